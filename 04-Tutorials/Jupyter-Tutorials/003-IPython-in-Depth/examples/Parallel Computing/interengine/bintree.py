@@ -3,7 +3,11 @@ BinaryTree inter-engine communication class
 
 use from bintree_script.py
 
-Provides parallel [all]reduce functionality
+Provides parallel [all]reduce functionality: reduce on a binary tree,
+and allreduce on the tree, on a ring or by recursive doubling, or
+with algorithm='auto', whichever suits the size of the value and
+number of engines best.
+ireduce, iallreduce and ibroadcast start them in the background.
 
 """
 from __future__ import print_function
@@ -11,10 +15,18 @@ from __future__ import print_function
 import cPickle as pickle
 import re
 import socket
+import threading
+import time
 import uuid
+from collections import namedtuple
 
 import zmq
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from IPython.parallel.util import disambiguate_url
 
 
@@ -22,8 +34,9 @@ from IPython.parallel.util import disambiguate_url
 # bintree-related construction/printing helpers
 #----------------------------------------------------------------------------
 
-def bintree(ids, parent=None):
+def bintree(ids, parent=None, k=2):
     """construct {child:parent} dict representation of a binary tree
+    (or a k-ary tree, in which each node has up to k children)
     
     keys are the nodes in the tree, and values are the parent of each node.
     
@@ -52,10 +65,48 @@ def bintree(ids, parent=None):
     else:
         ids = ids[1:]
         n = len(ids)
-        left = bintree(ids[:n/2], parent=root)
-        right = bintree(ids[n/2:], parent=root)
-        parents.update(left)
-        parents.update(right)
+        for i in range(k):
+            parents.update(bintree(ids[i*n//k:(i+1)*n//k], parent=root, k=k))
+    return parents
+
+def topology_tree(ids, locations, k=2):
+    """construct a {child:parent} tree, which reduces within each host
+    before going across hosts
+    
+    locations is a dict of the host of each id, e.g. the location in the
+    info of the communicators. The engines of each host form a k-ary tree
+    (see bintree), and the roots of these trees another one, rooted at ids[0],
+    so there is one edge between hosts for each host but the first. A root
+    has up to k children on its host, and k on other hosts.
+    
+    >>> locations = {0: 'a', 1: 'b', 2: 'a', 3: 'b', 4: 'a', 5: 'b'}
+    >>> stats = tree_stats(bintree(range(6)), locations)
+    >>> stats['cross_node_edges'], stats['depth']
+    (4, 2)
+    >>> tree = topology_tree(range(6), locations)
+    >>> print_bintree(tree, locations=locations)
+    0 (a)
+      1 (b)
+        3 (b)
+        5 (b)
+      2 (a)
+      4 (a)
+    >>> stats = tree_stats(tree, locations)
+    >>> stats['cross_node_edges'], stats['depth']
+    (1, 2)
+    """
+    hosts = []
+    members = {}
+    for id in ids:
+        host = locations[id]
+        if host not in members:
+            hosts.append(host)
+            members[host] = []
+        members[host].append(id)
+    heads = [members[host][0] for host in hosts]
+    parents = bintree(heads, k=k)
+    for host, head in zip(hosts, heads):
+        parents.update(bintree(members[host], parent=parents[head], k=k))
     return parents
 
 def reverse_bintree(parents):
@@ -90,10 +141,39 @@ def depth(n, tree):
         parent = tree[parent]
     return d
 
-def print_bintree(tree, indent='  '):
-    """print a binary tree"""
-    for n in sorted(tree.keys()):
-        print("%s%s" % (indent * depth(n,tree), n))
+def subtree(n, tree):
+    """the nodes in the subtree of n, n first"""
+    nodes = [n]
+    for child, parent in tree.iteritems():
+        if parent == n:
+            nodes.extend(subtree(child, tree))
+    return nodes
+
+def tree_height(n, tree):
+    """the length of the longest path from n down to a leaf"""
+    return max([tree_height(child, tree)+1 for child, parent in tree.iteritems()
+                if parent == n] or [0])
+
+def tree_stats(tree, locations=None):
+    """the depth of a tree, the most children of a node, and with the
+    host of each node in locations, the number of edges between hosts"""
+    stats = dict(depth=max([depth(n, tree) for n in tree] or [0]),
+                 max_children=max([tree.values().count(n) for n in tree] or [0]))
+    if locations is not None:
+        stats['cross_node_edges'] = len([n for n, parent in tree.iteritems()
+                                         if parent is not None and locations[n] != locations[parent]])
+    return stats
+
+def print_bintree(tree, indent='  ', locations=None):
+    """print a tree, with the host of each node if locations are given"""
+    children = reverse_bintree(tree)
+    def print_node(n):
+        host = ' (%s)' % locations[n] if locations is not None else ''
+        print("%s%s%s" % (indent * depth(n,tree), n, host))
+        for child in sorted(children.get(n, [])):
+            print_node(child)
+    if None in children:
+        print_node(children[None])
 
 #----------------------------------------------------------------------------
 # Communicator class for a binary-tree map
@@ -107,6 +187,17 @@ def disambiguate_dns_url(url, location):
         location = socket.gethostbyname(location)
     return disambiguate_url(url, location)
 
+class CollectiveTimeout(RuntimeError):
+    """engines did not send their part of a collective operation in time,
+    their ids are in the attribute engines"""
+    def __init__(self, message, engines):
+        RuntimeError.__init__(self, message)
+        self.engines = engines
+
+# a piece of a flattened array: elements start:start+len(data) of
+# an array of the given shape, which was sent in count segments
+Segment = namedtuple('Segment', 'index count start shape data')
+
 class BinaryTreeCommunicator(object):
     
     id          = None
@@ -116,17 +207,50 @@ class BinaryTreeCommunicator(object):
     upstream    = None
     pub_url     = None
     tree_url    = None
+    # split arrays larger than this (in bytes) into segments in reduce
+    # and broadcast; None sends them whole
+    segment_bytes = None
+    # the allreduce algorithm: 'tree', 'ring', 'recursive_doubling',
+    # or 'auto' for the fastest one by a simple cost model, with this
+    # latency (s) per message and transfer time (s) per byte. They apply
+    # f in different orders, see allreduce, so 'auto' is opt-in
+    algorithm   = 'tree'
+    latency     = 1e-4
+    byte_time   = 1e-9
+    # seconds a collective operation may take before the engines that
+    # haven't sent their part are given up on (None: wait forever)
+    timeout     = 60.
+    # seconds between the heartbeats of each engine to its parent in the
+    # tree (None: no heartbeats); a child that misses heartbeat_misses
+    # of them in a row is given up on before the timeout
+    heartbeat   = None
+    heartbeat_misses = 3
+    # reduce without the subtrees of the children that are given up on,
+    # instead of raising CollectiveTimeout; their ids are then in missing
+    degraded    = False
+    missing     = []
+    # the thread of ireduce, iallreduce and ibroadcast (see nonblocking.py)
+    progress    = None
     
-    def __init__(self, id, interface='tcp://*', root=False):
+    def __init__(self, id, interface='tcp://*', root=False, segment_bytes=None,
+                 timeout=60., heartbeat=None, degraded=False):
         self.id = id
         self.root = root
+        self.segment_bytes = segment_bytes
+        self.timeout = timeout
+        self.heartbeat = heartbeat
+        self.degraded = degraded
         
         # create context and sockets
         self._ctx = zmq.Context()
         if root:
             self.pub = self._ctx.socket(zmq.PUB)
+            # PUB drops what is over the high water mark, so don't
+            # have one: the segments of a large array are many messages
+            self.pub.hwm = 0
         else:
             self.sub = self._ctx.socket(zmq.SUB)
+            self.sub.hwm = 0
             self.sub.setsockopt(zmq.SUBSCRIBE, b'')
         self.downstream = self._ctx.socket(zmq.PULL)
         self.upstream = self._ctx.socket(zmq.PUSH)
@@ -141,15 +265,43 @@ class BinaryTreeCommunicator(object):
         self.tree_url = interface_f % tree_port
         self.downstream_poller = zmq.Poller()
         self.downstream_poller.register(self.downstream, zmq.POLLIN)
+        if not root:
+            self.sub_poller = zmq.Poller()
+            self.sub_poller.register(self.sub, zmq.POLLIN)
+        # parts of later collectives, which children sent early
+        self.early = []
+        self.heartbeat_thread = None
+        
+        # messages from any engine, for the ring and recursive doubling,
+        # which are sent on a PUSH socket per peer, connected when needed
+        self.inbox = self._ctx.socket(zmq.PULL)
+        inbox_port = self.inbox.bind_to_random_port(interface)
+        self.inbox_url = interface_f % inbox_port
+        self.inbox_poller = zmq.Poller()
+        self.inbox_poller.register(self.inbox, zmq.POLLIN)
+        self.outboxes = {}
+        # messages that arrived before they were waited for
+        self.pending = {}
+        self.collectives = 0
         
         # guess first public IP from socket
         self.location = socket.gethostbyname_ex(socket.gethostname())[-1][0]
     
     def __del__(self):
+        if self.progress is not None:
+            self.progress.stop()
+        if self.heartbeat_thread is not None:
+            self.stop_heartbeat.set()
+            self.heartbeat_thread.join()
         self.downstream.close()
-        self.upstream.close()
+        # the collectives wait for their messages to go, so anything still
+        # queued is for an engine that was given up on: drop it
+        self.upstream.close(linger=0)
+        self.inbox.close()
+        for outbox in self.outboxes.values():
+            outbox.close(linger=0)
         if self.root:
-            self.pub.close()
+            self.pub.close(linger=0)
         else:
             self.sub.close()
         self._ctx.term()
@@ -157,61 +309,289 @@ class BinaryTreeCommunicator(object):
     @property
     def info(self):
         """return the connection info for this object's sockets."""
-        return (self.tree_url, self.location)
+        return (self.tree_url, self.location, self.inbox_url)
     
     def connect(self, peers, btree, pub_url, root_id=0):
-        """connect to peers.  `peers` will be a dict of 4-tuples, keyed by name.
-        {peer : (ident, addr, pub_addr, location)}
-        where peer is the name, ident is the XREP identity, addr,pub_addr are the
+        """connect to peers.  `peers` will be a dict of 3-tuples, keyed by id.
+        {peer : (tree_url, location, inbox_url)}
+        the info of the BinaryTreeCommunicator of each engine.
         """
         
         # count the number of children we have
         self.nchildren = btree.values().count(self.id)
+        self.children = [child for child, parent in btree.iteritems() if parent == self.id]
+        self.tree = btree
+        self.root_id = root_id
+        self.height = tree_height(self.id, btree)
+        self.levels = max(tree_height(root_id, btree), 1)
+        self.last_seen = dict((child, time.time()) for child in self.children)
+        # the engines in the order of the ring
+        self.peers = peers
+        self.ids = sorted(peers)
+        self.rank = self.ids.index(self.id)
+        # the engines that get what the root publishes
+        self.subscribers = [i for i in self.ids if i != root_id]
         
         if self.root:
             return # root only binds
         
-        root_location = peers[root_id][-1]
+        root_location = peers[root_id][1]
         self.sub.connect(disambiguate_dns_url(pub_url, root_location))
         
         parent = btree[self.id]
         
-        tree_url, location = peers[parent]
+        tree_url, location = peers[parent][:2]
         self.upstream.connect(disambiguate_dns_url(tree_url, location))
+        if self.heartbeat:
+            self.start_heartbeat(disambiguate_dns_url(tree_url, location))
+    
+    def start_heartbeat(self, url):
+        """send a heartbeat to the parent at url every self.heartbeat seconds,
+        from a thread, so that it comes while the engine is busy"""
+        self.stop_heartbeat = threading.Event()
+        def beat():
+            socket = self._ctx.socket(zmq.PUSH)
+            socket.linger = 0
+            socket.connect(url)
+            header = pickle.dumps((self.id, None, None), -1)
+            while not self.stop_heartbeat.wait(self.heartbeat):
+                try:
+                    socket.send(header, zmq.NOBLOCK)
+                except zmq.Again:
+                    # the parent is gone or far behind
+                    pass
+            socket.close()
+        self.heartbeat_thread = threading.Thread(target=beat)
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
     
     def serialize(self, obj):
         """serialize objects.
         
         Must return list of sendable buffers.
         
-        Can be extended for more efficient/noncopying serialization of numpy arrays, etc.
+        The first buffer says how the rest is encoded. numpy arrays are
+        sent as their metadata (dtype and shape) and their data, which zmq
+        sends from the array itself, without a copy (arrays that aren't
+        C-contiguous are copied once). Everything else is pickled.
+        
+        Segments of arrays are sent in segment_frames.
         """
-        return [pickle.dumps(obj)]
+        if numpy is not None and isinstance(obj, numpy.ndarray) and not obj.dtype.hasobject:
+            if not obj.flags.c_contiguous:
+                obj = obj.copy()
+            return [b'array', pickle.dumps((obj.dtype, obj.shape), -1), obj]
+        return [b'pickle', pickle.dumps(obj, -1)]
     
     def unserialize(self, msg):
-        """inverse of serialize"""
-        return pickle.loads(msg[0])
+        """inverse of serialize, for the frames of a message received with copy=False
+        
+        Arrays are built on the received data without a copy, so they are
+        read-only: reduce functions should return new arrays (a+b), not
+        update their arguments in place.
+        """
+        kind = msg[0].bytes
+        if kind == b'array':
+            dtype, shape = pickle.loads(msg[1].bytes)
+            return numpy.frombuffer(msg[2].buffer, dtype=dtype).reshape(shape)
+        elif kind == b'segment':
+            index, count, start, dtype, shape = pickle.loads(msg[1].bytes)
+            return Segment(index, count, start, shape, numpy.frombuffer(msg[2].buffer, dtype=dtype))
+        return pickle.loads(msg[1].bytes)
+    
+    def send_tree(self, socket, tag, frames, missing=(), flags=0):
+        """send the frames of a value or a segment in collective tag on the
+        tree, with the ids of the engines missing from it, without waiting
+        for it to go. Returns the tracker of the message: the data of arrays
+        is sent in place, so wait on it before changing them."""
+        header = pickle.dumps((self.id, tag, list(missing)), -1)
+        return socket.send_multipart([header]+frames, flags=flags, copy=False, track=True)
     
-    def publish(self, value):
+    def wait_sent(self, sent, deadline=None):
+        """wait until zmq is done with the messages in sent, a list of
+        (engines, tracker) pairs, by deadline (default: self.deadline() from
+        now). Raises CollectiveTimeout naming the engines a message is still
+        queued for then, which are gone or have stopped reading"""
+        if deadline is None:
+            deadline = self.deadline()
+        for engines, tracker in sent:
+            try:
+                tracker.wait(-1 if deadline is None else max(0, deadline-time.time()))
+            except zmq.NotDone:
+                raise CollectiveTimeout("engine %s: a message to engine(s) %s wasn't taken by the deadline"
+                                        %(self.id, ', '.join(map(str, engines))), engines)
+    
+    def parent(self):
+        """the id of the parent in the tree"""
+        return self.tree[self.id]
+    
+    def segments(self, value, segment_bytes):
+        """the (start, stop) bounds of the segments of segment_bytes
+        (at least one element) of the flattened array value"""
+        step = max(1, segment_bytes // value.itemsize)
+        return [(start, min(start+step, value.size)) for start in range(0, value.size, step)]
+    
+    def segment_frames(self, segment):
+        """the buffers to send a Segment in, like serialize"""
+        data = numpy.ascontiguousarray(segment.data)
+        header = pickle.dumps((segment.index, segment.count, segment.start, data.dtype, segment.shape), -1)
+        return [b'segment', header, data]
+    
+    def publish(self, value, tag, missing=()):
         assert self.root
-        self.pub.send_multipart(self.serialize(value))
+        self.wait_sent([(self.subscribers, self.send_tree(self.pub, tag, self.serialize(value), missing))])
     
-    def consume(self):
+    def consume(self, tag):
+        """the value published in collective tag, put together if it was sent
+        in segments. Sets missing to the engines missing from it."""
         assert not self.root
-        return self.unserialize(self.sub.recv_multipart())
+        # the root may take all of the timeout to give up on other engines
+        deadline = None if self.timeout is None else time.time()+self.timeout
+        result = None
+        received = 0
+        while True:
+            if not self.sub_poller.poll(None if deadline is None else 1000*max(0, deadline-time.time())):
+                raise CollectiveTimeout("engine %s: nothing from the root (engine %s) within %g s"
+                                        %(self.id, self.root_id, self.timeout), [self.root_id])
+            msg = self.sub.recv_multipart(copy=False)
+            root, t, missing = pickle.loads(msg[0].bytes)
+            if t != tag:
+                # the rest of a collective this engine gave up on
+                continue
+            if msg[1].bytes == b'stalled':
+                raise CollectiveTimeout(pickle.loads(msg[2].bytes), missing)
+            value = self.unserialize(msg[1:])
+            self.missing = missing
+            if not isinstance(value, Segment):
+                return value
+            if result is None:
+                result = numpy.empty(int(numpy.prod(value.shape)), value.data.dtype)
+            result[value.start:value.start+len(value.data)] = value.data
+            received += 1
+            if received == value.count:
+                return result.reshape(value.shape)
+    
+    def broadcast(self, value=None, segment_bytes=None):
+        """the value of the root on all nodes
+        
+        Arrays larger than segment_bytes (default: self.segment_bytes) are
+        published in segments, which the nodes copy into place while the
+        rest are still on their way.
+        """
+        if self.queued():
+            return self.ibroadcast(value, segment_bytes).wait()
+        tag = self.next_tag()
+        if not self.root:
+            return self.consume(tag)
+        if segment_bytes is None:
+            segment_bytes = self.segment_bytes
+        if not self.segmented(value, segment_bytes):
+            self.publish(value, tag)
+            return value
+        flat = numpy.ascontiguousarray(value).reshape(-1)
+        bounds = self.segments(flat, segment_bytes)
+        sent = [(self.subscribers, self.send_tree(self.pub, tag, self.segment_frames(
+                    Segment(i, len(bounds), start, value.shape, flat[start:stop]))))
+                for i, (start, stop) in enumerate(bounds)]
+        self.wait_sent(sent)
+        return value
+    
+    def segmented(self, value, segment_bytes):
+        """whether value is an array to send in segments"""
+        return (segment_bytes and numpy is not None and isinstance(value, numpy.ndarray)
+                and not value.dtype.hasobject and value.nbytes > segment_bytes)
 
-    def send_upstream(self, value, flags=0):
-        assert not self.root
-        self.upstream.send_multipart(self.serialize(value), flags=flags|zmq.NOBLOCK)
+    def abort(self, tag, error):
+        """raise error (a CollectiveTimeout) for collective tag, after passing it
+        up the tree, from where the root publishes it, so that the other
+        engines raise it as well instead of waiting for their timeout"""
+        frames = [b'stalled', pickle.dumps(str(error), -1)]
+        try:
+            if self.root:
+                self.wait_sent([(self.subscribers, self.send_tree(self.pub, tag, frames, error.engines))])
+            else:
+                self.wait_sent([([self.parent()], self.send_tree(self.upstream, tag, frames, error.engines))])
+        except CollectiveTimeout:
+            # the parent is gone too, the error is still the one to raise
+            pass
+        raise error
+    
+    def deadline(self):
+        """the time by which a collective starting now has to be done on this
+        engine. Nodes further down the tree give up on their children first,
+        so that their parents get what they have before giving up on them."""
+        if self.timeout is None:
+            return None
+        return time.time() + self.timeout*max(self.height, 1)/float(self.levels)
     
-    def recv_downstream(self, flags=0, timeout=2000.):
-        # wait for a message, so we won't block if there was a bug
-        self.downstream_poller.poll(timeout)
+    def recv_downstream(self, tag, waiting, deadline=None):
+        """the next message of collective tag from a child in waiting, as
+        (child, ids of the engines missing from it, value).
         
-        msg = self.downstream.recv_multipart(zmq.NOBLOCK|flags)
-        return self.unserialize(msg)
+        Raises CollectiveTimeout with the children in waiting that stalled:
+        which sent nothing by deadline (a time.time()), or with heartbeats,
+        that weren't heard from for heartbeat_misses heartbeats.
+        """
+        for i, (child, t, missing, value) in enumerate(self.early):
+            if t == tag and child in waiting:
+                del self.early[i]
+                return child, missing, value
+        while True:
+            # take in what has come before looking for stalled children
+            if not self.downstream_poller.poll(0):
+                self.check_stalled(waiting, deadline)
+                # wake up for the deadline, and to check the heartbeats
+                wait = [deadline-time.time()] if deadline is not None else []
+                if self.heartbeat:
+                    wait.append(self.heartbeat)
+                if not self.downstream_poller.poll(1000*max(0, min(wait)) if wait else None):
+                    continue
+            msg = self.downstream.recv_multipart(copy=False)
+            child, t, missing = pickle.loads(msg[0].bytes)
+            self.last_seen[child] = time.time()
+            if t is None:
+                # a heartbeat
+                continue
+            if t == tag and msg[1].bytes == b'stalled':
+                # the child gave up on engines below it
+                raise CollectiveTimeout(pickle.loads(msg[2].bytes), missing)
+            value = self.unserialize(msg[1:])
+            if t == tag and child in waiting:
+                return child, missing, value
+            elif t > tag:
+                self.early.append((child, t, missing, value))
+            # otherwise the late part of a collective that gave up on child
+    
+    def check_stalled(self, waiting, deadline):
+        """raise CollectiveTimeout for the children in waiting, if it is past
+        deadline, or for those that have missed heartbeat_misses heartbeats"""
+        now = time.time()
+        if deadline is not None and now >= deadline:
+            stalled = sorted(waiting)
+            reason = "nothing by the deadline"
+        elif self.heartbeat:
+            limit = self.heartbeat*self.heartbeat_misses
+            stalled = sorted(child for child in waiting if now-self.last_seen[child] > limit)
+            reason = "missed %i heartbeats"%self.heartbeat_misses
+        else:
+            return
+        if stalled:
+            raise CollectiveTimeout("engine %s: %s from engine %s (last heard from %s)"%(
+                                    self.id, reason, ', '.join(map(str, stalled)),
+                                    ', '.join('%.3g s ago'%(now-self.last_seen[c]) for c in stalled)),
+                                    stalled)
+    
+    def give_up(self, tag, error, waiting, missing):
+        """the children of error (a CollectiveTimeout) are given up on:
+        take them off waiting and add their subtrees to missing,
+        or if not degraded, abort collective tag with error"""
+        if not self.degraded:
+            self.abort(tag, error)
+        for child in error.engines:
+            waiting.discard(child)
+            missing.extend(subtree(child, self.tree))
     
-    def reduce(self, f, value, flat=True, all=False):
+    def reduce(self, f, value, flat=True, all=False, segment_bytes=None):
         """parallel reduce on binary tree
         
         if flat:
@@ -223,24 +603,320 @@ class BinaryTreeCommunicator(object):
             broadcast final result to all nodes
         else:
             only root gets final result
+        
+        Arrays larger than segment_bytes (default: self.segment_bytes) are
+        reduced in segments, see reduce_segmented. f must then work
+        elementwise, and the arrays must have the same shape on all nodes.
+        
+        Children that don't send their value in time (see timeout and
+        heartbeat) raise CollectiveTimeout, or if degraded, are left out:
+        the result is then the reduction over the rest, and missing lists
+        the engines whose values are not in it (on the root, and with all
+        on every engine).
         """
+        if self.queued():
+            return self.ireduce(f, value, flat, all, segment_bytes).wait()
         if not flat:
             value = reduce(f, value)
+        if segment_bytes is None:
+            segment_bytes = self.segment_bytes
+        if self.segmented(value, segment_bytes):
+            return self.reduce_segmented(f, value, segment_bytes, all)
         
-        for i in range(self.nchildren):
-            value = f(value, self.recv_downstream())
+        tag = self.next_tag()
+        deadline = self.deadline()
+        waiting = set(self.children)
+        missing = []
+        while waiting:
+            try:
+                child, child_missing, child_value = self.recv_downstream(tag, waiting, deadline)
+            except CollectiveTimeout as e:
+                self.give_up(tag, e, waiting, missing)
+                continue
+            waiting.discard(child)
+            missing.extend(child_missing)
+            value = f(value, child_value)
+        self.missing = sorted(missing)
         
         if not self.root:
-            self.send_upstream(value)
+            self.wait_sent([([self.parent()], self.send_tree(self.upstream, tag, self.serialize(value), missing))])
         
         if all:
             if self.root:
-                self.publish(value)
+                self.publish(value, tag, missing)
             else:
-                value = self.consume()
+                value = self.consume(tag)
         return value
     
-    def allreduce(self, f, value, flat=True):
-        """parallel reduce followed by broadcast of the result"""
-        return self.reduce(f, value, flat=flat, all=True)
+    def reduce_segmented(self, f, value, segment_bytes, all=False):
+        """pipelined reduce of the array value, in segments of segment_bytes
+        
+        A node combines each segment of its value with those of its children
+        as they arrive, and sends it up the tree as soon as all children have
+        sent theirs, while the later segments are still on their way. So a
+        segment at a time, not the whole array, waits at each level of the
+        tree. With all, the root publishes each segment of the result as soon
+        as it is complete.
+        
+        Children that stall raise CollectiveTimeout, also when degraded,
+        as the other segments may already have their parts.
+        """
+        tag = self.next_tag()
+        deadline = self.deadline()
+        shape = value.shape
+        flat = numpy.ascontiguousarray(value).reshape(-1)
+        bounds = self.segments(flat, segment_bytes)
+        partial = [flat[start:stop] for start, stop in bounds]
+        arrived = [0]*len(bounds)
+        # the children that haven't sent all their segments
+        received = dict((child, 0) for child in self.children)
+        waiting = set(self.children)
+        self.missing = []
+        sent = []
+        # the nodes with children keep their partial result
+        # (the whole result on the root), unless it is broadcast
+        keep = self.nchildren and (self.root or not all)
+        result = None
+        done = 0
+        while done < len(bounds):
+            if arrived[done] < self.nchildren:
+                try:
+                    child, missing, segment = self.recv_downstream(tag, waiting, deadline)
+                except CollectiveTimeout as e:
+                    self.abort(tag, e)
+                partial[segment.index] = f(partial[segment.index], segment.data)
+                arrived[segment.index] += 1
+                received[child] += 1
+                if received[child] == len(bounds):
+                    waiting.discard(child)
+                continue
+            # pass on the segments in order, as they are completed
+            start, stop = bounds[done]
+            if not self.root or all:
+                socket = self.pub if self.root else self.upstream
+                segment = Segment(done, len(bounds), start, shape, partial[done])
+                sent.append((self.subscribers if self.root else [self.parent()],
+                             self.send_tree(socket, tag, self.segment_frames(segment))))
+            if keep:
+                if result is None:
+                    result = numpy.empty(flat.size, numpy.asarray(partial[done]).dtype)
+                result[start:stop] = partial[done]
+            partial[done] = None
+            done += 1
+        
+        # the arrays being sent may be views of value
+        self.wait_sent(sent)
+        if all and not self.root:
+            return self.consume(tag)
+        if keep:
+            return result.reshape(shape)
+        return value
+    
+    def allreduce(self, f, value, flat=True, segment_bytes=None, algorithm=None):
+        """the reduction of value over all engines, on all engines
+        
+        algorithm (default: self.algorithm, which is 'tree') is one of
+        
+        'tree': reduce on the binary tree, followed by a broadcast of the
+            result. Each node calls f(its value, the value of a child's
+            subtree) for its children in the order their values arrive, so
+            f must be associative and commutative (see bintree_script.py).
+        'ring': reduce-scatter and allgather around the ring of all engines.
+            Each engine sends 2*(n-1) messages of 1/n of the value, so it is
+            the best one for large arrays. Only for arrays, with an
+            elementwise f. Each chunk is reduced around the ring from a
+            different engine on, as f(an engine's chunk, the chunk reduced
+            so far by the engines to its left), so f must be associative and
+            commutative.
+        'recursive_doubling': log2(n) rounds, in each of which every engine
+            swaps its value with a partner. The fewest messages, for small
+            values. f gets the values in the order of the engine ids (the
+            values of the lower ids first), grouped in pairs, pairs of pairs
+            and so on, so f needn't be commutative, only associative.
+        'auto': the fastest of these by allreduce_costs. Opt in only if f
+            suits all of them.
+        
+        All of them give the same result on all engines. As they group the
+        values differently, floating point results of the same f can differ
+        in the last bits from one algorithm to the other.
+        """
+        if self.queued():
+            return self.iallreduce(f, value, flat, segment_bytes, algorithm).wait()
+        if not flat:
+            value = reduce(f, value)
+        if algorithm is None:
+            algorithm = self.algorithm
+        if algorithm == 'auto':
+            costs = self.allreduce_costs(value)
+            algorithm = min(costs, key=costs.get)
+        if algorithm == 'tree':
+            return self.reduce(f, value, all=True, segment_bytes=segment_bytes)
+        elif algorithm == 'ring':
+            return self.ring_allreduce(f, value)
+        elif algorithm == 'recursive_doubling':
+            return self.recursive_doubling_allreduce(f, value)
+        raise ValueError("unknown allreduce algorithm: %r"%algorithm)
+    
+    def allreduce_costs(self, value, n=None):
+        """the modeled time of allreduce of value on n engines (default: all)
+        with each algorithm that can reduce it, for the latency and byte_time
+        of this communicator"""
+        n = n or len(self.ids)
+        array = (numpy is not None and isinstance(value, numpy.ndarray)
+                 and not value.dtype.hasobject)
+        if array:
+            nbytes = value.nbytes
+        else:
+            # anything else is sent pickled
+            nbytes = len(pickle.dumps(value, -1))
+        message = lambda nbytes: self.latency + nbytes*self.byte_time
+        # log2(n), rounded down
+        log2n = n.bit_length()-1
+        stats = tree_stats(self.tree if n == len(self.ids) else bintree(range(n)))
+        # a message from each child on each level of the tree,
+        # then the root publishes a copy for each engine
+        costs = dict(tree=stats['depth']*stats['max_children']*message(nbytes) + message((n-1)*nbytes))
+        # a round for each bit, and two more if n isn't a power of two
+        rounds = log2n if n == 2**log2n else log2n+2
+        costs['recursive_doubling'] = rounds*message(nbytes)
+        if array and value.size:
+            costs['ring'] = 2*(n-1)*message(nbytes/float(n))
+        return costs
+    
+    def start(self, f, *args, **kwargs):
+        """a Request for f(*args, **kwargs), run by the progress thread
+        after the collectives started before it"""
+        if self.progress is None:
+            # Progress comes from nonblocking.py, which is run on the
+            # engines along with this file
+            self.progress = Progress()
+        return self.progress.start(f, *args, **kwargs)
+    
+    def queued(self):
+        """whether a blocking collective called now must wait for its turn
+        on the progress thread, which owns the sockets once it is started"""
+        return (self.progress is not None and self.progress.thread is not None
+                and threading.current_thread() is not self.progress.thread)
+    
+    def ibroadcast(self, value=None, segment_bytes=None):
+        """broadcast without waiting for it: returns a Request (see
+        nonblocking.py), whose wait() gives the result of broadcast"""
+        return self.start(self.broadcast, value, segment_bytes)
+    
+    def ireduce(self, f, value, flat=True, all=False, segment_bytes=None):
+        """reduce without waiting for it: returns a Request (see
+        nonblocking.py), whose wait() gives the result of reduce.
+        
+        The collectives run on a thread, one at a time, in the order they
+        are started, which must be the same on all engines. Arrays are sent
+        without a copy, so don't change value until the request is done.
+        """
+        return self.start(self.reduce, f, value, flat, all, segment_bytes)
+    
+    def iallreduce(self, f, value, flat=True, segment_bytes=None, algorithm=None):
+        """allreduce without waiting for it: returns a Request (see
+        nonblocking.py), whose wait() gives the result of allreduce.
+        As in ireduce, don't change value until the request is done."""
+        return self.start(self.allreduce, f, value, flat, segment_bytes, algorithm)
+    
+    def next_tag(self):
+        """a tag for the messages of a new collective operation, which
+        is the same on all engines if they call the same collectives"""
+        self.collectives += 1
+        return self.collectives
+    
+    def send_to(self, peer, tag, value):
+        """send value to the engine peer, without waiting for it to go,
+        returns the tracker of the message"""
+        if peer not in self.outboxes:
+            tree_url, location, inbox_url = self.peers[peer]
+            outbox = self._ctx.socket(zmq.PUSH)
+            outbox.connect(disambiguate_dns_url(inbox_url, location))
+            self.outboxes[peer] = outbox
+        header = pickle.dumps((self.id, tag), -1)
+        return self.outboxes[peer].send_multipart([header]+self.serialize(value),
+                                                  copy=False, track=True)
+    
+    def p2p_deadline(self):
+        """the time by which a message between two engines, which don't wait
+        for the rest of the tree, has to arrive: self.timeout from now"""
+        return None if self.timeout is None else time.time()+self.timeout
+    
+    def recv_from(self, peer, tag):
+        """the value sent by the engine peer with tag. Raises
+        CollectiveTimeout if it doesn't come within self.timeout"""
+        key = (peer, tag)
+        deadline = self.p2p_deadline()
+        while key not in self.pending:
+            wait = None if deadline is None else 1000*max(0, deadline-time.time())
+            if not self.inbox_poller.poll(wait):
+                raise CollectiveTimeout("engine %s: nothing from engine %s within %g s"
+                                        %(self.id, peer, self.timeout), [peer])
+            msg = self.inbox.recv_multipart(copy=False)
+            self.pending[pickle.loads(msg[0].bytes)] = self.unserialize(msg[1:])
+        return self.pending.pop(key)
+    
+    def ring_allreduce(self, f, value):
+        """allreduce of an array on the ring of engines, see allreduce"""
+        n = len(self.ids)
+        if n == 1:
+            return value
+        tag = self.next_tag()
+        rank = self.rank
+        right = self.ids[(rank+1)%n]
+        left = self.ids[(rank-1)%n]
+        flat = numpy.ascontiguousarray(value).reshape(-1)
+        chunks = [flat[flat.size*i//n:flat.size*(i+1)//n] for i in range(n)]
+        sent = []
+        # reduce-scatter: pass on the chunk reduced so far, and add to it
+        # the one from the left, so that chunk rank+1 is complete at the end
+        for step in range(n-1):
+            sent.append(([right], self.send_to(right, (tag, step), chunks[(rank-step)%n])))
+            c = (rank-step-1)%n
+            chunks[c] = f(chunks[c], self.recv_from(left, (tag, step)))
+        # allgather: pass the complete chunks around the ring
+        for step in range(n-1):
+            sent.append(([right], self.send_to(right, (tag, n-1+step), chunks[(rank+1-step)%n])))
+            chunks[(rank-step)%n] = self.recv_from(left, (tag, n-1+step))
+        # the first chunk sent is a view of value
+        self.wait_sent(sent, self.p2p_deadline())
+        return numpy.concatenate(chunks).reshape(value.shape)
+    
+    def recursive_doubling_allreduce(self, f, value):
+        """allreduce by recursive doubling, see allreduce"""
+        n = len(self.ids)
+        if n == 1:
+            return value
+        tag = self.next_tag()
+        rank = self.rank
+        ids = self.ids
+        # the largest power of two <= n; the first 2*extra engines pair up,
+        # and the even one of each pair sits out, with the odd one holding
+        # the values of both
+        p2 = 2**(n.bit_length()-1)
+        extra = n-p2
+        sent = []
+        if rank < 2*extra:
+            if rank%2 == 0:
+                sent.append(([ids[rank+1]], self.send_to(ids[rank+1], (tag, 'in'), value)))
+                value = self.recv_from(ids[rank+1], (tag, 'out'))
+                self.wait_sent(sent, self.p2p_deadline())
+                return value
+            value = f(self.recv_from(ids[rank-1], (tag, 'in')), value)
+            vrank = rank//2
+        else:
+            vrank = rank-extra
+        # swap with the partners whose (virtual) rank differs in one bit
+        mask = 1
+        while mask < p2:
+            vpartner = vrank^mask
+            partner = ids[2*vpartner+1 if vpartner < extra else vpartner+extra]
+            sent.append(([partner], self.send_to(partner, (tag, mask), value)))
+            other = self.recv_from(partner, (tag, mask))
+            value = f(value, other) if vrank < vpartner else f(other, value)
+            mask *= 2
+        if rank < 2*extra:
+            sent.append(([ids[rank-1]], self.send_to(ids[rank-1], (tag, 'out'), value)))
+        self.wait_sent(sent, self.p2p_deadline())
+        return value
 
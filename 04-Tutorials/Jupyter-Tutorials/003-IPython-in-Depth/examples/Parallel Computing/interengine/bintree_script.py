@@ -33,18 +33,19 @@ view = rc[:]
 # run bintree.py script defining bintree functions, etc.
 execfile('bintree.py')
 
-# generate binary tree of parents
-btree = bintree(ids)
-
-print "setting up binary tree interconnect:"
-print_bintree(btree)
+# the number of children of each node in the tree
+fanout = 2
 
+view.run('nonblocking.py')
 view.run('bintree.py')
 view.scatter('id', ids, flatten=True)
 view['root_id'] = root_id
 
-# create the Communicator objects on the engines
-view.execute('com = BinaryTreeCommunicator(id, root = id==root_id )')
+# create the Communicator objects on the engines; a collective raises
+# CollectiveTimeout, naming the engine it waited for, if that takes more than
+# timeout seconds, or misses 3 of the heartbeats it sends every second
+# (with degraded=True, the others carry on without it instead)
+view.execute('com = BinaryTreeCommunicator(id, root = id==root_id, timeout=60., heartbeat=1.)')
 pub_url = root.apply_sync(lambda : com.pub_url)
 
 # gather the connection information into a dict
@@ -52,6 +53,16 @@ ar = view.apply_async(lambda : com.info)
 peers = ar.get_dict()
 # this is a dict, keyed by engine ID, of the connection info for the EngineCommunicators
 
+# generate a tree of parents, which reduces on each host first,
+# so that only one edge per host goes between hosts
+locations = dict((id, info[1]) for id, info in peers.items())
+btree = topology_tree(ids, locations, k=fanout)
+
+print "setting up tree interconnect:"
+print_bintree(btree, locations=locations)
+print "tree by engine id:", tree_stats(bintree(ids, k=fanout), locations)
+print "tree by host:     ", tree_stats(btree, locations)
+
 # connect the engines to each other:
 def connect(com, peers, tree, pub_url, root_id):
     """this function will be called on the engines"""
@@ -85,3 +96,27 @@ print "allreduce sum of data on all engines:", view['data_sum']
 view.execute("ids_sum = com.reduce(add, id, flat=True)")
 print "reduce sum of engine ids (not broadcast):", root['ids_sum']
 print "partial result on each engine:", view['ids_sum']
+
+# large arrays can be reduced in segments, which are pipelined up the tree
+# and published as soon as they are done (add works elementwise on arrays)
+view.execute("import numpy")
+view.execute("big = numpy.ones(1<<22)*id") # 32 MB per engine
+view.execute("big_sum = com.allreduce(add, big, segment_bytes=1<<20)")
+view.execute("big_first = big_sum[0]")
+print "segmented allreduce of 32 MB arrays, first element:", view['big_first']
+
+# allreduce over the ring of all engines, and by recursive doubling, with
+# the same connections; 'auto' picks one by the size of the value (the
+# default is the tree; see allreduce for the order each one applies f in)
+for algorithm in ('ring', 'recursive_doubling', 'auto'):
+    view.execute("big_sum = com.allreduce(add, big, algorithm=%r)"%algorithm)
+    view.execute("big_first = big_sum[0]")
+    print "%s allreduce of 32 MB arrays, first element:"%algorithm, view['big_first']
+
+# iallreduce returns at once, with a request whose wait() gives the result,
+# so the engines can compute while the arrays go up and down the tree
+view.execute("request = com.iallreduce(add, big)")
+view.execute("other = numpy.dot(big[:1000], big[:1000])") # meanwhile
+view.execute("big_sum = request.wait()")
+view.execute("big_first = big_sum[0]")
+print "iallreduce of 32 MB arrays, first element:", view['big_first']
@@ -62,7 +62,23 @@ class EngineCommunicator(object):
         for p in peers:
             ident = self.peers[p]
             self.socket.send_multipart([ident]+msg, flags=flags, copy=copy)
-        
+
+    def isend(self, peers, msg, flags=0):
+        """send without waiting for the messages to go, return a
+        SendRequest (see nonblocking.py). msg is sent without a copy,
+        so don't change its buffers until the request is done.
+        SendRequest comes from nonblocking.py, run it on the engines too."""
+        if not isinstance(peers, list):
+            peers = [peers]
+        if not isinstance(msg, list):
+            msg = [msg]
+        trackers = []
+        for p in peers:
+            ident = self.peers[p]
+            trackers.append(self.socket.send_multipart([ident]+msg, flags=flags,
+                                                       copy=False, track=True))
+        return SendRequest(trackers)
+
     def recv(self, flags=0, copy=True):
         return self.socket.recv_multipart(flags=flags, copy=copy)[1:]
     
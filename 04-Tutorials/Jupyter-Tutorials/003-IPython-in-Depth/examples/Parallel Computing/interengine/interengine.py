@@ -6,6 +6,7 @@ from IPython.parallel import Client
 rc = Client()
 rc.block=True
 view = rc[:]
+view.run('nonblocking.py')
 view.run('communicator.py')
 view.execute('com = EngineCommunicator()')
 
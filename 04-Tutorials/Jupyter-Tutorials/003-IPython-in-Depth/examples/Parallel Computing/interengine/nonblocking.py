@@ -0,0 +1,111 @@
+"""
+Non-blocking operations for the inter-engine communicators
+
+use from bintree.py (ireduce, iallreduce, ibroadcast) and
+communicator.py (isend)
+
+A non-blocking operation returns a request at once: test() says whether
+the operation is done, wait() waits for its result. A Progress thread
+carries out the collectives of a communicator one at a time, in the
+order they were started; zmq and numpy release the GIL while they work,
+so the engine can compute in the meantime. Sends need no thread of our
+own: zmq's I/O thread sends them, and a SendRequest is done when it has.
+
+Run it on the engines along with the communicator, which uses its
+classes from the engine namespace:
+
+    view.run('nonblocking.py')
+    view.run('bintree.py')
+"""
+from __future__ import print_function
+
+import sys
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import zmq
+
+
+class Request(object):
+    """the result of an operation carried out by a Progress thread"""
+
+    def __init__(self, name):
+        self.name = name
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def __repr__(self):
+        return "<Request %s: %s>" % (self.name, 'done' if self.test() else 'pending')
+
+    def test(self):
+        """whether the operation is done (also if it failed)"""
+        return self.done.is_set()
+
+    def wait(self):
+        """the result of the operation, once it is done;
+        raises the error of the operation if it failed"""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SendRequest(object):
+    """the request of messages sent with track=True"""
+
+    def __init__(self, trackers):
+        self.tracker = zmq.MessageTracker(*trackers)
+
+    def __repr__(self):
+        return "<SendRequest: %s>" % ('done' if self.test() else 'pending')
+
+    def test(self):
+        """whether zmq is done with the messages, so that their
+        buffers may be changed again"""
+        return self.tracker.done
+
+    def wait(self):
+        """wait until zmq is done with the messages"""
+        self.tracker.wait()
+
+
+class Progress(object):
+    """a thread that carries out operations one at a time, in order"""
+
+    def __init__(self):
+        self.queue = Queue()
+        self.thread = None
+
+    def start(self, f, *args, **kwargs):
+        """a Request for f(*args, **kwargs), run after the ones started before"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        request = Request(getattr(f, '__name__', 'operation'))
+        self.queue.put((request, f, args, kwargs))
+        return request
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            request, f, args, kwargs = item
+            try:
+                request.result = f(*args, **kwargs)
+            except Exception:
+                request.error = sys.exc_info()[1]
+            request.done.set()
+
+    def stop(self):
+        """finish the operations started so far, and stop the thread"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 """A rectangular domain partitioner and associated communication
-functionality for solving PDEs in (1D,2D) using FDM
+functionality for solving PDEs in (1D,2D,ND) using FDM
 written in the python language
 
 The global solution domain is assumed to be of rectangular shape,
 where the number of cells in each direction is stored in nx, ny, nz
+(or global_num_cells, for any number of space dimensions)
 
 The numerical scheme is fully explicit
 
@@ -16,15 +17,282 @@ Authors
 
 """
 from __future__ import print_function
+import os
+import tempfile
 import time
 
-from numpy import zeros, ascontiguousarray, frombuffer
+from numpy import zeros, copyto, frombuffer, asarray, ndarray
+from numpy.lib.format import open_memmap
 try:
     from mpi4py import MPI
 except ImportError:
     pass
 else:
     mpi = MPI.COMM_WORLD
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+def factorizations(n, ndim):
+    """all ordered ways of writing n as a product of ndim positive integers"""
+    if ndim == 1:
+        return [[n]]
+    result = []
+    for d in range(1, n+1):
+        if n%d == 0:
+            for rest in factorizations(n//d, ndim-1):
+                result.append([d]+rest)
+    return result
+
+def partition_cost(global_num_cells, num_parts, itemsize=8):
+    """
+    Predict the communication of a partitioning, per time step.
+
+    Returns a dict with the total number of halo bytes sent by all
+    subdomains ('halo_bytes'), the halo bytes sent by the busiest subdomain
+    ('max_halo_bytes') and its ratio of halo cells sent to cells computed
+    ('comm_compute').
+    """
+    nsd_ = len(global_num_cells)
+    points = [n+1 for n in global_num_cells]
+    total = 0
+    for i in range(nsd_):
+        # every inner interface is crossed by one message in each direction
+        face = 1
+        for j in range(nsd_):
+            if j != i:
+                face *= points[j]
+        total += 2*(num_parts[i]-1)*face
+    # the busiest subdomain: the largest one, with neighbors on both sides
+    loc_points = [-(-global_num_cells[i]//num_parts[i])+1 for i in range(nsd_)]
+    loc_cells = 1
+    for n in loc_points:
+        loc_cells *= n
+    halo = 0
+    for i in range(nsd_):
+        sides = min(2, num_parts[i]-1)
+        halo += sides*loc_cells//loc_points[i]
+    return dict(halo_bytes=total*itemsize, max_halo_bytes=halo*itemsize,
+                comm_compute=float(halo)/loc_cells)
+
+def plan_partition(global_num_cells, num_procs, itemsize=8):
+    """
+    Choose the numbers of subdomains in each direction for num_procs
+    engines, such that the fewest halo bytes are exchanged per time step.
+    Ties are broken by the halo bytes of the busiest subdomain, and then
+    in favor of more subdomains in the first direction, whose halos are
+    contiguous rows.
+
+    Returns (num_parts, cost), where cost is the partition_cost dict.
+    """
+    best = None
+    for parts in factorizations(num_procs, len(global_num_cells)):
+        # every subdomain needs at least a couple of cells in each direction
+        if any(2*p > n for p,n in zip(parts, global_num_cells)):
+            continue
+        cost = partition_cost(global_num_cells, parts, itemsize)
+        key = (cost['halo_bytes'], cost['max_halo_bytes'], -parts[0])
+        if best is None or key < best[0]:
+            best = (key, parts, cost)
+    if best is None:
+        raise ValueError("can't partition %s cells over %i engines"%(global_num_cells, num_procs))
+    return best[1], best[2]
+
+def split_cells(num_cells, weights, min_cells=1):
+    """
+    Split num_cells cells into len(weights) parts, with sizes in proportion
+    to weights, but at least min_cells each. Returns the cuts, the first
+    cell of each part and num_cells at the end.
+    """
+    num_parts = len(weights)
+    if num_cells < num_parts*min_cells:
+        raise ValueError("can't split %i cells into %i parts of at least %i cells"\
+                         %(num_cells, num_parts, min_cells))
+    total = float(sum(weights))
+    cuts = [0]
+    acc = 0.0
+    for w in weights[:-1]:
+        acc += w
+        cuts.append(int(round(num_cells*acc/total)))
+    cuts.append(num_cells)
+    # make room for the smallest parts, from both ends
+    for r in range(1, num_parts):
+        cuts[r] = max(cuts[r], cuts[r-1]+min_cells)
+    for r in range(num_parts-1, 0, -1):
+        cuts[r] = min(cuts[r], cuts[r+1]-min_cells)
+    return cuts
+
+def limit_cuts(old, new, min_cells=1):
+    """
+    Move the cuts old toward new, but not past the neighboring old cuts, so
+    that every new part only takes cells from its old neighbors. Returns
+    old if that leaves a part smaller than min_cells.
+    """
+    cuts = [old[0]]+[min(max(c, old[r-1]), old[r+1])
+                     for r, c in enumerate(new[1:-1], 1)]+[old[-1]]
+    if any(cuts[r+1]-cuts[r] < min_cells for r in range(len(cuts)-1)):
+        return list(old)
+    return cuts
+
+def owned_block(u, partitioner):
+    """the global slices of the points a subdomain owns, the shape of the
+    global array, and the values of the owned points in u"""
+    local, glob = partitioner.get_owned_slices()
+    return glob, [n+1 for n in partitioner.global_num_cells], u[local]
+
+def gather_global(view, u='u', partitioner='partitioner', out=None):
+    """
+    Assemble a global array from the local arrays of the engines in view.
+
+    u and partitioner are the names (or expressions, e.g. 'solver.us[1]')
+    of the local solution array and of its partitioner in the engines'
+    namespaces. Each engine sends only the points it owns, and the blocks
+    are copied into out at their global offsets in whatever order the
+    engines finish, so the client holds the global array and a few blocks
+    at a time. out may be an array of shape (nx+1, ny+1, ...), the name of
+    a .npy file to create as a memory-mapped array, or None for a new array.
+    Returns out.
+    """
+    from IPython.parallel import Reference
+    client = view.client
+    targets = view.targets
+    if targets is None or targets == 'all':
+        targets = client.ids
+    elif isinstance(targets, int):
+        targets = [targets]
+    pending = [client[t].apply_async(owned_block, Reference(u), Reference(partitioner))
+               for t in targets]
+    while pending:
+        done = [ar for ar in pending if ar.ready()]
+        if not done:
+            time.sleep(1e-3)
+            continue
+        for ar in done:
+            pending.remove(ar)
+            glob, shape, block = ar.get()
+            if out is None:
+                out = zeros(shape, block.dtype)
+            elif isinstance(out, str):
+                out = open_memmap(out, mode='w+', dtype=block.dtype, shape=tuple(shape))
+            out[glob] = block
+    return out
+
+def chain_allreduce(value, lower, upper):
+    """
+    Sum value (a number or an array) over a chain of engines, where lower
+    and upper are the 0MQ sockets to the neighbors (None at the ends), and
+    return the total on all of them. The partial sums travel up the chain
+    and then back down, one message per socket in each direction.
+    """
+    value = asarray(value, dtype=float)
+    below = 0.0
+    if lower is not None:
+        below = frombuffer(lower.recv(), dtype=float).reshape(value.shape)
+    if upper is not None:
+        upper.send(below+value)
+    above = 0.0
+    if upper is not None:
+        above = frombuffer(upper.recv(), dtype=float).reshape(value.shape)
+    if lower is not None:
+        lower.send(above+value)
+    return below+value+above
+
+class SharedMemoryRing(object):
+    """
+    A ring of message slots of a fixed shape in shared memory, for one
+    sender and one receiver process on the same host (multiprocessing.
+    shared_memory, Python >= 3.8).
+
+    The sender fills write_slot() and calls commit(), the receiver reads
+    read_slot() and calls release(). Two named pipes next to the segment
+    count the slots, like semaphores: commit writes a byte to the 'full'
+    pipe, which read_slot waits for, and release writes one to the 'free'
+    pipe, which starts with a byte per slot and which write_slot waits
+    for. So a side that has to wait blocks in the kernel, as on a socket,
+    instead of spinning.
+
+    The sender creates the ring (name=None) and passes ring.name to the
+    receiver, which attaches to it with the same shape.
+    """
+
+    def __init__(self, shape, dtype=float, slots=2, name=None):
+        if shared_memory is None:
+            raise ImportError("shared memory halos need multiprocessing.shared_memory (Python >= 3.8)")
+        self.num_slots = slots
+        slot = zeros(shape, dtype)
+        self.creator = name is None
+        size = slots*slot.nbytes
+        if self.creator:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            # the creator unlinks the segment, not the resource tracker of this process
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, size=size, track=False)
+            except TypeError:
+                # Python < 3.13
+                self.shm = shared_memory.SharedMemory(name=name, size=size)
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.name = self.shm.name
+        self.slots = ndarray((slots,)+tuple(shape), dtype, buffer=self.shm.buf)
+        base = os.path.join(tempfile.gettempdir(), self.name.lstrip('/'))
+        self.paths = [base+'-full', base+'-free']
+        if self.creator:
+            for path in self.paths:
+                os.mkfifo(path)
+        # read-write, so that opening doesn't wait for the other side
+        self.full, self.free = [os.open(path, os.O_RDWR) for path in self.paths]
+        if self.creator:
+            os.write(self.free, b'x'*slots)
+        self.written = 0
+        self.read = 0
+
+    def write_slot(self):
+        """the next slot to write, once the receiver has made room"""
+        os.read(self.free, 1)
+        return self.slots[self.written%self.num_slots]
+
+    def commit(self):
+        """hand the slot from write_slot to the receiver"""
+        self.written += 1
+        os.write(self.full, b'x')
+
+    def read_slot(self):
+        """the next slot to read, once the sender has committed it"""
+        os.read(self.full, 1)
+        return self.slots[self.read%self.num_slots]
+
+    def release(self):
+        """give the slot from read_slot back to the sender"""
+        self.read += 1
+        os.write(self.free, b'x')
+
+    def fileno(self):
+        """readable when a slot is committed, for select and zmq.Poller"""
+        return self.full
+
+    def close(self):
+        os.close(self.full)
+        os.close(self.free)
+        del self.slots
+        self.shm.close()
+        if self.creator:
+            self.shm.unlink()
+            for path in self.paths:
+                os.unlink(path)
+
+class ExchangeTimeout(RuntimeError):
+    """a neighbor did not send or receive its halo within the timeout"""
+    pass
 
 class RectPartitioner:
     """
@@ -33,31 +301,101 @@ class RectPartitioner:
     spatial directions. The partitioning info is expressed as an
     array of integers, each indicating the number of subdomains in
     one spatial direction.
+
+    Set count_allocs to record in alloc_bytes the peak memory allocated
+    by each exchange (requires the tracemalloc module, Python >= 3.4).
+    Allocations are only traced during the exchanges, so the rest of a
+    step runs at full speed.
+
+    halo is the number of cells each subdomain overlaps with a neighbor
+    (the width of the ghost layer), 1 for the usual one-cell overlap.
+
+    dtype is the type of the halo buffers, which should be that of the
+    solution arrays: numpy.float32 halves the messages of the default
+    float (float64).
+
+    The cells are split evenly between the subdomains, unless redim is
+    given weights, one for each engine (e.g. its relative speed). Then
+    every slab of subdomains in a direction gets a share of the cells
+    in proportion to the total weight of its engines.
     """
+    slice_copy = True
+    count_allocs = False
+    halo = 1
+    weights = None
+    dtype = float
 
     def __init__(self, my_id=-1, num_procs=-1, \
-                 global_num_cells=[], num_parts=[]):
+                 global_num_cells=[], num_parts=[], halo=1, dtype=float):
         self.nsd = 0
         self.my_id = my_id
         self.num_procs = num_procs
+        self.halo = halo
+        self.dtype = dtype
         self.redim (global_num_cells, num_parts)
 
-    def redim (self, global_num_cells, num_parts):
+    def redim (self, global_num_cells, num_parts, weights=None):
         nsd_ = len(global_num_cells)
 #        print("Inside the redim function, nsd=%d" %nsd_)
 
-        if nsd_<1 | nsd_>3 | nsd_!=len(num_parts):
+        if nsd_!=len(num_parts):
             print('The input global_num_cells is not ok!')
             return
 
         self.nsd = nsd_
         self.global_num_cells = global_num_cells
         self.num_parts = num_parts
+        self.weights = weights
 
-    def prepare_communication (self):
+    def partition_cuts (self):
+        """
+        The first global cell of each subdomain in every direction, with
+        the total number of cells at the end.
+        """
+        cuts = []
+        offset = 1
+        for i in range(self.nsd):
+            n = self.global_num_cells[i]
+            p = self.num_parts[i]
+            if self.weights is None:
+                k = n//p
+                m = n%p
+                if p>1 and k<self.halo:
+                    raise ValueError("a halo of %i cells is wider than the subdomains "
+                                     "(%i cells) in direction %i"%(self.halo, k, i))
+                # the last m subdomains get one more cell
+                cuts.append([rank*k+max(0,rank+m-p) for rank in range(p)]+[n])
+            else:
+                # the total weight of each slab of subdomains
+                slabs = [0.0]*p
+                for id, w in enumerate(self.weights):
+                    slabs[(id//offset)%p] += w
+                cuts.append(split_cells(n, slabs, self.halo))
+            offset *= p
+        return cuts
+
+    def check_cuts (self, cuts, halo=None):
+        """
+        Raise a ValueError if a subdomain of cuts (as returned by
+        partition_cuts) is narrower than a halo of halo cells, by default
+        self.halo, in a direction with more than one subdomain.
+        """
+        if halo is None:
+            halo = self.halo
+        for i, c in enumerate(cuts):
+            if len(c)>2:
+                k = min(c[rank+1]-c[rank] for rank in range(len(c)-1))
+                if k<halo:
+                    raise ValueError("a halo of %i cells is wider than the subdomains "
+                                     "(%i cells) in direction %i"%(halo, k, i))
+
+    def prepare_communication (self, cuts=None):
         """
         Find the subdomain rank (tuple) for each processor and
         determine the neighbor info.
+
+        cuts are the first global cells of the subdomains, as returned by
+        partition_cuts, which computes them by default.
         """
         
         nsd_ = self.nsd
@@ -65,11 +403,11 @@ class RectPartitioner:
             print('Number of space dimensions is %d, nothing to do' %nsd_)
             return
         
-        self.subd_rank = [-1,-1,-1]
-        self.subd_lo_ix = [-1,-1,-1]
-        self.subd_hi_ix = [-1,-1,-1]
-        self.lower_neighbors = [-1,-1,-1]
-        self.upper_neighbors = [-1,-1,-1]
+        self.subd_rank = [-1]*nsd_
+        self.subd_lo_ix = [-1]*nsd_
+        self.subd_hi_ix = [-1]*nsd_
+        self.lower_neighbors = [-1]*nsd_
+        self.upper_neighbors = [-1]*nsd_
 
         num_procs = self.num_procs
         my_id = self.my_id
@@ -81,42 +419,42 @@ class RectPartitioner:
             print("# subds=", num_subds)
             # should check num_subds againt num_procs
 
-        offsets = [1, 0, 0]
+        # the ids are numbered with the first direction running fastest
+        offsets = [1]*nsd_
+        for i in range(1, nsd_):
+            offsets[i] = offsets[i-1]*self.num_parts[i-1]
 
         # find the subdomain rank
-        self.subd_rank[0] = my_id%self.num_parts[0]
-        if nsd_>=2:
-            offsets[1] = self.num_parts[0]
-            self.subd_rank[1] = my_id/offsets[1]
-        if nsd_==3:
-            offsets[1] = self.num_parts[0]
-            offsets[2] = self.num_parts[0]*self.num_parts[1]
-            self.subd_rank[1] = (my_id%offsets[2])/self.num_parts[0]
-            self.subd_rank[2] = my_id/offsets[2]
+        for i in range(nsd_):
+            self.subd_rank[i] = (my_id//offsets[i])%self.num_parts[i]
                     
         print("my_id=%d, subd_rank: "%my_id, self.subd_rank)
         if my_id==0:
             print("offsets=", offsets)
 
         # find the neighbor ids
+        h = self.halo
+        if cuts is None:
+            cuts = self.partition_cuts()
+        else:
+            self.check_cuts(cuts)
+        self.cuts = cuts
         for i in range(nsd_):
             rank = self.subd_rank[i]
             if rank>0:
                 self.lower_neighbors[i] = my_id-offsets[i]
             if rank<self.num_parts[i]-1:
                 self.upper_neighbors[i] = my_id+offsets[i]
-                
-            k = self.global_num_cells[i]/self.num_parts[i]
-            m = self.global_num_cells[i]%self.num_parts[i]
-            
-            ix = rank*k+max(0,rank+m-self.num_parts[i])
-            self.subd_lo_ix[i] = ix
-            
-            ix = ix+k
-            if rank>=(self.num_parts[i]-m):
-                ix = ix+1  # load balancing
+
+            ix = cuts[i][rank]
+            if rank>0:
+                self.subd_lo_ix[i] = ix-(h-1)  # the rest of a wider halo
+            else:
+                self.subd_lo_ix[i] = ix
+
+            ix = cuts[i][rank+1]
             if rank<self.num_parts[i]-1:
-                ix = ix+1  # one cell of overlap
+                ix = ix+h  # halo cells of overlap
             self.subd_hi_ix[i] = ix
 
         print("subd_rank:",self.subd_rank,\
@@ -124,6 +462,102 @@ class RectPartitioner:
               "upper_neig:", self.upper_neighbors)
         print("subd_rank:",self.subd_rank,"subd_lo_ix:", self.subd_lo_ix, \
               "subd_hi_ix:", self.subd_hi_ix)
+        self.alloc_bytes = []
+
+    def get_owned_slices (self):
+        """
+        Slices of the points this subdomain computes itself, in the local
+        solution array and in the global one. Every global point is owned
+        by exactly one subdomain; the overlap with a neighbor belongs to
+        the neighbor that computes it.
+        """
+        h = self.halo
+        local = []
+        glob = []
+        for i in range(self.nsd):
+            n = self.subd_hi_ix[i]-self.subd_lo_ix[i]
+            start = h if self.lower_neighbors[i]>-1 else 0
+            stop = n-h+1 if self.upper_neighbors[i]>-1 else n+1
+            local.append(slice(start, stop))
+            glob.append(slice(self.subd_lo_ix[i]+start, self.subd_lo_ix[i]+stop))
+        return tuple(local), tuple(glob)
+
+    def update_internal_boundary (self, *solution_arrays):
+        """
+        A single subdomain has no inner boundary, so that a plain
+        partitioner with num_parts all 1 can be used for serial runs.
+        The subclasses communicate with the neighbors.
+        """
+        if max(self.lower_neighbors+self.upper_neighbors)>-1:
+            raise NotImplementedError("%s can't communicate with neighbors"%self.__class__.__name__)
+
+    begin_exchange = update_internal_boundary
+
+    def finish_exchange (self, *solution_arrays):
+        pass
+
+    def allreduce (self, value):
+        """the sum of value over all subdomains, on every engine"""
+        if max(self.lower_neighbors+self.upper_neighbors)>-1:
+            raise NotImplementedError("%s can't communicate with neighbors"%self.__class__.__name__)
+        return value
+
+    def close (self):
+        """release what the partitioner holds beyond its buffers, once the
+        run is done; nothing for a plain partitioner"""
+        pass
+
+    def exchange_blocks (self, i, to_lower, to_upper):
+        """send the arrays to_lower and to_upper to the neighbors in
+        direction i, and return the arrays received from them (None where
+        there is no neighbor). Used to move subdomain data, not the halo."""
+        if max(self.lower_neighbors+self.upper_neighbors)>-1:
+            raise NotImplementedError("%s can't communicate with neighbors"%self.__class__.__name__)
+        return None, None
+
+    def pack (self, buf, data):
+        """copy a row/column of the solution array into a send buffer"""
+        if self.slice_copy:
+            copyto(buf, data)
+        else:
+            for i in xrange(0,len(buf)):
+                buf[i] = data[i]
+
+    def unpack (self, data, buf):
+        """copy a receive buffer into a row/column of the solution array"""
+        if self.slice_copy:
+            data[...] = buf
+        else:
+            for i in xrange(0,len(buf)):
+                data[i] = buf[i]
+
+    def start_alloc_count (self):
+        if self.count_allocs:
+            if tracemalloc is None:
+                raise RuntimeError("count_allocs needs the tracemalloc module (Python >= 3.4)")
+            self._alloc_snapshot = None
+            self._started_tracing = not tracemalloc.is_tracing()
+            if self._started_tracing:
+                # start() resets the peak as well
+                tracemalloc.start()
+            elif hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                # someone else is tracing, and the peak can't be reset
+                # before Python 3.9: count what is left at the end instead
+                self._alloc_snapshot = tracemalloc.take_snapshot()
+            self._alloc_base = tracemalloc.get_traced_memory()[0]
+
+    def stop_alloc_count (self):
+        if self.count_allocs:
+            if self._alloc_snapshot is None:
+                allocated = tracemalloc.get_traced_memory()[1]-self._alloc_base
+            else:
+                diff = tracemalloc.take_snapshot().compare_to(self._alloc_snapshot, 'filename')
+                allocated = sum(stat.size_diff for stat in diff if stat.size_diff > 0)
+            if self._started_tracing:
+                tracemalloc.stop()
+            self.alloc_bytes.append(allocated)
 
         
 class RectPartitioner1D(RectPartitioner):
@@ -138,11 +572,11 @@ class RectPartitioner1D(RectPartitioner):
         RectPartitioner.prepare_communication (self)
         
         if self.lower_neighbors[0]>=0:
-            self.in_lower_buffers = [zeros(1, float)]
-            self.out_lower_buffers = [zeros(1, float)]
+            self.in_lower_buffers = [zeros(1, self.dtype)]
+            self.out_lower_buffers = [zeros(1, self.dtype)]
         if self.upper_neighbors[0]>=0:
-            self.in_upper_buffers = [zeros(1, float)]
-            self.out_upper_buffers = [zeros(1, float)]
+            self.in_upper_buffers = [zeros(1, self.dtype)]
+            self.out_upper_buffers = [zeros(1, self.dtype)]
 
     def get_num_loc_cells(self):
         return [self.subd_hi_ix[0]-self.subd_lo_ix[0]]
@@ -151,39 +585,161 @@ class RectPartitioner1D(RectPartitioner):
 class RectPartitioner2D(RectPartitioner):
     """
     Subclass of RectPartitioner, for 2D problems
+
+    The communication buffers are allocated once in prepare_communication.
+    The exchange methods of the subclasses pack into and receive into these
+    same buffers, so no arrays are allocated per time step.
+
+    With halo=h, the slabs of h rows/columns at local indices h..2h-1 and
+    loc_n-2h+1..loc_n-h are sent to the lower/upper neighbor, and received
+    into 0..h-1 and loc_n-h+1..loc_n. The points a subdomain computes for
+    itself are h..loc_n-h (1..loc_n-1 next to the physical boundary).
+    update_internal_boundary exchanges in x before y, so that the corners
+    of the halo are filled as well; begin_exchange/finish_exchange leave
+    them out, which is enough for a single step.
+
+    The exchange methods take one or more solution arrays (e.g. two time
+    levels), whose slabs travel in a single message per neighbor. The
+    buffers have room for 'levels' arrays: 1, or 2 with a wide halo, which
+    is there to take several steps between exchanges.
+
+    repartition moves the boundaries between the subdomains during a run,
+    to follow new weights.
     """
-    def prepare_communication (self):
+
+    def prepare_communication (self, cuts=None):
         """
         Prepare the buffers to be used for later communications
         """
         
-        RectPartitioner.prepare_communication (self)
+        RectPartitioner.prepare_communication (self, cuts)
         
         self.in_lower_buffers = [[], []]
         self.out_lower_buffers = [[], []]
         self.in_upper_buffers = [[], []]
         self.out_upper_buffers = [[], []]
 
+        h = self.halo
+        self.levels = levels = 2 if h>1 else 1
         size1 = self.subd_hi_ix[1]-self.subd_lo_ix[1]+1
         if self.lower_neighbors[0]>=0:
-            self.in_lower_buffers[0] = zeros(size1, float)
-            self.out_lower_buffers[0] = zeros(size1, float)
+            self.in_lower_buffers[0] = zeros((levels, h, size1), self.dtype)
+            self.out_lower_buffers[0] = zeros((levels, h, size1), self.dtype)
         if self.upper_neighbors[0]>=0:
-            self.in_upper_buffers[0] = zeros(size1, float)
-            self.out_upper_buffers[0] = zeros(size1, float)
+            self.in_upper_buffers[0] = zeros((levels, h, size1), self.dtype)
+            self.out_upper_buffers[0] = zeros((levels, h, size1), self.dtype)
 
         size0 = self.subd_hi_ix[0]-self.subd_lo_ix[0]+1
         if self.lower_neighbors[1]>=0:
-            self.in_lower_buffers[1] = zeros(size0, float)
-            self.out_lower_buffers[1] = zeros(size0, float)
+            self.in_lower_buffers[1] = zeros((levels, size0, h), self.dtype)
+            self.out_lower_buffers[1] = zeros((levels, size0, h), self.dtype)
         if self.upper_neighbors[1]>=0:
-            self.in_upper_buffers[1] = zeros(size0, float)
-            self.out_upper_buffers[1] = zeros(size0, float)
+            self.in_upper_buffers[1] = zeros((levels, size0, h), self.dtype)
+            self.out_upper_buffers[1] = zeros((levels, size0, h), self.dtype)
 
     def get_num_loc_cells(self):
         return [self.subd_hi_ix[0]-self.subd_lo_ix[0],\
                 self.subd_hi_ix[1]-self.subd_lo_ix[1]]
 
+    def repartition (self, weights, *solution_arrays):
+        """
+        Resize the subdomains in proportion to new weights (one per engine),
+        and move the solution arrays along. Must be called on all engines.
+
+        Every boundary between two subdomains moves at most to the next old
+        boundary, so the points a subdomain gains come from its neighbors
+        in that direction; a bigger change takes several calls. The owned
+        points are moved in x and then in y, and finally the halo is
+        exchanged. Returns the new solution arrays.
+        """
+        old = self.cuts
+        self.weights = weights
+        target = self.partition_cuts()
+        arrays = solution_arrays
+        for i in range(2):
+            cuts = limit_cuts(old[i], target[i], self.halo)
+            arrays = self.move_owned(i, cuts, arrays)
+        if len(arrays)<=self.levels:
+            self.update_internal_boundary(*arrays)
+        else:
+            for a in arrays:
+                self.update_internal_boundary(a)
+        return arrays
+
+    def move_owned (self, i, cuts, solution_arrays):
+        """switch to the subdomains of cuts, which differ from the current
+        ones only in direction i, and move the owned points of the solution
+        arrays there. Returns the new arrays, whose halo is not set yet."""
+        def owned(c, rank):
+            # the global points of a subdomain, without the halo
+            return (c[rank]+1 if rank>0 else 0, c[rank+1]+1)
+        def part(arrays, lo, start, stop):
+            # the points start<=ix<stop in direction i, for a local lo
+            index = [slice(None), slice(None)]
+            index[i] = slice(start-lo, max(start, stop)-lo)
+            return [a[tuple(index)] for a in arrays]
+
+        old = self.cuts[i]
+        old_lo = self.subd_lo_ix[i]
+        rank = self.subd_rank[i]
+        new_cuts = list(self.cuts)
+        new_cuts[i] = cuts
+        self.prepare_communication(new_cuts)
+        lo = self.subd_lo_ix[i]
+        shape = [n+1 for n in self.get_num_loc_cells()]
+        arrays = [zeros(shape, a.dtype) for a in solution_arrays]
+
+        mine = owned(old, rank)
+        wanted = owned(cuts, rank)
+        to_lower = to_upper = None
+        if self.lower_neighbors[i]>-1:
+            theirs = owned(cuts, rank-1)
+            to_lower = asarray(part(solution_arrays, old_lo, max(mine[0], theirs[0]), min(mine[1], theirs[1])))
+        if self.upper_neighbors[i]>-1:
+            theirs = owned(cuts, rank+1)
+            to_upper = asarray(part(solution_arrays, old_lo, max(mine[0], theirs[0]), min(mine[1], theirs[1])))
+        from_lower, from_upper = self.exchange_blocks(i, to_lower, to_upper)
+
+        # the points this subdomain keeps, and those from the neighbors
+        start, stop = max(mine[0], wanted[0]), min(mine[1], wanted[1])
+        for a, b in zip(part(arrays, lo, start, stop), part(solution_arrays, old_lo, start, stop)):
+            a[...] = b
+        if from_lower is not None:
+            theirs = owned(old, rank-1)
+            for a, b in zip(part(arrays, lo, max(theirs[0], wanted[0]), min(theirs[1], wanted[1])), from_lower):
+                a[...] = b
+        if from_upper is not None:
+            theirs = owned(old, rank+1)
+            for a, b in zip(part(arrays, lo, max(theirs[0], wanted[0]), min(theirs[1], wanted[1])), from_upper):
+                a[...] = b
+        return arrays
+
+    def slab (self, solution_array, i, start):
+        """the halo rows (i=0) or columns (i=1) of solution_array from start on"""
+        if i==0:
+            return solution_array[start:start+self.halo,:]
+        return solution_array[:,start:start+self.halo]
+
+    def pack_slabs (self, buf, solution_arrays, i, start):
+        """pack the slab of each solution array into buf, return the filled part of buf"""
+        for l in range(len(solution_arrays)):
+            self.pack(buf[l], self.slab(solution_arrays[l], i, start))
+        return buf[:len(solution_arrays)]
+
+    def unpack_slabs (self, solution_arrays, i, start, buf):
+        """unpack buf into the slab of each solution array"""
+        for l in range(len(solution_arrays)):
+            self.unpack(self.slab(solution_arrays[l], i, start), buf[l])
+
+    def buffers_ready (self):
+        nsd_ = self.nsd
+        if nsd_!=len(self.in_lower_buffers) or nsd_!=len(self.out_lower_buffers):
+            print("Buffers for communicating with lower neighbors not ready")
+            return False
+        if nsd_!=len(self.in_upper_buffers) or nsd_!=len(self.out_upper_buffers):
+            print("Buffers for communicating with upper neighbors not ready")
+            return False
+        return True
 
 class MPIRectPartitioner2D(RectPartitioner2D):
     """
@@ -192,83 +748,136 @@ class MPIRectPartitioner2D(RectPartitioner2D):
     
     def __init__(self, my_id=-1, num_procs=-1,
                  global_num_cells=[], num_parts=[],
-                 slice_copy=True):
+                 slice_copy=True, count_allocs=False, halo=1, dtype=float):
         RectPartitioner.__init__(self, my_id, num_procs,
-                                 global_num_cells, num_parts)
+                                 global_num_cells, num_parts, halo, dtype)
         self.slice_copy = slice_copy
+        self.count_allocs = count_allocs
+        self.requests = []
         
-    def update_internal_boundary (self, solution_array):
-        nsd_ = self.nsd
-        if nsd_!=len(self.in_lower_buffers) | nsd_!=len(self.out_lower_buffers):
-            print("Buffers for communicating with lower neighbors not ready")
-            return
-        if nsd_!=len(self.in_upper_buffers) | nsd_!=len(self.out_upper_buffers):
-            print("Buffers for communicating with upper neighbors not ready")
+    def update_internal_boundary (self, *solution_arrays):
+        if not self.buffers_ready():
             return
 
+        self.start_alloc_count()
         loc_nx = self.subd_hi_ix[0]-self.subd_lo_ix[0]
         loc_ny = self.subd_hi_ix[1]-self.subd_lo_ix[1]
+        h = self.halo
+        n = len(solution_arrays)
 
         lower_x_neigh = self.lower_neighbors[0]
         upper_x_neigh = self.upper_neighbors[0]
         lower_y_neigh = self.lower_neighbors[1]
         upper_y_neigh = self.upper_neighbors[1]
+        requests = []
 
         # communicate in the x-direction first
         if lower_x_neigh>-1:
-            if self.slice_copy:
-                self.out_lower_buffers[0] = ascontiguousarray(solution_array[1,:])
-            else:
-                for i in xrange(0,loc_ny+1):
-                    self.out_lower_buffers[0][i] = solution_array[1,i]
-            mpi.Isend(self.out_lower_buffers[0], lower_x_neigh)
+            buf = self.pack_slabs(self.out_lower_buffers[0], solution_arrays, 0, h)
+            requests.append(mpi.Isend(buf, lower_x_neigh))
             
         if upper_x_neigh>-1:
-            mpi.Recv(self.in_upper_buffers[0], upper_x_neigh)
-            if self.slice_copy:
-                solution_array[loc_nx,:] = self.in_upper_buffers[0]
-                self.out_upper_buffers[0] = ascontiguousarray(solution_array[loc_nx-1,:])
-            else:
-                for i in xrange(0,loc_ny+1):
-                    solution_array[loc_nx,i] = self.in_upper_buffers[0][i]
-                    self.out_upper_buffers[0][i] = solution_array[loc_nx-1,i]
-            mpi.Isend(self.out_upper_buffers[0], upper_x_neigh)
+            mpi.Recv(self.in_upper_buffers[0][:n], upper_x_neigh)
+            self.unpack_slabs(solution_arrays, 0, loc_nx-h+1, self.in_upper_buffers[0])
+            buf = self.pack_slabs(self.out_upper_buffers[0], solution_arrays, 0, loc_nx-2*h+1)
+            requests.append(mpi.Isend(buf, upper_x_neigh))
 
         if lower_x_neigh>-1:
-            mpi.Recv(self.in_lower_buffers[0], lower_x_neigh)
-            if self.slice_copy:
-                solution_array[0,:] = self.in_lower_buffers[0]
-            else:
-                for i in xrange(0,loc_ny+1):
-                    solution_array[0,i] = self.in_lower_buffers[0][i]
+            mpi.Recv(self.in_lower_buffers[0][:n], lower_x_neigh)
+            self.unpack_slabs(solution_arrays, 0, 0, self.in_lower_buffers[0])
 
         # communicate in the y-direction afterwards
         if lower_y_neigh>-1:
-            if self.slice_copy:
-                self.out_lower_buffers[1] = ascontiguousarray(solution_array[:,1])
-            else:
-                for i in xrange(0,loc_nx+1):
-                    self.out_lower_buffers[1][i] = solution_array[i,1]
-            mpi.Isend(self.out_lower_buffers[1], lower_y_neigh)
+            buf = self.pack_slabs(self.out_lower_buffers[1], solution_arrays, 1, h)
+            requests.append(mpi.Isend(buf, lower_y_neigh))
             
         if upper_y_neigh>-1:
-            mpi.Recv(self.in_upper_buffers[1], upper_y_neigh)
-            if self.slice_copy:
-                solution_array[:,loc_ny] = self.in_upper_buffers[1]
-                self.out_upper_buffers[1] = ascontiguousarray(solution_array[:,loc_ny-1])
-            else:
-                for i in xrange(0,loc_nx+1):
-                    solution_array[i,loc_ny] = self.in_upper_buffers[1][i]
-                    self.out_upper_buffers[1][i] = solution_array[i,loc_ny-1]
-            mpi.Isend(self.out_upper_buffers[1], upper_y_neigh)
+            mpi.Recv(self.in_upper_buffers[1][:n], upper_y_neigh)
+            self.unpack_slabs(solution_arrays, 1, loc_ny-h+1, self.in_upper_buffers[1])
+            buf = self.pack_slabs(self.out_upper_buffers[1], solution_arrays, 1, loc_ny-2*h+1)
+            requests.append(mpi.Isend(buf, upper_y_neigh))
             
         if lower_y_neigh>-1:
-            mpi.Recv(self.in_lower_buffers[1], lower_y_neigh)
-            if self.slice_copy:
-                solution_array[:,0] = self.in_lower_buffers[1]
-            else:
-                for i in xrange(0,loc_nx+1):
-                    solution_array[i,0] = self.in_lower_buffers[1][i]
+            mpi.Recv(self.in_lower_buffers[1][:n], lower_y_neigh)
+            self.unpack_slabs(solution_arrays, 1, 0, self.in_lower_buffers[1])
+
+        # the send buffers are reused in the next step
+        MPI.Request.Waitall(requests)
+        self.stop_alloc_count()
+
+    def begin_exchange (self, *solution_arrays):
+        """post non-blocking sends and receives of the inner boundary.
+
+        Only the rows/columns next to the inner boundary need to be up to date
+        when this is called, so the rest of the subdomain can be computed while
+        the messages are in flight. Must be followed by finish_exchange.
+        """
+        self.start_alloc_count()
+        loc_nx = self.subd_hi_ix[0]-self.subd_lo_ix[0]
+        loc_ny = self.subd_hi_ix[1]-self.subd_lo_ix[1]
+        h = self.halo
+        n = len(solution_arrays)
+
+        lower_x_neigh = self.lower_neighbors[0]
+        upper_x_neigh = self.upper_neighbors[0]
+        lower_y_neigh = self.lower_neighbors[1]
+        upper_y_neigh = self.upper_neighbors[1]
+        requests = []
+
+        if lower_x_neigh>-1:
+            buf = self.pack_slabs(self.out_lower_buffers[0], solution_arrays, 0, h)
+            requests.append(mpi.Irecv(self.in_lower_buffers[0][:n], lower_x_neigh))
+            requests.append(mpi.Isend(buf, lower_x_neigh))
+
+        if upper_x_neigh>-1:
+            buf = self.pack_slabs(self.out_upper_buffers[0], solution_arrays, 0, loc_nx-2*h+1)
+            requests.append(mpi.Irecv(self.in_upper_buffers[0][:n], upper_x_neigh))
+            requests.append(mpi.Isend(buf, upper_x_neigh))
+
+        if lower_y_neigh>-1:
+            buf = self.pack_slabs(self.out_lower_buffers[1], solution_arrays, 1, h)
+            requests.append(mpi.Irecv(self.in_lower_buffers[1][:n], lower_y_neigh))
+            requests.append(mpi.Isend(buf, lower_y_neigh))
+
+        if upper_y_neigh>-1:
+            buf = self.pack_slabs(self.out_upper_buffers[1], solution_arrays, 1, loc_ny-2*h+1)
+            requests.append(mpi.Irecv(self.in_upper_buffers[1][:n], upper_y_neigh))
+            requests.append(mpi.Isend(buf, upper_y_neigh))
+
+        self.requests = requests
+
+    def finish_exchange (self, *solution_arrays):
+        """wait for the requests posted by begin_exchange and unpack the inner boundary"""
+        loc_nx = self.subd_hi_ix[0]-self.subd_lo_ix[0]
+        loc_ny = self.subd_hi_ix[1]-self.subd_lo_ix[1]
+        h = self.halo
+
+        MPI.Request.Waitall(self.requests)
+        self.requests = []
+
+        if self.upper_neighbors[0]>-1:
+            self.unpack_slabs(solution_arrays, 0, loc_nx-h+1, self.in_upper_buffers[0])
+        if self.lower_neighbors[0]>-1:
+            self.unpack_slabs(solution_arrays, 0, 0, self.in_lower_buffers[0])
+        if self.upper_neighbors[1]>-1:
+            self.unpack_slabs(solution_arrays, 1, loc_ny-h+1, self.in_upper_buffers[1])
+        if self.lower_neighbors[1]>-1:
+            self.unpack_slabs(solution_arrays, 1, 0, self.in_lower_buffers[1])
+        self.stop_alloc_count()
+
+    def allreduce (self, value):
+        """the sum of value over all subdomains, on every engine"""
+        return mpi.allreduce(value)
+
+    def exchange_blocks (self, i, to_lower, to_upper):
+        lower = self.lower_neighbors[i]
+        upper = self.upper_neighbors[i]
+        lower = lower if lower>-1 else MPI.PROC_NULL
+        upper = upper if upper>-1 else MPI.PROC_NULL
+        # shift up the chain, then down
+        from_lower = mpi.sendrecv(to_upper, dest=upper, source=lower)
+        from_upper = mpi.sendrecv(to_lower, dest=lower, source=upper)
+        return from_lower, from_upper
 
 class ZMQRectPartitioner2D(RectPartitioner2D):
     """
@@ -276,217 +885,550 @@ class ZMQRectPartitioner2D(RectPartitioner2D):
     The first two arguments must be `comm`, an EngineCommunicator object,
     and `addrs`, a dict of connection information for other EngineCommunicator
     objects.
+
+    The send buffers are handed to 0MQ without copying, so each send is
+    tracked, and a buffer is only refilled once its previous send is done.
+
+    By default the halos are received in a fixed order (east, west, north,
+    south). With poll=True, finish_exchange (and so the send_recv pattern)
+    waits for all neighbors at once with a zmq.Poller, and unpacks each
+    halo as soon as it arrives, so a late neighbor doesn't hold up the
+    others. With a timeout (in seconds), every wait for a neighbor raises
+    ExchangeTimeout, naming the neighbor, if it takes longer than that,
+    instead of hanging forever on a dead engine.
+
+    With shared_memory=True, the halos of neighbors on the same host (the
+    same location in their connection info) go through a SharedMemoryRing
+    in each direction instead of a socket: the slabs are packed straight
+    into the ring and unpacked from it by the neighbor. The sockets are
+    still used to set the rings up, for allreduce and while repartition
+    moves the subdomains. Call close() after the run to unlink the rings.
     """
 
     def __init__(self, comm, addrs, my_id=-1, num_procs=-1,
                  global_num_cells=[], num_parts=[],
-                 slice_copy=True):
+                 slice_copy=True, count_allocs=False, halo=1,
+                 shared_memory=False, dtype=float, poll=False, timeout=None):
         RectPartitioner.__init__(self, my_id, num_procs,
-                                 global_num_cells, num_parts)
+                                 global_num_cells, num_parts, halo, dtype)
         self.slice_copy = slice_copy
+        self.count_allocs = count_allocs
         self.comm = comm # an Engine
         self.addrs = addrs
+        self.trackers = {}
+        self.connected = False
+        self.shared_memory = shared_memory
+        self.rings = {}
+        self.poll = poll
+        self.timeout = timeout
     
-    def prepare_communication(self):
-        RectPartitioner2D.prepare_communication(self)
-        # connect west/south to east/north
-        west_id,south_id = self.lower_neighbors[:2]
-        west = self.addrs.get(west_id, None)
-        south = self.addrs.get(south_id, None)
-        self.comm.connect(south, west)
+    def prepare_communication(self, cuts=None):
+        RectPartitioner2D.prepare_communication(self, cuts)
+        if not self.connected:
+            # connect west/south to east/north
+            # (repartitioning keeps the neighbors)
+            west_id,south_id = self.lower_neighbors[:2]
+            west = self.addrs.get(west_id, None)
+            south = self.addrs.get(south_id, None)
+            self.comm.connect(south, west)
+            self.connected = True
+        if self.shared_memory:
+            # the buffers may have changed shape
+            self.setup_rings()
+
+    def neighbor_buffers (self):
+        """(direction, neighbor id, out buffer, in buffer) for each neighbor"""
+        result = []
+        for i, (lower, upper) in enumerate((('west', 'east'), ('south', 'north'))):
+            if self.lower_neighbors[i]>-1:
+                result.append((lower, self.lower_neighbors[i],
+                               self.out_lower_buffers[i], self.in_lower_buffers[i]))
+            if self.upper_neighbors[i]>-1:
+                result.append((upper, self.upper_neighbors[i],
+                               self.out_upper_buffers[i], self.in_upper_buffers[i]))
+        return result
+
+    def neighbor_id (self, direction):
+        i, upper = dict(west=(0, False), east=(0, True),
+                        south=(1, False), north=(1, True))[direction]
+        return (self.upper_neighbors if upper else self.lower_neighbors)[i]
+
+    def wait (self, direction, source, what='halo', write=False):
+        """wait up to timeout for source (a socket or a file descriptor) to
+        become readable (or writable), raise ExchangeTimeout if it doesn't"""
+        if self.timeout is None:
+            return
+        if write:
+            ready = zmq.select([], [source], [], self.timeout)[1]
+        else:
+            ready = zmq.select([source], [], [], self.timeout)[0]
+        if not ready:
+            raise ExchangeTimeout("no %s from the %s neighbor (engine %i) within %g s"\
+                                  %(what, direction, self.neighbor_id(direction), self.timeout))
+
+    def setup_rings (self):
+        """create a SharedMemoryRing to each neighbor on this host, and
+        attach to the ones they create for us. Returns once the neighbors
+        have attached to ours, so that close_rings may unlink them."""
+        self.close_rings()
+        local = [(direction, out_buf, in_buf)
+                 for direction, id, out_buf, in_buf in self.neighbor_buffers()
+                 if id in self.addrs and self.addrs[id][0] == self.comm.location]
+        outgoing = {}
+        for direction, out_buf, in_buf in local:
+            ring = SharedMemoryRing(out_buf.shape, out_buf.dtype)
+            outgoing[direction] = ring
+            getattr(self.comm, direction).send(ring.name.encode('ascii'))
+        for direction, out_buf, in_buf in local:
+            name = getattr(self.comm, direction).recv().decode('ascii')
+            self.rings[direction] = (outgoing[direction],
+                                     SharedMemoryRing(in_buf.shape, in_buf.dtype, name=name))
+        # tell the neighbors that we're attached, and wait until they are
+        for direction, out_buf, in_buf in local:
+            getattr(self.comm, direction).send(b'attached')
+        for direction, out_buf, in_buf in local:
+            getattr(self.comm, direction).recv()
+
+    def close_rings (self):
+        for out_ring, in_ring in self.rings.values():
+            in_ring.close()
+            out_ring.close()
+        self.rings = {}
+
+    def repartition (self, weights, *solution_arrays):
+        """RectPartitioner2D.repartition, which exchanges through the sockets
+        while the subdomains move; the rings are set up again once, for the
+        buffers of the new subdomains"""
+        shared_memory = self.shared_memory
+        self.close_rings()
+        self.shared_memory = False
+        try:
+            arrays = RectPartitioner2D.repartition(self, weights, *solution_arrays)
+        finally:
+            self.shared_memory = shared_memory
+        if shared_memory:
+            self.setup_rings()
+        return arrays
+
+    def close (self):
+        """close the shared memory rings, which unlinks the segments and
+        pipes this engine created; call it on every engine after the run"""
+        self.close_rings()
+
+    def send (self, direction, buf, solution_arrays, i, start):
+        """pack the slabs of the solution arrays into the send buffer buf, and
+        send it to the neighbor in direction ('north', 'south', 'east' or 'west')"""
+        if direction in self.rings:
+            ring = self.rings[direction][0]
+            self.wait(direction, ring.free, 'free slot')
+            self.pack_slabs(ring.write_slot(), solution_arrays, i, start)
+            ring.commit()
+            return
+        tracker = self.trackers.pop(direction, None)
+        if tracker is not None:
+            try:
+                tracker.wait(-1 if self.timeout is None else self.timeout)
+            except zmq.NotDone:
+                raise ExchangeTimeout("the last halo for the %s neighbor (engine %i) was not sent within %g s"\
+                                      %(direction, self.neighbor_id(direction), self.timeout))
+        buf = self.pack_slabs(buf, solution_arrays, i, start)
+        sock = getattr(self.comm, direction)
+        self.trackers[direction] = sock.send(buf, copy=False, track=True)
+
+    def source (self, direction):
+        """the socket or SharedMemoryRing the halo from direction comes in on"""
+        if direction in self.rings:
+            return self.rings[direction][1]
+        return getattr(self.comm, direction)
+
+    def recv (self, direction, buf, solution_arrays, i, start, ready=False):
+        """receive from the neighbor in direction into buf, and unpack it
+        into the slabs of the solution arrays (ready: a message is there)"""
+        if not ready:
+            self.wait(direction, self.source(direction))
+        if direction in self.rings:
+            ring = self.rings[direction][1]
+            self.unpack_slabs(solution_arrays, i, start, ring.read_slot())
+            ring.release()
+            return
+        sock = getattr(self.comm, direction)
+        part = buf[:len(solution_arrays)]
+        if hasattr(sock, 'recv_into'):
+            sock.recv_into(part)
+        else:
+            msg = sock.recv(copy=False)
+            copyto(part, frombuffer(msg, dtype=buf.dtype).reshape(part.shape))
+        self.unpack_slabs(solution_arrays, i, start, buf)
     
-    def update_internal_boundary_x_y (self, solution_array):
+    def update_internal_boundary_x_y (self, *solution_arrays):
         """update the inner boundary with the same send/recv pattern as the MPIPartitioner"""
-        nsd_ = self.nsd
-        dtype = solution_array.dtype
-        if nsd_!=len(self.in_lower_buffers) | nsd_!=len(self.out_lower_buffers):
-            print("Buffers for communicating with lower neighbors not ready")
-            return
-        if nsd_!=len(self.in_upper_buffers) | nsd_!=len(self.out_upper_buffers):
-            print("Buffers for communicating with upper neighbors not ready")
+        if not self.buffers_ready():
             return
 
+        self.start_alloc_count()
         loc_nx = self.subd_hi_ix[0]-self.subd_lo_ix[0]
         loc_ny = self.subd_hi_ix[1]-self.subd_lo_ix[1]
+        h = self.halo
+        arrays = solution_arrays
 
         lower_x_neigh = self.lower_neighbors[0]
         upper_x_neigh = self.upper_neighbors[0]
         lower_y_neigh = self.lower_neighbors[1]
         upper_y_neigh = self.upper_neighbors[1]
-        trackers = []
-        flags = dict(copy=False, track=False)
         # communicate in the x-direction first
         if lower_x_neigh>-1:
-            if self.slice_copy:
-                self.out_lower_buffers[0] = ascontiguousarray(solution_array[1,:])
-            else:
-                for i in xrange(0,loc_ny+1):
-                    self.out_lower_buffers[0][i] = solution_array[1,i]
-            t = self.comm.west.send(self.out_lower_buffers[0], **flags)
-            trackers.append(t)
+            self.send('west', self.out_lower_buffers[0], arrays, 0, h)
             
         if upper_x_neigh>-1:
-            msg = self.comm.east.recv(copy=False)
-            self.in_upper_buffers[0] = frombuffer(msg, dtype=dtype)
-            if self.slice_copy:
-                solution_array[loc_nx,:] = self.in_upper_buffers[0]
-                self.out_upper_buffers[0] = ascontiguousarray(solution_array[loc_nx-1,:])
-            else:
-                for i in xrange(0,loc_ny+1):
-                    solution_array[loc_nx,i] = self.in_upper_buffers[0][i]
-                    self.out_upper_buffers[0][i] = solution_array[loc_nx-1,i]
-            t = self.comm.east.send(self.out_upper_buffers[0], **flags)
-            trackers.append(t)
-            
+            self.recv('east', self.in_upper_buffers[0], arrays, 0, loc_nx-h+1)
+            self.send('east', self.out_upper_buffers[0], arrays, 0, loc_nx-2*h+1)
 
         if lower_x_neigh>-1:
-            msg = self.comm.west.recv(copy=False)
-            self.in_lower_buffers[0] = frombuffer(msg, dtype=dtype)
-            if self.slice_copy:
-                solution_array[0,:] = self.in_lower_buffers[0]
-            else:
-                for i in xrange(0,loc_ny+1):
-                    solution_array[0,i] = self.in_lower_buffers[0][i]
+            self.recv('west', self.in_lower_buffers[0], arrays, 0, 0)
         
         # communicate in the y-direction afterwards
         if lower_y_neigh>-1:
-            if self.slice_copy:
-                self.out_lower_buffers[1] = ascontiguousarray(solution_array[:,1])
-            else:
-                for i in xrange(0,loc_nx+1):
-                    self.out_lower_buffers[1][i] = solution_array[i,1]
-            t = self.comm.south.send(self.out_lower_buffers[1], **flags)
-            trackers.append(t)
-            
+            self.send('south', self.out_lower_buffers[1], arrays, 1, h)
             
         if upper_y_neigh>-1:
-            msg = self.comm.north.recv(copy=False)
-            self.in_upper_buffers[1] = frombuffer(msg, dtype=dtype)
-            if self.slice_copy:
-                solution_array[:,loc_ny] = self.in_upper_buffers[1]
-                self.out_upper_buffers[1] = ascontiguousarray(solution_array[:,loc_ny-1])
-            else:
-                for i in xrange(0,loc_nx+1):
-                    solution_array[i,loc_ny] = self.in_upper_buffers[1][i]
-                    self.out_upper_buffers[1][i] = solution_array[i,loc_ny-1]
-            t = self.comm.north.send(self.out_upper_buffers[1], **flags)
-            trackers.append(t)
+            self.recv('north', self.in_upper_buffers[1], arrays, 1, loc_ny-h+1)
+            self.send('north', self.out_upper_buffers[1], arrays, 1, loc_ny-2*h+1)
             
         if lower_y_neigh>-1:
-            msg = self.comm.south.recv(copy=False)
-            self.in_lower_buffers[1] = frombuffer(msg, dtype=dtype)
-            if self.slice_copy:
-                solution_array[:,0] = self.in_lower_buffers[1]
-            else:
-                for i in xrange(0,loc_nx+1):
-                    solution_array[i,0] = self.in_lower_buffers[1][i]
-        
-        # wait for sends to complete:
-        if flags['track']:
-            for t in trackers:
-                t.wait()
+            self.recv('south', self.in_lower_buffers[1], arrays, 1, 0)
+        self.stop_alloc_count()
 
-    def update_internal_boundary_send_recv (self, solution_array):
-        """update the inner boundary, sending first, then recving"""
-        nsd_ = self.nsd
-        dtype = solution_array.dtype
-        if nsd_!=len(self.in_lower_buffers) | nsd_!=len(self.out_lower_buffers):
-            print("Buffers for communicating with lower neighbors not ready")
-            return
-        if nsd_!=len(self.in_upper_buffers) | nsd_!=len(self.out_upper_buffers):
-            print("Buffers for communicating with upper neighbors not ready")
+    def begin_exchange (self, *solution_arrays):
+        """post the sends of the inner boundary to all neighbors.
+
+        Only the rows/columns next to the inner boundary need to be up to date
+        when this is called, so the rest of the subdomain can be computed while
+        the messages are in flight. Must be followed by finish_exchange.
+        """
+        if not self.buffers_ready():
             return
 
+        self.start_alloc_count()
         loc_nx = self.subd_hi_ix[0]-self.subd_lo_ix[0]
         loc_ny = self.subd_hi_ix[1]-self.subd_lo_ix[1]
+        h = self.halo
+        arrays = solution_arrays
 
-        lower_x_neigh = self.lower_neighbors[0]
-        upper_x_neigh = self.upper_neighbors[0]
-        lower_y_neigh = self.lower_neighbors[1]
-        upper_y_neigh = self.upper_neighbors[1]
-        trackers = []
-        flags = dict(copy=False, track=False)
-        
-        # send in all directions first
-        if lower_x_neigh>-1:
-            if self.slice_copy:
-                self.out_lower_buffers[0] = ascontiguousarray(solution_array[1,:])
-            else:
-                for i in xrange(0,loc_ny+1):
-                    self.out_lower_buffers[0][i] = solution_array[1,i]
-            t = self.comm.west.send(self.out_lower_buffers[0], **flags)
-            trackers.append(t)
-        
-        if lower_y_neigh>-1:
-            if self.slice_copy:
-                self.out_lower_buffers[1] = ascontiguousarray(solution_array[:,1])
-            else:
-                for i in xrange(0,loc_nx+1):
-                    self.out_lower_buffers[1][i] = solution_array[i,1]
-            t = self.comm.south.send(self.out_lower_buffers[1], **flags)
-            trackers.append(t)
-            
-        if upper_x_neigh>-1:
-            if self.slice_copy:
-                self.out_upper_buffers[0] = ascontiguousarray(solution_array[loc_nx-1,:])
-            else:
-                for i in xrange(0,loc_ny+1):
-                    self.out_upper_buffers[0][i] = solution_array[loc_nx-1,i]
-            t = self.comm.east.send(self.out_upper_buffers[0], **flags)
-            trackers.append(t)
-        
-        if upper_y_neigh>-1:
-            if self.slice_copy:
-                self.out_upper_buffers[1] = ascontiguousarray(solution_array[:,loc_ny-1])
-            else:
-                for i in xrange(0,loc_nx+1):
-                    self.out_upper_buffers[1][i] = solution_array[i,loc_ny-1]
-            t = self.comm.north.send(self.out_upper_buffers[1], **flags)
-            trackers.append(t)
-        
-        
-        # now start receiving
-        if upper_x_neigh>-1:
-            msg = self.comm.east.recv(copy=False)
-            self.in_upper_buffers[0] = frombuffer(msg, dtype=dtype)
-            if self.slice_copy:
-                solution_array[loc_nx,:] = self.in_upper_buffers[0]
-            else:
-                for i in xrange(0,loc_ny+1):
-                    solution_array[loc_nx,i] = self.in_upper_buffers[0][i]
+        # send in all directions
+        if self.lower_neighbors[0]>-1:
+            self.send('west', self.out_lower_buffers[0], arrays, 0, h)
+        if self.lower_neighbors[1]>-1:
+            self.send('south', self.out_lower_buffers[1], arrays, 1, h)
+        if self.upper_neighbors[0]>-1:
+            self.send('east', self.out_upper_buffers[0], arrays, 0, loc_nx-2*h+1)
+        if self.upper_neighbors[1]>-1:
+            self.send('north', self.out_upper_buffers[1], arrays, 1, loc_ny-2*h+1)
 
-        if lower_x_neigh>-1:
-            msg = self.comm.west.recv(copy=False)
-            self.in_lower_buffers[0] = frombuffer(msg, dtype=dtype)
-            if self.slice_copy:
-                solution_array[0,:] = self.in_lower_buffers[0]
-            else:
-                for i in xrange(0,loc_ny+1):
-                    solution_array[0,i] = self.in_lower_buffers[0][i]
-        
-        if upper_y_neigh>-1:
-            msg = self.comm.north.recv(copy=False)
-            self.in_upper_buffers[1] = frombuffer(msg, dtype=dtype)
-            if self.slice_copy:
-                solution_array[:,loc_ny] = self.in_upper_buffers[1]
-            else:
-                for i in xrange(0,loc_nx+1):
-                    solution_array[i,loc_ny] = self.in_upper_buffers[1][i]
-            
-        if lower_y_neigh>-1:
-            msg = self.comm.south.recv(copy=False)
-            self.in_lower_buffers[1] = frombuffer(msg, dtype=dtype)
-            if self.slice_copy:
-                solution_array[:,0] = self.in_lower_buffers[1]
-            else:
-                for i in xrange(0,loc_nx+1):
-                    solution_array[i,0] = self.in_lower_buffers[1][i]
-        
-        # wait for sends to complete:
-        if flags['track']:
-            for t in trackers:
-                t.wait()
+    def finish_exchange (self, *solution_arrays):
+        """receive the inner boundary from all neighbors, after begin_exchange"""
+        loc_nx = self.subd_hi_ix[0]-self.subd_lo_ix[0]
+        loc_ny = self.subd_hi_ix[1]-self.subd_lo_ix[1]
+        h = self.halo
+        arrays = solution_arrays
+
+        pending = []
+        if self.upper_neighbors[0]>-1:
+            pending.append(('east', self.in_upper_buffers[0], 0, loc_nx-h+1))
+        if self.lower_neighbors[0]>-1:
+            pending.append(('west', self.in_lower_buffers[0], 0, 0))
+        if self.upper_neighbors[1]>-1:
+            pending.append(('north', self.in_upper_buffers[1], 1, loc_ny-h+1))
+        if self.lower_neighbors[1]>-1:
+            pending.append(('south', self.in_lower_buffers[1], 1, 0))
+        self.recv_all(pending, arrays)
+        self.stop_alloc_count()
+
+    def recv_all (self, pending, solution_arrays):
+        """receive the halos of pending, a list of (direction, buf, i, start),
+        in that order, or with poll=True in the order they arrive"""
+        if not self.poll or len(pending) < 2:
+            for direction, buf, i, start in pending:
+                self.recv(direction, buf, solution_arrays, i, start)
+            return
+        poller = zmq.Poller()
+        waiting = {}
+        for direction, buf, i, start in pending:
+            source = self.source(direction)
+            if not isinstance(source, zmq.Socket):
+                # the poller reports rings by their file descriptor
+                source = source.fileno()
+            poller.register(source, zmq.POLLIN)
+            waiting[source] = (direction, buf, i, start)
+        timeout = None if self.timeout is None else 1000*self.timeout
+        while waiting:
+            events = poller.poll(timeout)
+            if not events:
+                late = sorted(direction for direction, buf, i, start in waiting.values())
+                raise ExchangeTimeout("no halo from the %s within %g s"%(", ".join(
+                    "%s neighbor (engine %i)"%(d, self.neighbor_id(d)) for d in late), self.timeout))
+            for source, event in events:
+                direction, buf, i, start = waiting.pop(source)
+                poller.unregister(source)
+                self.recv(direction, buf, solution_arrays, i, start, ready=True)
+
+    def update_internal_boundary_send_recv (self, *solution_arrays):
+        """update the inner boundary, sending first, then recving"""
+        if self.halo>1 and self.poll:
+            self.update_internal_boundary_polled_x_y(*solution_arrays)
+            return
+        if self.halo>1:
+            # the corners of a wide halo are needed too, which the y sweep
+            # only gets right after the x sweep
+            self.update_internal_boundary_x_y(*solution_arrays)
+            return
+        self.begin_exchange(*solution_arrays)
+        self.finish_exchange(*solution_arrays)
     
+    def update_internal_boundary_polled_x_y (self, *solution_arrays):
+        """update the inner boundary in x and then in y, receiving the two
+        halos of each direction in the order they arrive"""
+        if not self.buffers_ready():
+            return
+
+        self.start_alloc_count()
+        loc_n = self.get_num_loc_cells()
+        h = self.halo
+        arrays = solution_arrays
+        for i, (lower, upper) in enumerate((('west', 'east'), ('south', 'north'))):
+            pending = []
+            if self.lower_neighbors[i]>-1:
+                self.send(lower, self.out_lower_buffers[i], arrays, i, h)
+                pending.append((lower, self.in_lower_buffers[i], i, 0))
+            if self.upper_neighbors[i]>-1:
+                self.send(upper, self.out_upper_buffers[i], arrays, i, loc_n[i]-2*h+1)
+                pending.append((upper, self.in_upper_buffers[i], i, loc_n[i]-h+1))
+            self.recv_all(pending, arrays)
+        self.stop_alloc_count()
+
     # use send/recv pattern instead of x/y sweeps
     update_internal_boundary = update_internal_boundary_send_recv
 
+    def exchange_blocks (self, i, to_lower, to_upper):
+        lower, upper = (('west', 'east'), ('south', 'north'))[i]
+        if to_lower is not None:
+            getattr(self.comm, lower).send_pyobj(to_lower)
+        if to_upper is not None:
+            getattr(self.comm, upper).send_pyobj(to_upper)
+        from_lower = from_upper = None
+        if to_lower is not None:
+            from_lower = getattr(self.comm, lower).recv_pyobj()
+        if to_upper is not None:
+            from_upper = getattr(self.comm, upper).recv_pyobj()
+        return from_lower, from_upper
+
+    def allreduce (self, value):
+        """the sum of value over all subdomains, on every engine.
+
+        Sums along x over the west/east sockets first, and then the row
+        sums along y over the south/north sockets.
+        """
+        comm = self.comm
+        total = chain_allreduce(value,
+                                comm.west if self.lower_neighbors[0]>-1 else None,
+                                comm.east if self.upper_neighbors[0]>-1 else None)
+        total = chain_allreduce(total,
+                                comm.south if self.lower_neighbors[1]>-1 else None,
+                                comm.north if self.upper_neighbors[1]>-1 else None)
+        return float(total) if total.ndim==0 else total
+
+
+class RectPartitionerND(RectPartitioner):
+    """
+    Subclass of RectPartitioner, for problems in any number of space
+    dimensions (e.g. 3D), see heat3d.py.
+
+    With halo=h, the slab of h layers at local indices h..2h-1 in
+    direction i is sent to the lower neighbor in that direction, and
+    loc_n-2h+1..loc_n-h to the upper one, into 0..h-1 and
+    loc_n-h+1..loc_n, as in RectPartitioner2D. The buffers have the shape
+    of the local solution array with direction i cut down to h, and the
+    dtype of the partitioner. The exchange methods take one solution
+    array.
+
+    begin_exchange/finish_exchange exchange all faces at once, which is
+    enough for a single step of a stencil without diagonal neighbors (such
+    as the 7-point Laplacian in 3D). update_internal_boundary exchanges one
+    direction after the other, so that the edges and corners of the halo
+    are filled as well, as needed to take h steps between exchanges.
+    """
+    def prepare_communication (self, cuts=None):
+        """
+        Prepare the buffers to be used for later communications
+        """
+        
+        RectPartitioner.prepare_communication (self, cuts)
+
+        nsd_ = self.nsd
+        self.in_lower_buffers = [[] for i in range(nsd_)]
+        self.out_lower_buffers = [[] for i in range(nsd_)]
+        self.in_upper_buffers = [[] for i in range(nsd_)]
+        self.out_upper_buffers = [[] for i in range(nsd_)]
+
+        h = self.halo
+        shape = [n+1 for n in self.get_num_loc_cells()]
+        for i in range(nsd_):
+            face_shape = shape[:i]+[h]+shape[i+1:]
+            if self.lower_neighbors[i]>=0:
+                self.in_lower_buffers[i] = zeros(face_shape, self.dtype)
+                self.out_lower_buffers[i] = zeros(face_shape, self.dtype)
+            if self.upper_neighbors[i]>=0:
+                self.in_upper_buffers[i] = zeros(face_shape, self.dtype)
+                self.out_upper_buffers[i] = zeros(face_shape, self.dtype)
+
+    def get_num_loc_cells(self):
+        return [self.subd_hi_ix[i]-self.subd_lo_ix[i] for i in range(self.nsd)]
+
+    def face (self, solution_array, i, start):
+        """the slab of halo layers of solution_array from start on in direction i"""
+        return solution_array[(slice(None),)*i + (slice(start, start+self.halo), Ellipsis)]
+
+    def face_starts (self, i):
+        """the first layers in direction i of the slabs (to lower, to upper,
+        from lower, from upper)"""
+        h = self.halo
+        loc_n = self.get_num_loc_cells()[i]
+        return h, loc_n-2*h+1, 0, loc_n-h+1
+
+    def directions (self, directions):
+        """the directions to exchange, all by default"""
+        return range(self.nsd) if directions is None else directions
+
+    def update_internal_boundary (self, solution_array):
+        """update the inner boundary, including its edges and corners, one
+        direction after the other"""
+        for i in range(self.nsd):
+            self.begin_exchange(solution_array, [i])
+            self.finish_exchange(solution_array, [i])
+
+
+class MPIRectPartitionerND(RectPartitionerND):
+    """
+    Subclass of RectPartitionerND, which uses MPI via mpi4py for communication
+    """
+
+    def __init__(self, my_id=-1, num_procs=-1,
+                 global_num_cells=[], num_parts=[],
+                 count_allocs=False, halo=1, dtype=float):
+        RectPartitioner.__init__(self, my_id, num_procs,
+                                 global_num_cells, num_parts, halo, dtype)
+        self.count_allocs = count_allocs
+        self.requests = []
+
+    def begin_exchange (self, solution_array, directions=None):
+        """post non-blocking sends and receives of the faces in the given
+        directions (default: all). Must be followed by finish_exchange.
+        """
+        self.start_alloc_count()
+        requests = []
+        for i in self.directions(directions):
+            to_lower, to_upper, from_lower, from_upper = self.face_starts(i)
+            lower = self.lower_neighbors[i]
+            upper = self.upper_neighbors[i]
+            if lower>-1:
+                self.pack(self.out_lower_buffers[i], self.face(solution_array, i, to_lower))
+                requests.append(mpi.Irecv(self.in_lower_buffers[i], lower, tag=i))
+                requests.append(mpi.Isend(self.out_lower_buffers[i], lower, tag=i))
+            if upper>-1:
+                self.pack(self.out_upper_buffers[i], self.face(solution_array, i, to_upper))
+                requests.append(mpi.Irecv(self.in_upper_buffers[i], upper, tag=i))
+                requests.append(mpi.Isend(self.out_upper_buffers[i], upper, tag=i))
+        self.requests = requests
+
+    def finish_exchange (self, solution_array, directions=None):
+        """wait for the requests posted by begin_exchange and unpack the faces"""
+        MPI.Request.Waitall(self.requests)
+        self.requests = []
+        for i in self.directions(directions):
+            to_lower, to_upper, from_lower, from_upper = self.face_starts(i)
+            if self.lower_neighbors[i]>-1:
+                self.unpack(self.face(solution_array, i, from_lower), self.in_lower_buffers[i])
+            if self.upper_neighbors[i]>-1:
+                self.unpack(self.face(solution_array, i, from_upper), self.in_upper_buffers[i])
+        self.stop_alloc_count()
+
+    def allreduce (self, value):
+        """the sum of value over all subdomains, on every engine"""
+        return mpi.allreduce(value)
+
+
+class ZMQRectPartitionerND(RectPartitionerND):
+    """
+    Subclass of RectPartitionerND, which uses 0MQ via pyzmq for communication
+    The first two arguments must be `comm`, a CartesianCommunicator object
+    with the same number of dimensions, and `addrs`, a dict of connection
+    information for other CartesianCommunicator objects.
+    """
+
+    def __init__(self, comm, addrs, my_id=-1, num_procs=-1,
+                 global_num_cells=[], num_parts=[],
+                 count_allocs=False, halo=1, dtype=float):
+        RectPartitioner.__init__(self, my_id, num_procs,
+                                 global_num_cells, num_parts, halo, dtype)
+        self.count_allocs = count_allocs
+        self.comm = comm
+        self.addrs = addrs
+        self.trackers = {}
+
+    def prepare_communication(self, cuts=None):
+        RectPartitionerND.prepare_communication(self, cuts)
+        # connect lower sockets to the upper sockets of the lower neighbors
+        peers = [self.addrs.get(i, None) for i in self.lower_neighbors]
+        self.comm.connect(peers)
+
+    def send (self, sock, buf, data):
+        """pack data into the send buffer buf, and send it on sock"""
+        tracker = self.trackers.pop(sock, None)
+        if tracker is not None:
+            tracker.wait()
+        self.pack(buf, data)
+        self.trackers[sock] = sock.send(buf, copy=False, track=True)
+
+    def recv (self, sock, buf, data):
+        """receive from sock into buf, and unpack it into data"""
+        if hasattr(sock, 'recv_into'):
+            sock.recv_into(buf)
+        else:
+            msg = sock.recv(copy=False)
+            copyto(buf, frombuffer(msg, dtype=buf.dtype).reshape(buf.shape))
+        self.unpack(data, buf)
+
+    def begin_exchange (self, solution_array, directions=None):
+        """send the faces in the given directions (default: all).
+        Must be followed by finish_exchange."""
+        self.start_alloc_count()
+        for i in self.directions(directions):
+            to_lower, to_upper, from_lower, from_upper = self.face_starts(i)
+            if self.lower_neighbors[i]>-1:
+                self.send(self.comm.lower[i], self.out_lower_buffers[i],
+                          self.face(solution_array, i, to_lower))
+            if self.upper_neighbors[i]>-1:
+                self.send(self.comm.upper[i], self.out_upper_buffers[i],
+                          self.face(solution_array, i, to_upper))
+
+    def finish_exchange (self, solution_array, directions=None):
+        """receive the faces from the neighbors, after begin_exchange"""
+        for i in self.directions(directions):
+            to_lower, to_upper, from_lower, from_upper = self.face_starts(i)
+            if self.upper_neighbors[i]>-1:
+                self.recv(self.comm.upper[i], self.in_upper_buffers[i],
+                          self.face(solution_array, i, from_upper))
+            if self.lower_neighbors[i]>-1:
+                self.recv(self.comm.lower[i], self.in_lower_buffers[i],
+                          self.face(solution_array, i, from_lower))
+        self.stop_alloc_count()
+
+    def allreduce (self, value):
+        """the sum of value over all subdomains, on every engine, summing
+        along one direction after the other"""
+        total = value
+        for i in range(self.nsd):
+            total = chain_allreduce(total,
+                                    self.comm.lower[i] if self.lower_neighbors[i]>-1 else None,
+                                    self.comm.upper[i] if self.upper_neighbors[i]>-1 else None)
+        total = asarray(total)
+        return float(total) if total.ndim==0 else total
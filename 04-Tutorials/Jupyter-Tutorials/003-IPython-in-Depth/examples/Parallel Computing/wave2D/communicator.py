@@ -57,3 +57,44 @@ class EngineCommunicator(object):
             self.west.connect(disambiguate_url(url, location))
     
 
+
+class CartesianCommunicator(object):
+    """An object that connects Engines to their neighbors on a Cartesian
+    grid with any number of dimensions.
+
+    For each direction i, upper[i] listens while lower[i] connects,
+    like north/east and south/west of EngineCommunicator.
+    """
+    
+    def __init__(self, ndim, interface='tcp://*'):
+        self._ctx = zmq.Context()
+        self.lower = [self._ctx.socket(zmq.PAIR) for i in range(ndim)]
+        self.upper = [self._ctx.socket(zmq.PAIR) for i in range(ndim)]
+        
+        # bind to ports
+        ports = [s.bind_to_random_port(interface) for s in self.upper]
+        self.upper_urls = [interface+":%i"%port for port in ports]
+        
+        # guess first public IP from socket
+        self.location = socket.gethostbyname_ex(socket.gethostname())[-1][0]
+    
+    def __del__(self):
+        for s in self.lower + self.upper:
+            s.close()
+        self._ctx.term()
+    
+    @property
+    def info(self):
+        """return the connection info for this object's sockets."""
+        return (self.location, self.upper_urls)
+    
+    def connect(self, lower_peers):
+        """connect to peers. `lower_peers` is a list with, for each direction,
+        the info of the lower neighbor, of the form:
+        (location, upper_urls)
+        or None if there is no lower neighbor in that direction.
+        """
+        for i, peer in enumerate(lower_peers):
+            if peer is not None:
+                location, urls = peer
+                self.lower[i].connect(disambiguate_url(urls[i], location))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+An ensemble of independent 2D wave simulations on one engine.
+
+EnsembleWaveSolver stacks B realisations of the problem of WaveSolver,
+each with its own initial condition, wave speed, source term and boundary
+value, on the same grid, into arrays of shape (B, nx+1, ny+1), and steps
+all of them with one vectorized update per time step. For the small grids
+of an uncertainty quantification study this replaces B solvers, and B
+times as many numpy calls per step, with one. There is no partitioner:
+every ensemble runs on a single engine, and many ensembles are spread over
+the engines with a load-balanced view (see parallelensemble.py).
+"""
+from __future__ import print_function
+import time
+
+from numpy import zeros, newaxis, sqrt, arange, asarray, add, multiply, subtract, einsum
+
+class EnsembleWaveSolver(object):
+    """
+    Solve the B wave equations u_tt = c[b]**2*(u_xx + u_yy) + f[b](x,y,t),
+    b = 0..B-1, on [0,Lx]x[0,Ly] with nx x ny cells, initial conditions
+    u = I[b](x,y) and du/dt = 0, and u = bc[b] on the boundary.
+
+    I: a list of B functions I(x,y), which must work on arrays.
+
+    f: a list of B source terms, each a function f(x,y,t) (on arrays) or
+    a number. Constant source terms are added for the whole ensemble at
+    once; a function costs a call per member and step.
+
+    c: the B wave speeds, or one for all members.
+
+    bc: the B (constant) boundary values, or one for all members.
+
+    dt is the time step, shared by all members. If dt<=0, the largest
+    step that is stable for the fastest member is used.
+
+    The update is the 'fused' one of WaveSolver, with the coefficients of
+    each member broadcast along the first axis, so every member gets the
+    same numbers as a WaveSolver of its own would.
+    """
+
+    def __init__(self, I, f, c, bc, Lx, Ly, nx, ny, dt=-1, user_action=None):
+        B = len(I)
+        self.size = B
+        self.nx = nx
+        self.ny = ny
+        dx = Lx/float(nx)
+        dy = Ly/float(ny)
+        x = dx*arange(nx+1)
+        y = dy*arange(ny+1)
+        self.x = x
+        self.y = y
+        xv = x[:,newaxis]
+        yv = y[newaxis,:]
+        # per-member coefficients, shaped to broadcast over (B, nx+1, ny+1)
+        c = zeros(B)+asarray(c, dtype=float)
+        if dt <= 0:
+            dt = (1/float(c.max()))*(1/sqrt(1/dx**2 + 1/dy**2))  # max time step
+        self.dt = dt
+        self.Cx2 = ((c*dt/dx)**2)[:,newaxis,newaxis]
+        self.Cy2 = ((c*dt/dy)**2)[:,newaxis,newaxis]
+        self.center = 2-2*self.Cx2-2*self.Cy2
+        self.bc = (zeros(B)+asarray(bc, dtype=float))[:,newaxis]
+        # constant source terms as one array, functions one by one
+        self.f_const = zeros((B, 1, 1))
+        self.f_funcs = []
+        for b, fb in enumerate(f):
+            if callable(fb):
+                self.f_funcs.append((b, fb))
+            else:
+                self.f_const[b] = fb
+        self.user_action = user_action
+
+        u = zeros((B, nx+1, ny+1))   # solution array
+        u_1 = u.copy()               # solution at t-dt
+        u_2 = u.copy()               # solution at t-2*dt
+        dt2 = dt**2
+        for b in range(B):
+            u_1[b] = I[b](xv, yv)
+        Cx2 = self.Cx2; Cy2 = self.Cy2
+        u_2[:,1:nx,1:ny] = u_1[:,1:nx,1:ny] + \
+        0.5*Cx2*(u_1[:,0:nx-1,1:ny] - 2*u_1[:,1:nx,1:ny] + u_1[:,2:nx+1,1:ny]) + \
+        0.5*Cy2*(u_1[:,1:nx,0:ny-1] - 2*u_1[:,1:nx,1:ny] + u_1[:,1:nx,2:ny+1]) + \
+        dt2*self.f_const
+        for b, fb in self.f_funcs:
+            u_2[b,1:nx,1:ny] += dt2*fb(xv[1:nx], yv[:,1:ny], 0.0)
+        self.set_bc(u_2)
+        if user_action is not None:
+            user_action(u_1, x, y, 0.0)
+        self.us = (u, u_1, u_2)
+        self.scratch = zeros((B, max(nx-1, 0), max(ny-1, 0)))
+        self.t = 0.0
+
+    def set_bc(self, u):
+        """set the boundary values of all members in u"""
+        bc = self.bc
+        u[:,0,:] = bc
+        u[:,self.nx,:] = bc
+        u[:,:,0] = bc
+        u[:,:,self.ny] = bc
+
+    def update_inner(self, u, u_1, u_2, t_old):
+        """update the inner points of all members in place"""
+        nx = self.nx; ny = self.ny
+        Cx2 = self.Cx2; Cy2 = self.Cy2; dt2 = self.dt**2
+        ur = u[:,1:nx,1:ny]
+        tmp = self.scratch
+        multiply(u_1[:,1:nx,1:ny], self.center, out=ur)
+        subtract(ur, u_2[:,1:nx,1:ny], out=ur)
+        add(u_1[:,0:nx-1,1:ny], u_1[:,2:nx+1,1:ny], out=tmp)
+        multiply(tmp, Cx2, out=tmp)
+        add(ur, tmp, out=ur)
+        add(u_1[:,1:nx,0:ny-1], u_1[:,1:nx,2:ny+1], out=tmp)
+        multiply(tmp, Cy2, out=tmp)
+        add(ur, tmp, out=ur)
+        if self.f_const.any():
+            add(ur, dt2*self.f_const, out=ur)
+        xv = self.x[1:nx,newaxis]
+        yv = self.y[newaxis,1:ny]
+        for b, fb in self.f_funcs:
+            multiply(fb(xv, yv, t_old), dt2, out=tmp[b])
+            add(ur[b], tmp[b], out=ur[b])
+
+    def solve(self, tstop, user_action=None, final_test=False):
+        """
+        Step all members from the time reached so far to tstop.
+        user_action(u, x, y, t) gets the (B, nx+1, ny+1) array. Returns
+        dt, or with final_test the sums of the squares of the final
+        solution over the inner points, one per member.
+        """
+        t0 = time.time()
+        dt = self.dt
+        u, u_1, u_2 = self.us
+        t = self.t
+        num_steps = 0
+        while t <= tstop:
+            t_old = t;  t += dt
+            num_steps += 1
+            self.update_inner(u, u_1, u_2, t_old)
+            self.set_bc(u)
+            if user_action is not None:
+                user_action(u, self.x, self.y, t)
+            # update data structures for next step
+            u_2, u_1, u = u_1, u, u_2
+        self.wtime = time.time()-t0
+        self.num_steps = num_steps
+        self.us = u, u_1, u_2
+        self.t = t
+        if final_test:
+            v = u_1[:,1:self.nx,1:self.ny]
+            return einsum('bij,bij->b', v, v)
+        return dt
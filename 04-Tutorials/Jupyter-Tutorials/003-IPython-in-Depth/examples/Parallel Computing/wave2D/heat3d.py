@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+A 3D heat equation in parallel, with the N-dimensional partitioners.
+
+The engines take explicit steps of u_t = u_xx + u_yy + u_zz on the unit
+cube, with u = 0 on the boundary, with the 7-point stencil, each on its
+subdomain of a ZMQRectPartitionerND (connected by CartesianCommunicator
+objects), or with --mpi of an MPIRectPartitionerND. With --halo h the
+ghost layers are h cells wide, and the engines take h steps between
+exchanges. The result is checked against the same steps on one engine,
+with a single subdomain: the norms agree to rounding.
+
+An example of running the program is (8 processors, 2x2x2 partition,
+64x64x64 grid cells)::
+
+   $ ipcluster start -n 8 # start 8 engines
+   $ python heat3d.py --grid 64 64 64 --partition 2 2 2 --halo 2
+
+or, with MPI::
+
+   $ ipcluster start --engines=MPIExec -n 8 # start 8 engines with mpiexec
+   $ python heat3d.py --mpi --grid 64 64 64
+"""
+from __future__ import print_function
+
+import time
+from math import sqrt
+
+from IPython.external import argparse
+from IPython.parallel import Client, Reference
+
+from RectPartitioner import plan_partition
+
+def setup_partitioner(comm, addrs, index, num_procs, gnum_cells, parts, halo, dtype):
+    """create a ZMQRectPartitionerND in the engine namespace"""
+    global partitioner
+    p = ZMQRectPartitionerND(comm, addrs, my_id=index, num_procs=num_procs,
+                             halo=halo, dtype=dtype)
+    p.redim(global_num_cells=gnum_cells, num_parts=parts)
+    p.prepare_communication()
+    partitioner = p
+
+def setup_mpi_partitioner(index, num_procs, gnum_cells, parts, halo, dtype):
+    """create an MPIRectPartitionerND in the engine namespace"""
+    global partitioner
+    p = MPIRectPartitionerND(my_id=index, num_procs=num_procs, halo=halo, dtype=dtype)
+    p.redim(global_num_cells=gnum_cells, num_parts=parts)
+    p.prepare_communication()
+    partitioner = p
+
+def heat_solve(p, num_steps, alpha):
+    """
+    Take num_steps steps of the heat equation on the subdomain of the
+    partitioner p, with alpha = dt/dx**2 (at most 1/6), and exchange the
+    halo every p.halo steps. Returns the sum of the squares of the final
+    solution over all subdomains, and the wall time of the steps.
+    """
+    import time
+    import numpy
+    h = p.halo
+    loc_n = p.get_num_loc_cells()
+    x = numpy.ix_(*[(p.subd_lo_ix[i]+numpy.arange(loc_n[i]+1))/float(p.global_num_cells[i])
+                    for i in range(3)])
+    u = numpy.exp(-50*sum((xi-0.5)**2 for xi in x)).astype(p.dtype)
+    for i in range(3):
+        if p.lower_neighbors[i] < 0:
+            u[(slice(None),)*i+(0,)] = 0
+        if p.upper_neighbors[i] < 0:
+            u[(slice(None),)*i+(loc_n[i],)] = 0
+    u_new = u.copy()
+    t0 = time.time()
+    for step in range(num_steps):
+        k = step%h+1
+        if k == 1:
+            p.update_internal_boundary(u)
+        # the points that are still up to date k steps after the exchange:
+        # the halo shrinks by a layer per step
+        bounds = [(k if p.lower_neighbors[i] > -1 else 1,
+                   loc_n[i]-k+1 if p.upper_neighbors[i] > -1 else loc_n[i])
+                  for i in range(3)]
+        inner = tuple(slice(lo, hi) for lo, hi in bounds)
+        laplace = -6*u[inner]
+        for i in range(3):
+            for d in (-1, 1):
+                laplace += u[tuple(slice(lo+d, hi+d) if j == i else inner[j]
+                                   for j, (lo, hi) in enumerate(bounds))]
+        u_new[inner] = u[inner]+alpha*laplace
+        u, u_new = u_new, u
+    wtime = time.time()-t0
+    local = p.get_owned_slices()[0]
+    return p.allreduce(float((u[local].astype(float)**2).sum())), wtime
+
+def serial_solve(gnum_cells, halo, dtype, num_steps, alpha):
+    """heat_solve on a single subdomain"""
+    p = RectPartitionerND(my_id=0, num_procs=1, global_num_cells=gnum_cells,
+                          num_parts=[1]*len(gnum_cells), halo=halo, dtype=dtype)
+    p.prepare_communication()
+    return heat_solve(p, num_steps, alpha)
+
+
+# main program:
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    paa = parser.add_argument
+    paa('--grid', '-g',
+        type=int, nargs=3, default=[48,48,48], dest='grid',
+        help="Cells in the grid, e.g. --grid 64 64 64")
+    paa('--partition', '-p',
+        type=int, nargs=3, default=None,
+        help="Process partition grid, e.g. --partition 2 2 2 "
+             "(default: the grid with the least halo communication)")
+    paa('--steps', '-n',
+        type=int, default=100,
+        help="Number of time steps")
+    paa('--alpha',
+        type=float, default=0.125,
+        help="dt/dx**2, at most 1/6 for a stable scheme")
+    paa('--halo',
+        type=int, default=1,
+        help="Width of the ghost layers, and steps taken between exchanges")
+    paa('--dtype',
+        default='float64',
+        help="Type of the solution and halos, e.g. float32")
+    paa('--mpi',
+        action='store_true',
+        help="Exchange the halos with MPI (engines started with mpiexec)")
+    paa('--profile',
+        type=unicode, default=u'default',
+        help="Specify the ipcluster profile for the client to connect to.")
+
+    ns = parser.parse_args()
+    grid = ns.grid
+    partition = ns.partition
+
+    rc = Client(profile=ns.profile)
+    num_procs = len(rc.ids)
+    if partition is None:
+        partition, cost = plan_partition(grid, num_procs)
+    elif not ns.mpi:
+        # with MPI, the partition must cover all the engines (MPI ranks)
+        num_procs = min(num_procs, partition[0]*partition[1]*partition[2])
+    assert partition[0]*partition[1]*partition[2] == num_procs, \
+        "can't map partition %s to %i engines"%(partition, num_procs)
+
+    view = rc[:num_procs]
+    print("Running %s system on %s processes, %i steps, halo %i, %s"%(
+          grid, partition, ns.steps, ns.halo, ns.dtype))
+
+    view.execute('import numpy')
+    view.run('RectPartitioner.py')
+    view.push(dict(heat_solve=heat_solve), block=True)
+    if ns.mpi:
+        view.execute('\n'.join([
+        "from mpi4py import MPI",
+        "mpi = MPI.COMM_WORLD",
+        "my_id = MPI.COMM_WORLD.Get_rank()"]), block=True)
+        view.apply_sync(setup_mpi_partitioner, Reference('my_id'), num_procs, grid, partition,
+                        ns.halo, ns.dtype)
+        view.execute('mpi.barrier()', block=True)
+    else:
+        view.run('communicator.py')
+        view.scatter('my_id', range(num_procs), flatten=True)
+        view.execute('com = CartesianCommunicator(3)')
+        # the connection info of each engine, by its index in the grid
+        addrs = dict(zip(view.pull('my_id', block=True),
+                         view.apply_sync(lambda : com.info)))
+        view.apply_sync(setup_partitioner, Reference('com'), addrs, Reference('my_id'),
+                        num_procs, grid, partition, ns.halo, ns.dtype)
+        time.sleep(1)
+
+    num_points = 1.0*(grid[0]+1)*(grid[1]+1)*(grid[2]+1)
+    t0 = time.time()
+    results = view.apply_sync(heat_solve, Reference('partitioner'), ns.steps, ns.alpha)
+    t1 = time.time()
+    # the sum is reduced on the engines, so they all return the same total
+    norm = sqrt(results[0][0]/num_points)
+    print("%i engines: Wtime=%g, %.3f ms/step, norm=%.10g"%(num_procs, t1-t0,
+          1e3*max(w for s, w in results)/ns.steps, norm))
+
+    s, wtime = rc[rc.ids[0]].apply_sync(serial_solve, grid, ns.halo, ns.dtype, ns.steps, ns.alpha)
+    serial = sqrt(s/num_points)
+    print("1 engine:   %.3f ms/step, norm=%.10g, relative difference %.2g"%(
+          1e3*wtime/ns.steps, serial, abs(norm-serial)/serial))
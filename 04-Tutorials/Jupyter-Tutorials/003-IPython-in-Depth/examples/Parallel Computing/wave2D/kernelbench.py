@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Compare the memory use and bandwidth of the inner update implementations
+of WaveSolver ('scalar', 'vectorized', 'fused' and 'tiled') on a single
+process.
+
+The solver runs on one subdomain (a plain RectPartitioner2D with a 1x1
+partition), so no ipcluster is needed::
+
+   $ python kernelbench.py --sizes 1024 2048 4096 8192
+
+For each implementation and grid size this prints the time per step, the
+effective memory bandwidth (counting only the unavoidable traffic of
+reading u_1, u_2 and writing u once per step) and the peak memory
+allocated during the run on top of the solution arrays. The 'scalar'
+version is only run up to --scalar-max cells per direction, because it
+is slow.
+
+--stencil runs the same implementations with stencils of stencil.py
+instead of the built-in 5-point update ('default'): 'wave2' is the same
+scheme, 'wave4' the 9-point 4th order wave stencil and 'heat' forward
+Euler for the heat equation, which reads one time level less::
+
+   $ python kernelbench.py --sizes 2048 --stencil default wave2 wave4 heat
+"""
+from __future__ import print_function
+
+from functools import partial
+
+from IPython.external import argparse
+
+from RectPartitioner import RectPartitioner2D
+from wavesolver import WaveSolver
+from stencil import wave_stencil, heat_stencil
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+STENCILS = dict(default=None, wave2=wave_stencil,
+                wave4=partial(wave_stencil, order=4), heat=heat_stencil)
+
+def I(x,y):
+    from numpy import exp
+    return 1.5*exp(-100*((x-0.5)**2+(y-0.5)**2))
+
+def run(n, inner, steps, trace=False, stencil='default'):
+    """run steps time steps on an n x n grid, return (time/step, peak temporary bytes)
+
+    The peak is only measured with trace=True, since tracing allocations
+    slows down the many small ones of the 'tiled' version.
+    """
+    p = RectPartitioner2D(my_id=0, num_procs=1)
+    p.redim(global_num_cells=[n,n], num_parts=[1,1])
+    p.prepare_communication()
+    impl = dict(ic='vectorized', inner=inner, bc='vectorized')
+    dt = 0.5/n
+    if stencil == 'heat':
+        # stable for the explicit heat equation
+        dt = 0.2/n**2
+    # f=0.0 and bc=0.0 declare a constant source term and boundary value
+    solver = WaveSolver(I, 0.0, 1., 0.0, 1., 1., partitioner=p, dt=dt, implementation=impl,
+                        stencil=STENCILS[stencil])
+    peak = -1
+    trace = trace and tracemalloc is not None
+    if trace:
+        # start() resets the peak (reset_peak needs Python >= 3.9)
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+    solver.solve((steps-0.5)*dt, dt=dt)
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]-base
+        tracemalloc.stop()
+    return solver.wtime/solver.num_steps, peak
+
+
+# main program:
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    paa = parser.add_argument
+    paa('--sizes', '-s',
+        type=int, nargs='+', default=[1024, 2048, 4096, 8192],
+        help="Cells per direction of the square grids to run")
+    paa('--steps', '-n',
+        type=int, default=10,
+        help="Number of time steps per run")
+    paa('--inner',
+        nargs='+', default=['scalar', 'vectorized', 'fused', 'tiled'],
+        help="Inner implementations to compare")
+    paa('--scalar-max',
+        type=int, default=1024,
+        help="Largest grid to run the scalar implementation on (with a single step)")
+    paa('--stencil',
+        nargs='+', default=['default'],
+        help="Stencils to run: default, wave2, wave4, heat")
+
+    ns = parser.parse_args()
+
+    print("%6s %-8s %-10s %12s %10s %16s"%('n', 'stencil', 'inner', 'ms/step', 'GB/s', 'peak temp MB'))
+    for n in ns.sizes:
+        for stencil in ns.stencil:
+            for inner in ns.inner:
+                steps = ns.steps
+                if inner == 'scalar':
+                    if n > ns.scalar_max:
+                        continue
+                    steps = 1
+                t, peak = run(n, inner, steps, stencil=stencil)
+                peak = run(n, inner, 1, trace=True, stencil=stencil)[1]
+                # read u_1 and u_2 (only u_1 for heat), write u
+                arrays = 2 if stencil == 'heat' else 3
+                nbytes = arrays*8.*(n+1)**2
+                print("%6i %-8s %-10s %12.2f %10.2f %16s"%(n, stencil, inner, 1e3*t, nbytes/t/1e9,
+                      '%.1f'%(peak/1e6) if peak >= 0 else 'n/a'))
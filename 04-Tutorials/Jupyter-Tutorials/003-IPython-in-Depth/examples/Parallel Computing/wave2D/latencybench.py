@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+Benchmark how many steps the parallel 2D wave solver should take between
+halo exchanges, for a range of message latencies.
+
+The engines are connected with ZMQRectPartitioner2D objects, as in
+parallelwave.py, with a halo as wide as the largest number of steps to try.
+Taking k steps between exchanges (WaveSolver.solve(..., time_block=k))
+sends one message per neighbor every k steps instead of every step, but
+computes up to k-1 extra rows/columns around each subdomain. A high-latency
+link is emulated by delaying every exchange by the given latency, so the
+whole k/latency table can be measured on one machine::
+
+   $ ipcluster start -n 4 # start 4 engines
+   $ python latencybench.py --grid 400 400 --time-block 1 2 4 8 --latency 0 0.1 1 5
+
+prints the time per step (ms) for each latency (ms) and k, and the best k
+for each latency.
+"""
+from __future__ import print_function
+
+import time
+
+from IPython.external import argparse
+from IPython.parallel import Client, Reference
+
+from RectPartitioner import plan_partition
+
+def setup_partitioner(comm, addrs, index, num_procs, gnum_cells, parts, halo):
+    """create a partitioner in the engine namespace, whose exchanges
+    take partitioner.latency seconds longer"""
+    global partitioner
+    import time
+    class SlowLinkPartitioner(ZMQRectPartitioner2D):
+        latency = 0.0
+        def update_internal_boundary(self, *solution_arrays):
+            # the messages to all neighbors are in flight at the same time
+            time.sleep(self.latency)
+            ZMQRectPartitioner2D.update_internal_boundary(self, *solution_arrays)
+    p = SlowLinkPartitioner(comm, addrs, my_id=index, num_procs=num_procs, halo=halo)
+    p.redim(global_num_cells=gnum_cells, num_parts=parts)
+    p.prepare_communication()
+    # put the partitioner into the global namespace:
+    partitioner=p
+
+def set_latency(latency):
+    partitioner.latency = latency
+
+def setup_solver(*args, **kwargs):
+    """create a WaveSolver in the engine namespace."""
+    global solver
+    solver = WaveSolver(*args, **kwargs)
+
+def step_time():
+    """the wall time per step of the last solver.solve on this engine"""
+    return solver.wtime/solver.num_steps
+
+
+# main program:
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    paa = parser.add_argument
+    paa('--grid', '-g',
+        type=int, nargs=2, default=[400,400], dest='grid',
+        help="Cells in the grid, e.g. --grid 100 200")
+    paa('--partition', '-p',
+        type=int, nargs=2, default=None,
+        help="Process partition grid, e.g. --partition 4 2 for 4x2 "
+             "(default: the grid with the least halo communication)")
+    paa('--time-block', '-k',
+        type=int, nargs='+', default=[1, 2, 4, 8],
+        help="Numbers of steps between exchanges to try")
+    paa('--latency', '-l',
+        type=float, nargs='+', default=[0., 0.1, 1., 5.],
+        help="Extra latency per exchange to emulate, in ms")
+    paa('--steps', '-n',
+        type=int, default=80,
+        help="Number of time steps per run (a multiple of all the time blocks is best)")
+    paa('--inner',
+        type=str, default='fused',
+        help="Inner implementation of the solver")
+    paa('--profile',
+        type=unicode, default=u'default',
+        help="Specify the ipcluster profile for the client to connect to.")
+
+    ns = parser.parse_args()
+    grid = ns.grid
+    partition = ns.partition
+    Lx = Ly = c = 1.
+
+    rc = Client(profile=ns.profile)
+    num_procs = len(rc.ids)
+
+    if partition is None:
+        partition, cost = plan_partition(grid, num_procs)
+    else:
+        num_procs = min(num_procs, partition[0]*partition[1])
+
+    assert partition[0]*partition[1] == num_procs, "can't map partition %s to %i engines"%(partition, num_procs)
+
+    view = rc[:num_procs]
+    halo = max(ns.time_block)
+    print("Benchmarking %s system on %s processes, %i steps, halo of %i cells"%(grid, partition, ns.steps, halo))
+
+    def I(x,y):
+        from numpy import exp
+        return 1.5*exp(-100*((x-0.5)**2+(y-0.5)**2))
+
+    view.execute('import numpy')
+    view.run('communicator.py')
+    view.run('RectPartitioner.py')
+    view.run('wavesolver.py')
+
+    view.scatter('my_id', range(num_procs), flatten=True)
+    view.execute('com = EngineCommunicator()')
+    peers = view.apply_async(lambda : com.info).get_dict()
+    view.apply_sync(setup_partitioner, Reference('com'), peers, Reference('my_id'), num_procs, grid, partition, halo)
+    time.sleep(1)
+
+    _solve = lambda *args, **kwargs: solver.solve(*args, **kwargs)
+
+    dt = 0.5*min(Lx/grid[0], Ly/grid[1])/c
+    tstop = (ns.steps-0.5)*dt
+    impl = dict(ic='vectorized', inner=ns.inner, bc='vectorized')
+
+    print("%12s"%'latency ms' + ''.join("%10s"%('k=%i'%k) for k in ns.time_block) + "%8s"%'best')
+    for latency in ns.latency:
+        view.apply_sync(set_latency, 1e-3*latency)
+        times = []
+        for k in ns.time_block:
+            # f=0.0 and bc=0.0 declare a constant source term and boundary value
+            view.apply_sync(setup_solver, I,0.0,c,0.0,Lx,Ly, partitioner=Reference('partitioner'), dt=dt, implementation=impl)
+            view.apply_sync(_solve, tstop, dt=dt, time_block=k)
+            # the slowest engine determines the time per step
+            times.append(max(view.apply_sync(step_time)))
+        best = ns.time_block[times.index(min(times))]
+        print("%12g"%latency + ''.join("%10.3f"%(1e3*t) for t in times) + "%8i"%best)
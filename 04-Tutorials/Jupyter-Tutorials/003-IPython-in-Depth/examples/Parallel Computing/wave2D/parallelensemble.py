@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Many small 2D wave simulations, e.g. for uncertainty quantification.
+
+Every member of the ensemble has its own wave speed, Gaussian initial
+condition (center and width) and constant source term, drawn at random.
+The members are grouped into batches of --batch, and each batch is one
+task of a load-balanced view, which steps all of its members together with
+an EnsembleWaveSolver (see ensemble.py). So a simulation costs 1/batch of
+a task and of its messages, instead of the setup_solver and solve round
+trips of parallelwave.py for each one.
+
+An example of running the program is (8 engines, 512 members in batches
+of 64 on a 50x50 grid)::
+
+   $ ipcluster start -n 8 # start 8 engines
+   $ python parallelensemble.py --members 512 --batch 64 --grid 50 50
+
+--compare-single N also runs the first N members one at a time, with a
+WaveSolver each, and reports the time per member of both.
+"""
+from __future__ import print_function
+
+import time
+
+from numpy import array, sqrt
+from numpy.random import RandomState
+
+from IPython.external import argparse
+from IPython.parallel import Client
+
+def random_members(n, seed=0):
+    """n random parameter sets (c, x0, y0, width, source)"""
+    r = RandomState(seed)
+    return [(r.uniform(0.5, 1.5), r.uniform(0.3, 0.7), r.uniform(0.3, 0.7),
+             r.uniform(0.05, 0.15), r.uniform(-1., 1.)) for i in range(n)]
+
+def gaussian(x0, y0, width):
+    """the initial condition of a member"""
+    def I(x, y):
+        from numpy import exp
+        return 1.5*exp(-((x-x0)**2+(y-y0)**2)/width**2)
+    return I
+
+def run_batch(members, grid, tstop, dt):
+    """solve the members together, return the L2 norm of
+    each final solution and the wall time of the solve"""
+    from numpy import sqrt
+    I = [gaussian(x0, y0, w) for c, x0, y0, w, s in members]
+    f = [s for c, x0, y0, w, s in members]
+    c = [c for c, x0, y0, w, s in members]
+    solver = EnsembleWaveSolver(I, f, c, 0.0, 1., 1., grid[0], grid[1], dt=dt)
+    squares = solver.solve(tstop, final_test=True)
+    num_cells = 1.0*(grid[0]-1)*(grid[1]-1)
+    return list(sqrt(squares/num_cells)), solver.wtime
+
+def run_single(member, grid, tstop, dt):
+    """solve one member with a WaveSolver of its own, as run_batch does"""
+    from math import sqrt
+    c, x0, y0, w, s = member
+    p = RectPartitioner2D(my_id=0, num_procs=1)
+    p.redim(global_num_cells=grid, num_parts=[1, 1])
+    p.prepare_communication()
+    impl = dict(ic='vectorized', inner='fused', bc='vectorized')
+    solver = WaveSolver(gaussian(x0, y0, w), s, c, 0.0, 1., 1., partitioner=p,
+                        dt=dt, implementation=impl)
+    squares = solver.solve(tstop, dt=dt, final_test=True)
+    num_cells = 1.0*(grid[0]-1)*(grid[1]-1)
+    return sqrt(squares/num_cells), solver.wtime
+
+
+# main program:
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    paa = parser.add_argument
+    paa('--members', '-m',
+        type=int, default=256,
+        help="Number of simulations in the ensemble")
+    paa('--batch', '-b',
+        type=int, default=32,
+        help="Number of simulations stepped together in one task")
+    paa('--grid', '-g',
+        type=int, nargs=2, default=[50,50], dest='grid',
+        help="Cells in the grid of every simulation, e.g. --grid 50 50")
+    paa('-t', '--tstop',
+        type=float, default=1.,
+        help="Time units to run")
+    paa('--seed',
+        type=int, default=0,
+        help="Seed of the random parameters")
+    paa('--compare-single',
+        type=int, default=0,
+        help="Also run this many members one at a time, to compare the time per member")
+    paa('--profile',
+        type=unicode, default=u'default',
+        help="Specify the ipcluster profile for the client to connect to.")
+
+    ns = parser.parse_args()
+    grid = ns.grid
+    members = random_members(ns.members, ns.seed)
+    # the step of the fastest member, the same for all of them
+    cmax = max(m[0] for m in members)
+    dt = (1/cmax)*(1/sqrt(1/(1./grid[0])**2 + 1/(1./grid[1])**2))
+
+    rc = Client(profile=ns.profile)
+    view = rc[:]
+    view.execute('import numpy')
+    view.run('RectPartitioner.py')
+    view.run('wavesolver.py')
+    view.run('ensemble.py')
+    view.push(dict(gaussian=gaussian), block=True)
+    lview = rc.load_balanced_view()
+
+    batches = [members[i:i+ns.batch] for i in range(0, len(members), ns.batch)]
+    print("Running %i members on a %s grid until %g, %i tasks on %i engines"%(
+          len(members), grid, ns.tstop, len(batches), len(rc.ids)))
+    t0 = time.time()
+    results = lview.map(run_batch, batches, [grid]*len(batches), [ns.tstop]*len(batches),
+                        [dt]*len(batches), block=True)
+    t1 = time.time()
+    norms = array([n for batch_norms, wtime in results for n in batch_norms])
+    solve_time = sum(wtime for batch_norms, wtime in results)
+    print("ensemble: Wtime=%g, %.3g ms solving per member, norm %.4g +- %.2g"%(
+          t1-t0, 1e3*solve_time/len(members), norms.mean(), norms.std()))
+
+    if ns.compare_single:
+        single = members[:ns.compare_single]
+        n = len(single)
+        t0 = time.time()
+        results = lview.map(run_single, single, [grid]*n, [ns.tstop]*n, [dt]*n, block=True)
+        t1 = time.time()
+        worst = max(abs(norm-m) for (norm, wtime), m in zip(results, norms))
+        solve_time = sum(wtime for norm, wtime in results)
+        print("single:   Wtime=%g, %.3g ms solving per member, %i tasks, largest norm difference %.2g"%(
+              t1-t0, 1e3*solve_time/n, n, worst))
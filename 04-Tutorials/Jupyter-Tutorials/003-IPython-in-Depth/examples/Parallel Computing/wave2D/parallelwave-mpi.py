@@ -30,11 +30,14 @@ from numpy import exp, zeros, newaxis, sqrt
 from IPython.external import argparse
 from IPython.parallel import Client, Reference
 
-def setup_partitioner(index, num_procs, gnum_cells, parts):
+from RectPartitioner import plan_partition, gather_global
+from snapshot import create_snapshot_file
+
+def setup_partitioner(index, num_procs, gnum_cells, parts, weights=None):
     """create a partitioner in the engine namespace"""
     global partitioner
     p = MPIRectPartitioner2D(my_id=index, num_procs=num_procs)
-    p.redim(global_num_cells=gnum_cells, num_parts=parts)
+    p.redim(global_num_cells=gnum_cells, num_parts=parts, weights=weights)
     p.prepare_communication()
     # put the partitioner into the global namespace:
     partitioner=p
@@ -44,12 +47,24 @@ def setup_solver(*args, **kwargs):
     global solver
     solver = WaveSolver(*args, **kwargs)
 
-def wave_saver(u, x, y, t):
-    """save the wave log"""
-    global u_hist
-    global t_hist
-    t_hist.append(t)
-    u_hist.append(1.0*u)
+def setup_snapshots(filename, every):
+    """create a SnapshotWriter in the engine namespace, writing to filename"""
+    global snapshots
+    snapshots = SnapshotWriter(filename, partitioner, every=every)
+
+def solve_balanced(tstop, dt, every, **kwargs):
+    """solve until tstop, and every `every` steps resize the subdomains
+    if their compute times have drifted apart"""
+    steps = 0
+    while True:
+        steps += every
+        ins = Instrumentation()
+        stop = min((steps-0.5)*dt, tstop)
+        result = solver.solve(stop, dt=dt, instrument=ins, **kwargs)
+        if stop >= tstop:
+            return result
+        if solver.balance(ins) and partitioner.my_id == 0:
+            print('rebalanced at t=%g, cuts: %s'%(solver.t, partitioner.cuts))
 
 
 # main program:
@@ -62,7 +77,8 @@ if __name__ == '__main__':
         help="Cells in the grid, e.g. --grid 100 200")
     paa('--partition', '-p',
         type=int, nargs=2, default=None,
-        help="Process partition grid, e.g. --partition 4 2 for 4x2")
+        help="Process partition grid, e.g. --partition 4 2 for 4x2 "
+             "(default: the grid with the least halo communication)")
     paa('-c',
         type=float, default=1.,
         help="Wave speed (I think)")
@@ -80,10 +96,29 @@ if __name__ == '__main__':
         help="Specify the ipcluster profile for the client to connect to.")
     paa('--save',
         action='store_true',
-        help="Add this flag to save the time/wave history during the run.")
+        help="Add this flag to save snapshots of the wave during the run.")
+    paa('--save-file',
+        type=str, default='wave.npy',
+        help="File for the snapshots, which all engines must be able to write to.")
+    paa('--save-every',
+        type=int, default=1,
+        help="Save a snapshot every this many steps.")
+    paa('--plot',
+        action='store_true',
+        help="Add this flag to gather the final wave from the engines and plot it.")
     paa('--scalar',
         action='store_true',
         help="Also run with scalar interior implementation, to see vector speedup.")
+    paa('--weights',
+        type=float, nargs='+', default=None,
+        help="Relative speed of each engine, to size the subdomains by, e.g. --weights 1 1 2 2")
+    paa('--calibrate',
+        action='store_true',
+        help="Size the subdomains by the speed of each engine in a short serial run.")
+    paa('--rebalance',
+        type=int, default=0,
+        help="Check the load balance every this many steps of the vectorized run, "
+             "and move rows/columns between the engines if needed.")
 
     ns = parser.parse_args()
     # set up arguments
@@ -94,7 +129,8 @@ if __name__ == '__main__':
     c = ns.c
     tstop = ns.tstop
     if ns.save:
-        user_action = wave_saver
+        # written on the engines by their SnapshotWriter
+        user_action = Reference('snapshots')
     else:
         user_action = None
 
@@ -106,9 +142,13 @@ if __name__ == '__main__':
     num_procs = len(rc.ids)
 
     if partition is None:
-        partition = [1,num_procs]
+        # pick the process grid with the least halo communication
+        partition, cost = plan_partition(grid, num_procs)
+        print "Predicted halo traffic: %i bytes/step, comm/compute ratio %.3g"%(cost['halo_bytes'], cost['comm_compute'])
 
     assert partition[0]*partition[1] == num_procs, "can't map partition %s to %i engines"%(partition, num_procs)
+    assert ns.weights is None or len(ns.weights) == num_procs, \
+        "--weights needs one weight for each of the %i engines, not %i"%(num_procs, len(ns.weights))
 
     view = rc[:]
     print "Running %s system on %s processes until %f"%(grid, partition, tstop)
@@ -131,9 +171,12 @@ if __name__ == '__main__':
     "mpi = MPI.COMM_WORLD",
     "my_id = MPI.COMM_WORLD.Get_rank()"]), block=True)
 
-    # initialize t_hist/u_hist for saving the state at each step (optional)
-    view['t_hist'] = []
-    view['u_hist'] = []
+    # the time step the solvers use (dt=0)
+    dt = (1/float(c))*(1/sqrt(1/(Lx/grid[0])**2 + 1/(Ly/grid[1])**2))
+    if ns.save:
+        # room for a snapshot every save_every steps
+        num_steps = int(tstop/dt)+2
+        create_snapshot_file(ns.save_file, grid, (num_steps-1)//ns.save_every+1)
 
     # set vector/scalar implementation details
     impl = {}
@@ -144,11 +187,20 @@ if __name__ == '__main__':
     # execute some files so that the classes we need will be defined on the engines:
     view.run('RectPartitioner.py')
     view.run('wavesolver.py')
+    view.run('snapshot.py')
 
     # setup remote partitioner
     # note that Reference means that the argument passed to setup_partitioner will be the
     # object named 'my_id' in the engine's namespace
-    view.apply_sync(setup_partitioner, Reference('my_id'), num_procs, grid, partition)
+    weights = ns.weights
+    if ns.calibrate:
+        # the engines' speeds, in the order of their MPI ranks
+        speeds = view.apply_sync(lambda : calibration_speed())
+        weights = [0.0]*num_procs
+        for rank, speed in zip(view['my_id'], speeds):
+            weights[rank] = speed
+        print "Engine speeds (points/s):", ' '.join('%.3g'%w for w in weights)
+    view.apply_sync(setup_partitioner, Reference('my_id'), num_procs, grid, partition, weights)
     # wait for initial communication to complete
     view.execute('mpi.barrier()')
     # setup remote solvers
@@ -160,17 +212,23 @@ if __name__ == '__main__':
     if ns.scalar:
         impl['inner'] = 'scalar'
         # run first with element-wise Python operations for each cell
+        if ns.save:
+            view.apply_sync(setup_snapshots, ns.save_file, ns.save_every)
         t0 = time.time()
         ar = view.apply_async(_solve, tstop, dt=0, verbose=True, final_test=final_test, user_action=user_action)
         if final_test:
-            # this sum is performed element-wise as results finish
-            s = sum(ar)
+            # the sum over the subdomains is reduced on the engines,
+            # so they all return the same total
+            s = ar.get()[0]
             # the L2 norm (RMS) of the result:
             norm = sqrt(s/num_cells)
         else:
             norm = -1
         t1 = time.time()
         print 'scalar inner-version, Wtime=%g, norm=%g'%(t1-t0, norm)
+        if ns.save:
+            # wait for the last snapshots to be written
+            view.execute('snapshots.close()', block=True)
 
     impl['inner'] = 'vectorized'
     # setup new solvers
@@ -178,28 +236,29 @@ if __name__ == '__main__':
     view.execute('mpi.barrier()')
 
     # run again with numpy vectorized inner-implementation
+    if ns.save:
+        view.apply_sync(setup_snapshots, ns.save_file, ns.save_every)
     t0 = time.time()
-    ar = view.apply_async(_solve, tstop, dt=0, verbose=True, final_test=final_test, user_action=user_action)
+    if ns.rebalance:
+        ar = view.apply_async(solve_balanced, tstop, dt, ns.rebalance, final_test=final_test, user_action=user_action)
+    else:
+        ar = view.apply_async(_solve, tstop, dt=0, verbose=True, final_test=final_test, user_action=user_action)
     if final_test:
-        # this sum is performed element-wise as results finish
-        s = sum(ar)
+        # the sum over the subdomains is reduced on the engines,
+        # so they all return the same total
+        s = ar.get()[0]
         # the L2 norm (RMS) of the result:
         norm = sqrt(s/num_cells)
     else:
         norm = -1
     t1 = time.time()
     print 'vector inner-version, Wtime=%g, norm=%g'%(t1-t0, norm)
+    if ns.save:
+        view.execute('snapshots.close()', block=True)
 
-    # if ns.save is True, then u_hist stores the history of u as a list
-    # If the partion scheme is Nx1, then u can be reconstructed via 'gather':
-    if ns.save and partition[-1] == 1:
+    # the final wave, assembled from the subdomains of any partition:
+    if ns.plot:
         import matplotlib.pyplot as plt
-        view.execute('u_last=u_hist[-1]')
-        # map mpi IDs to IPython IDs, which may not match
-        ranks = view['my_id']
-        targets = range(len(ranks))
-        for idx in range(len(ranks)):
-            targets[idx] = ranks.index(idx)
-        u_last = rc[targets].gather('u_last', block=True)
+        u_last = gather_global(view, 'solver.us[1]')
         plt.pcolor(u_last)
         plt.show()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""
+Strong and weak scaling of the parallel 2D wave solver.
+
+For every number of engines in --engines, the solver runs a fixed grid
+(strong scaling, --grid) and a grid with a fixed number of cells per
+engine (weak scaling, --cells-per-engine), with each of the requested
+partitioners (--transport zmq, mpi) and inner boundary exchange patterns
+(--pattern): 'x_y' sweeps in x and then in y, with the receives in
+between the sends, while 'send_recv' posts all sends before the
+receives. The time per step of the slowest engine (the best of --repeat
+runs) is written to a JSON file, with the speedup and parallel
+efficiency relative to the smallest number of engines:
+T(n0)*n0/(T(n)*n) for strong and T(n0)/T(n) for weak scaling.
+
+On a local ipcluster::
+
+   $ ipcluster start -n 8
+   $ python scalingbench.py --engines 1 2 4 8 --grid 1000 1000 --cells-per-engine 500 500
+
+With MPI engines, which all have to be part of the run (the ranks below
+the number of engines take part in each configuration)::
+
+   $ ipcluster start --engines=MPIExec -n 8
+   $ python scalingbench.py --transport mpi --engines 1 2 4 8
+
+Without a cluster, the engines can be threads of this process, connected
+with inproc 0MQ sockets (zmq only). The solver releases the GIL only in
+the numpy operations, so this measures the overhead of the exchange
+more than the speedup::
+
+   $ python scalingbench.py --in-process --engines 1 2 4
+"""
+from __future__ import print_function
+
+import json
+import threading
+
+from IPython.external import argparse
+
+from RectPartitioner import factorizations, partition_cost, plan_partition
+
+def make_partitioner(comm, addrs, index, num_procs, gnum_cells, parts, transport, pattern):
+    """a partitioner for transport ('zmq' or 'mpi'), whose
+    update_internal_boundary uses pattern ('x_y' or 'send_recv')"""
+    if transport == 'mpi':
+        p = MPIRectPartitioner2D(my_id=index, num_procs=num_procs)
+    else:
+        p = ZMQRectPartitioner2D(comm, addrs, my_id=index, num_procs=num_procs)
+    p.redim(global_num_cells=gnum_cells, num_parts=parts)
+    p.prepare_communication()
+    if pattern == 'x_y':
+        if transport == 'zmq':
+            p.update_internal_boundary = p.update_internal_boundary_x_y
+        # the MPI partitioner sweeps x and y by default
+    elif transport == 'mpi':
+        def send_recv(*solution_arrays):
+            p.begin_exchange(*solution_arrays)
+            p.finish_exchange(*solution_arrays)
+        p.update_internal_boundary = send_recv
+    return p
+
+def timed_run(comm, addrs, index, num_procs, gnum_cells, parts, transport, pattern,
+              implementation, steps, repeat):
+    """the wall time per step of repeat runs of steps steps on this engine"""
+    from numpy import exp
+    p = make_partitioner(comm, addrs, index, num_procs, gnum_cells, parts, transport, pattern)
+    def I(x,y):
+        return 1.5*exp(-100*((x-0.5)**2+(y-0.5)**2))
+    dt = 0.5*min(1./gnum_cells[0], 1./gnum_cells[1])
+    times = []
+    for r in range(repeat):
+        # f=0.0 and bc=0.0 declare a constant source term and boundary value
+        solver = WaveSolver(I, 0.0, 1., 0.0, 1., 1., partitioner=p, dt=dt,
+                            implementation=implementation)
+        solver.solve((steps-0.5)*dt, dt=dt)
+        times.append(solver.wtime/solver.num_steps)
+    return times
+
+def weak_partition(cells, num_procs):
+    """the partition of num_procs engines with cells cells each, which sends
+    the fewest halo bytes, and its global grid"""
+    best = None
+    for parts in factorizations(num_procs, len(cells)):
+        grid = [c*p for c, p in zip(cells, parts)]
+        cost = partition_cost(grid, parts)
+        key = (cost['halo_bytes'], -parts[0])
+        if best is None or key < best[0]:
+            best = (key, parts, grid)
+    return best[1], best[2]
+
+
+class InProcessCommunicator(object):
+    """an EngineCommunicator for an engine thread, with inproc sockets"""
+    count = 0
+
+    def __init__(self, context):
+        import zmq
+        InProcessCommunicator.count += 1
+        self.north = context.socket(zmq.PAIR)
+        self.west = context.socket(zmq.PAIR)
+        self.south = context.socket(zmq.PAIR)
+        self.east = context.socket(zmq.PAIR)
+        self.north_url = 'inproc://north-%i'%self.count
+        self.east_url = 'inproc://east-%i'%self.count
+        self.north.bind(self.north_url)
+        self.east.bind(self.east_url)
+        self.location = 'localhost'
+
+    @property
+    def info(self):
+        return (self.location, self.north_url, self.east_url)
+
+    def connect(self, south_peer=None, west_peer=None):
+        if south_peer is not None:
+            self.south.connect(south_peer[1])
+        if west_peer is not None:
+            self.west.connect(west_peer[2])
+
+    def close(self):
+        for s in (self.north, self.west, self.south, self.east):
+            s.close()
+
+def run_in_process(num_procs, grid, parts, transport, pattern, impl, steps, repeat):
+    """timed_run on num_procs engine threads, returns the times of each"""
+    import zmq
+    context = zmq.Context.instance()
+    comms = [InProcessCommunicator(context) for i in range(num_procs)]
+    addrs = dict((i, c.info) for i, c in enumerate(comms))
+    results = [None]*num_procs
+    def engine(i):
+        results[i] = timed_run(comms[i], addrs, i, num_procs, grid, parts, transport, pattern,
+                               impl, steps, repeat)
+    threads = [threading.Thread(target=engine, args=(i,)) for i in range(num_procs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for c in comms:
+        c.close()
+    return results
+
+def run_on_cluster(rc, num_procs, grid, parts, transport, pattern, impl, steps, repeat):
+    """timed_run on num_procs engines of rc, returns the times of each"""
+    from IPython.parallel import Reference
+    if transport == 'mpi':
+        # the engines with the lowest ranks
+        ranks = rc[:].apply_sync(lambda : my_id)
+        targets = [e for e, rank in zip(rc.ids, ranks) if rank < num_procs]
+        view = rc[targets]
+        return view.apply_sync(timed_run, None, None, Reference('my_id'), num_procs, grid, parts,
+                               transport, pattern, impl, steps, repeat)
+    view = rc[:num_procs]
+    view.scatter('my_id', range(num_procs), flatten=True)
+    # new connections for the new neighbors
+    view.execute('com = EngineCommunicator()', block=True)
+    peers = view.apply_async(lambda : com.info).get_dict()
+    return view.apply_sync(timed_run, Reference('com'), peers, Reference('my_id'), num_procs, grid, parts,
+                           transport, pattern, impl, steps, repeat)
+
+
+# main program:
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    paa = parser.add_argument
+    paa('--engines', '-e',
+        type=int, nargs='+', default=[1, 2, 4],
+        help="Numbers of engines to run on")
+    paa('--scaling',
+        nargs='+', default=['strong', 'weak'],
+        help="Kinds of scaling to measure")
+    paa('--grid', '-g',
+        type=int, nargs=2, default=[1000,1000],
+        help="Cells in the grid for strong scaling")
+    paa('--cells-per-engine', '-c',
+        type=int, nargs=2, default=[500,500],
+        help="Cells per engine for weak scaling")
+    paa('--transport',
+        nargs='+', default=['zmq'],
+        help="Partitioners to compare: zmq, mpi")
+    paa('--pattern',
+        nargs='+', default=['x_y', 'send_recv'],
+        help="Inner boundary exchange patterns to compare")
+    paa('--inner',
+        type=str, default='vectorized',
+        help="Inner implementation of the solver")
+    paa('--steps', '-n',
+        type=int, default=50,
+        help="Number of time steps per run")
+    paa('--repeat', '-r',
+        type=int, default=3,
+        help="Number of runs of each configuration, the best one is reported")
+    paa('--output', '-o',
+        type=str, default='scaling.json',
+        help="File to write the results to")
+    paa('--in-process',
+        action='store_true',
+        help="Run the engines as threads of this process instead of on an ipcluster")
+    paa('--profile',
+        type=unicode, default=u'default',
+        help="Specify the ipcluster profile for the client to connect to.")
+
+    ns = parser.parse_args()
+    impl = dict(ic='vectorized', inner=ns.inner, bc='vectorized')
+
+    if ns.in_process:
+        if 'mpi' in ns.transport:
+            print("MPI needs MPI engines, only running zmq in-process")
+            ns.transport = [t for t in ns.transport if t != 'mpi']
+        from RectPartitioner import ZMQRectPartitioner2D
+        from wavesolver import WaveSolver
+        run = run_in_process
+        max_procs = max(ns.engines)
+    else:
+        from IPython.parallel import Client
+        rc = Client(profile=ns.profile)
+        max_procs = len(rc.ids)
+        view = rc[:]
+        view.execute('import numpy')
+        if 'zmq' in ns.transport:
+            view.run('communicator.py')
+        if 'mpi' in ns.transport:
+            view.execute('\n'.join([
+            "from mpi4py import MPI",
+            "mpi = MPI.COMM_WORLD",
+            "mpi_rank = MPI.COMM_WORLD.Get_rank()"]), block=True)
+        view.run('RectPartitioner.py')
+        view.run('wavesolver.py')
+        view.push(dict(make_partitioner=make_partitioner), block=True)
+        run = lambda *args: run_on_cluster(rc, *args)
+
+    engines = [n for n in ns.engines if n <= max_procs]
+    if engines != ns.engines:
+        print("Only %i engines, skipping %s"%(max_procs, [n for n in ns.engines if n > max_procs]))
+
+    results = []
+    print("%-7s %-5s %-10s %7s %9s %13s %10s %8s %10s"%('scaling', 'comm', 'pattern', 'engines', 'partition',
+                                                        'grid', 'ms/step', 'speedup', 'efficiency'))
+    for scaling in ns.scaling:
+        for transport in ns.transport:
+            for pattern in ns.pattern:
+                base = None
+                for n in engines:
+                    if scaling == 'strong':
+                        grid = list(ns.grid)
+                        parts = plan_partition(grid, n)[0]
+                    else:
+                        parts, grid = weak_partition(ns.cells_per_engine, n)
+                    if transport == 'mpi' and not ns.in_process:
+                        # my_id is the MPI rank
+                        rc[:].execute('my_id = mpi_rank', block=True)
+                    times = run(n, grid, parts, transport, pattern, impl, ns.steps, ns.repeat)
+                    # the slowest engine determines the time per step of a run
+                    t = min(max(ts[r] for ts in times) for r in range(ns.repeat))
+                    if base is None:
+                        base = (n, t)
+                    if scaling == 'strong':
+                        speedup = base[1]/t
+                        efficiency = speedup*base[0]/n
+                    else:
+                        speedup = base[1]*n/(t*base[0])
+                        efficiency = base[1]/t
+                    cells = grid[0]*grid[1]
+                    results.append(dict(scaling=scaling, transport=transport, pattern=pattern,
+                                        engines=n, partition=list(parts), grid=list(grid),
+                                        inner=ns.inner, steps=ns.steps, step_time=t,
+                                        cell_updates_per_s=cells/t, speedup=speedup,
+                                        efficiency=efficiency))
+                    print("%-7s %-5s %-10s %7i %9s %13s %10.3f %8.2f %10.2f"%(scaling, transport, pattern, n,
+                          '%ix%i'%tuple(parts), '%ix%i'%tuple(grid), 1e3*t, speedup, efficiency))
+
+    with open(ns.output, 'w') as f:
+        json.dump(dict(in_process=ns.in_process, steps=ns.steps, repeat=ns.repeat,
+                       results=results), f, indent=1)
+    print("wrote %s"%ns.output)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Saving snapshots of a distributed solution to a single .npy file.
+
+The file holds an array of shape (num_snapshots, nx+1, ny+1), created once
+by the client with create_snapshot_file. Every engine memory-maps it, and
+a SnapshotWriter writes the points its subdomain owns at their global
+offsets, so the full field of any snapshot can be read back with
+numpy.load(filename, mmap_mode='r')[k], without gathering anything through
+the controller. The engines must share the file, e.g. all on one host, or on
+a file system where writes to separate parts of a file don't clobber each
+other.
+"""
+from __future__ import print_function
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from numpy import zeros, copyto
+from numpy.lib.format import open_memmap
+
+def create_snapshot_file(filename, global_num_cells, num_snapshots, dtype=float):
+    """create (or overwrite) a snapshot file for num_snapshots snapshots of the global grid"""
+    shape = tuple([num_snapshots]+[n+1 for n in global_num_cells])
+    mm = open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+    del mm
+
+class SnapshotWriter(object):
+    """
+    Write every Nth solution to a snapshot file, from a background thread.
+
+    A SnapshotWriter is a user_action for WaveSolver.solve. Each call
+    counts as one step; on every `every`-th step the owned part of u is
+    copied into one of `max_queue` preallocated buffers and queued for the
+    writer thread, so the solver only waits for the disk when all buffers
+    are in use, and memory use does not grow with the length of the run.
+
+    The times of the snapshots written are kept in `times`. Call close()
+    after the run to wait for the queued snapshots and flush the file.
+    The owned points are looked up for every snapshot, so the writer
+    follows the partitioner when it is rebalanced during the run.
+    """
+
+    def __init__(self, filename, partitioner, every=1, max_queue=4):
+        self.every = every
+        self.partitioner = partitioner
+        local, glob = partitioner.get_owned_slices()
+        self.file = open_memmap(filename, mode='r+')
+        self.step = 0
+        self.times = []
+        shape = [s.stop-s.start for s in local]
+        self.free = Queue()
+        for i in range(max_queue):
+            self.free.put(zeros(shape, self.file.dtype))
+        self.queue = Queue(max_queue)
+        self.thread = threading.Thread(target=self.write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __call__(self, u, x, y, t):
+        step = self.step
+        self.step += 1
+        if step % self.every:
+            return
+        index = step//self.every
+        if index >= len(self.file):
+            if index == len(self.file):
+                print('snapshot file is full after %i snapshots, t=%g'%(index, t))
+            return
+        local, glob = self.partitioner.get_owned_slices()
+        # blocks while all buffers wait to be written
+        buf = self.free.get()
+        if buf.shape != u[local].shape:
+            # the subdomain was resized
+            buf = zeros(u[local].shape, self.file.dtype)
+        copyto(buf, u[local])
+        self.times.append(t)
+        self.queue.put((index, glob, buf))
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            index, glob, buf = item
+            self.file[index][glob] = buf
+            self.free.put(buf)
+
+    def close(self):
+        """write out the queued snapshots and flush the file"""
+        self.queue.put(None)
+        self.thread.join()
+        self.file.flush()
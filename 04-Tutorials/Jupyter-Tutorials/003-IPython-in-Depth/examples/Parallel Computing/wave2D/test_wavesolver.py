@@ -0,0 +1,102 @@
+"""
+Checks of WaveSolver on engine threads in this process, which exchange
+their halos through inproc 0MQ sockets. Run with::
+
+   $ python -m pytest test_wavesolver.py
+"""
+import threading
+
+from numpy import exp, zeros
+
+import zmq
+
+from RectPartitioner import RectPartitioner2D, ZMQRectPartitioner2D
+from wavesolver import WaveSolver
+
+class InProcessCommunicator(object):
+    """the sockets of an EngineCommunicator, for an engine thread"""
+    count = 0
+
+    def __init__(self, context):
+        InProcessCommunicator.count += 1
+        self.north = context.socket(zmq.PAIR)
+        self.west = context.socket(zmq.PAIR)
+        self.south = context.socket(zmq.PAIR)
+        self.east = context.socket(zmq.PAIR)
+        self.north_url = 'inproc://test-north-%i'%self.count
+        self.east_url = 'inproc://test-east-%i'%self.count
+        self.north.bind(self.north_url)
+        self.east.bind(self.east_url)
+        self.location = 'localhost'
+
+    @property
+    def info(self):
+        return (self.location, self.north_url, self.east_url)
+
+    def connect(self, south_peer=None, west_peer=None):
+        if south_peer is not None:
+            self.south.connect(south_peer[1])
+        if west_peer is not None:
+            self.west.connect(west_peer[2])
+
+    def close(self):
+        for s in (self.north, self.west, self.south, self.east):
+            s.close()
+
+def I(x, y):
+    return 1.5*exp(-100*((x-0.5)**2+(y-0.5)**2))
+
+def solve(p, stops, time_block, dt):
+    """the final solution on the subdomain of p, after a call of solve for
+    every time in stops, and its owned slices"""
+    solver = WaveSolver(I, 0.0, 1., 0.0, 1., 1., partitioner=p, dt=dt)
+    for tstop in stops:
+        solver.solve(tstop, dt=dt, time_block=time_block)
+    return solver.us[1], p.get_owned_slices()
+
+def parallel_solve(grid, parts, stops, time_block, dt):
+    """solve on parts[0]*parts[1] engine threads, gathered to the global grid"""
+    num_procs = parts[0]*parts[1]
+    context = zmq.Context.instance()
+    comms = [InProcessCommunicator(context) for i in range(num_procs)]
+    addrs = dict((i, c.info) for i, c in enumerate(comms))
+    results = [None]*num_procs
+    def engine(i):
+        p = ZMQRectPartitioner2D(comms[i], addrs, my_id=i, num_procs=num_procs,
+                                 halo=time_block)
+        p.redim(global_num_cells=grid, num_parts=parts)
+        p.prepare_communication()
+        results[i] = solve(p, stops, time_block, dt)
+    threads = [threading.Thread(target=engine, args=(i,)) for i in range(num_procs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for c in comms:
+        c.close()
+    u = zeros([n+1 for n in grid])
+    for u_local, (local, glob) in results:
+        u[glob] = u_local[local]
+    return u
+
+def serial_solve(grid, stops, dt):
+    p = RectPartitioner2D(my_id=0, num_procs=1)
+    p.redim(global_num_cells=grid, num_parts=[1,1])
+    p.prepare_communication()
+    return solve(p, stops, 1, dt)[0]
+
+def test_split_time_block():
+    """a run split into calls of solve that end in the middle of a block
+    gives the same solution as the serial run"""
+    grid = [40, 40]
+    dt = 0.5/40
+    reference = serial_solve(grid, [20.5*dt], dt)
+    scale = abs(reference).max()
+    for time_block, stops in ((2, [20.5*dt]), (2, [8.5*dt, 20.5*dt]),
+                              (3, [6.5*dt, 20.5*dt]), (3, [4.5*dt, 5.5*dt, 20.5*dt])):
+        u = parallel_solve(grid, [2,2], stops, time_block, dt)
+        error = abs(u-reference).max()/scale
+        assert error < 1e-12, (time_block, stops, error)
+
+if __name__ == '__main__':
+    test_split_time_block()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""
+Benchmark the per-step wall time of the parallel 2D wave solver.
+
+The engines are connected with ZMQRectPartitioner2D objects, exactly as in
+parallelwave.py, and the same problem is solved once for each of the
+requested exchange modes. 'blocking' computes all inner points before the
+inner boundary is exchanged, while 'overlap' posts the sends as soon as the
+rows/columns next to the inner boundary are done, and computes the rest of
+the interior while the messages are in flight.
+
+An example of running the benchmark is (8 processors, 4x2 partition,
+2000x2000 grid cells)::
+
+   $ ipcluster start -n 8 # start 8 engines
+   $ python wavebench.py --grid 2000 2000 --partition 4 2
+
+Add --shared-memory to compare with halos through shared memory between
+engines on the same host.
+
+--dtype float64 float32 runs everything in each precision and ends with an
+accuracy-vs-speed report: the time per step and halo bytes per step of
+each dtype, and the relative difference of the L2 norm of the final
+solution (from final_test) to that of float64::
+
+   $ python wavebench.py --grid 2000 2000 --dtype float64 float32
+
+--poll compares receiving the halos in a fixed order with receiving them
+in the order they arrive (ZMQRectPartitioner2D(poll=True)), by the tail
+latency per step: percentiles over the steps of the time the slowest
+engine takes, in total and waiting for halos. --jitter adds a random
+delay of that mean (in ms) to every step of every engine, like the noise
+of a busy node, so that the halos arrive in a random order::
+
+   $ python wavebench.py --poll --jitter 0.5 --steps 500
+"""
+from __future__ import print_function
+
+import time
+from math import sqrt
+
+import numpy
+from IPython.external import argparse
+from IPython.parallel import Client, Reference
+
+from RectPartitioner import plan_partition, partition_cost
+from wavesolver import imbalance_report, step_latency
+
+def setup_partitioner(comm, addrs, index, num_procs, gnum_cells, parts, **kwargs):
+    """create a partitioner in the engine namespace"""
+    global partitioner
+    p = ZMQRectPartitioner2D(comm, addrs, my_id=index, num_procs=num_procs, **kwargs)
+    p.redim(global_num_cells=gnum_cells, num_parts=parts)
+    p.prepare_communication()
+    # put the partitioner into the global namespace:
+    partitioner=p
+
+def setup_solver(*args, **kwargs):
+    """create a WaveSolver in the engine namespace."""
+    global solver
+    solver = WaveSolver(*args, **kwargs)
+
+def step_time():
+    """the wall time per step of the last solver.solve on this engine"""
+    return solver.wtime/solver.num_steps
+
+def instrumented_solve(tstop, dt):
+    """solve again with an Instrumentation, return its arrays"""
+    ins = Instrumentation()
+    solver.solve(tstop, dt=dt, instrument=ins)
+    return ins.arrays()
+
+def jittered_solve(tstop, dt, jitter):
+    """instrumented_solve with a random delay, exponentially distributed
+    with mean jitter seconds, in every step on this engine"""
+    import random, time
+    def noise(u, x, y, t):
+        time.sleep(random.expovariate(1./jitter))
+    ins = Instrumentation()
+    solver.solve(tstop, dt=dt, instrument=ins, user_action=noise if jitter > 0 else None)
+    return ins.arrays()
+
+def set_poll(poll, timeout=None):
+    """receive the halos in the order they arrive (poll=True) or in a fixed order"""
+    partitioner.poll = poll
+    partitioner.timeout = timeout
+
+def exchange_allocs():
+    """the largest number of bytes allocated by one exchange on this engine"""
+    n = max(partitioner.alloc_bytes or [0])
+    partitioner.alloc_bytes = []
+    return n
+
+
+# main program:
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    paa = parser.add_argument
+    paa('--grid', '-g',
+        type=int, nargs=2, default=[1000,1000], dest='grid',
+        help="Cells in the grid, e.g. --grid 100 200")
+    paa('--partition', '-p',
+        type=int, nargs=2, default=None,
+        help="Process partition grid, e.g. --partition 4 2 for 4x2 "
+             "(default: the grid with the least halo communication)")
+    paa('--steps', '-n',
+        type=int, default=100,
+        help="Number of time steps per run")
+    paa('--repeat', '-r',
+        type=int, default=3,
+        help="Number of runs for each exchange mode, the best one is reported")
+    paa('--exchange',
+        nargs='+', default=['blocking', 'overlap'],
+        help="Exchange modes to compare")
+    paa('--count-allocs',
+        action='store_true',
+        help="Report the bytes allocated per halo exchange (needs Python >= 3.4 on the engines)")
+    paa('--shared-memory',
+        action='store_true',
+        help="Exchange the halos of engines on the same host through shared memory (Python >= 3.8)")
+    paa('--dtype',
+        nargs='+', default=['float64'],
+        help="Types of the solution and halos to compare, e.g. float64 float32")
+    paa('--poll',
+        action='store_true',
+        help="Compare the tail latency per step of fixed order and polled receives")
+    paa('--jitter',
+        type=float, default=0.0,
+        help="Mean random delay per step on every engine, in ms, for --poll")
+    paa('--timeout',
+        type=float, default=None,
+        help="Seconds to wait for a neighbor before giving up with an error")
+    paa('--report',
+        action='store_true',
+        help="Print a per-phase load-imbalance report for each exchange mode")
+    paa('--profile',
+        type=unicode, default=u'default',
+        help="Specify the ipcluster profile for the client to connect to.")
+
+    ns = parser.parse_args()
+    grid = ns.grid
+    partition = ns.partition
+    Lx = Ly = c = 1.
+
+    # create the Client
+    rc = Client(profile=ns.profile)
+    num_procs = len(rc.ids)
+
+    if partition is None:
+        # pick the process grid with the least halo communication
+        partition, cost = plan_partition(grid, num_procs)
+        print("Predicted halo traffic: %i bytes/step, comm/compute ratio %.3g"%(cost['halo_bytes'], cost['comm_compute']))
+    else:
+        num_procs = min(num_procs, partition[0]*partition[1])
+
+    assert partition[0]*partition[1] == num_procs, "can't map partition %s to %i engines"%(partition, num_procs)
+
+    view = rc[:num_procs]
+    print("Benchmarking %s system on %s processes, %i steps"%(grid, partition, ns.steps))
+
+    def I(x,y):
+        from numpy import exp
+        return 1.5*exp(-100*((x-0.5)**2+(y-0.5)**2))
+    def f(x,y,t):
+        return 0.0
+    def bc(x,y,t):
+        return 0.0
+
+    view.execute('import numpy')
+    view.run('communicator.py')
+    view.run('RectPartitioner.py')
+    view.run('wavesolver.py')
+
+    view.scatter('my_id', range(num_procs), flatten=True)
+    view.execute('com = EngineCommunicator()')
+    peers = view.apply_async(lambda : com.info).get_dict()
+    view.apply_sync(setup_partitioner, Reference('com'), peers, Reference('my_id'), num_procs, grid, partition,
+                    count_allocs=ns.count_allocs, shared_memory=ns.shared_memory, timeout=ns.timeout)
+    time.sleep(1)
+
+    _solve = lambda *args, **kwargs: solver.solve(*args, **kwargs)
+
+    # the same time step on all engines, so that tstop gives ns.steps steps
+    dt = 0.5*min(Lx/grid[0], Ly/grid[1])/c
+    tstop = (ns.steps-0.5)*dt
+
+    dtypes = ns.dtype
+    if len(dtypes) > 1 and 'float64' not in dtypes:
+        # the reference for the accuracy report
+        dtypes = ['float64']+dtypes
+
+    results = {}
+    norms = {}
+    for dtype in dtypes:
+        # the partitioner's buffers follow the dtype of the solver
+        args = (I,f,c,bc,Lx,Ly)
+        kwargs = dict(partitioner=Reference('partitioner'), dt=dt, dtype=dtype)
+        for exchange in ns.exchange:
+            impl = dict(ic='vectorized', inner='vectorized', bc='vectorized', exchange=exchange)
+            best = None
+            for i in range(ns.repeat):
+                view.apply_sync(setup_solver, *args, implementation=impl, **kwargs)
+                view.apply_sync(_solve, tstop, dt=dt)
+                # the slowest engine determines the time per step
+                t = max(view.apply_sync(step_time))
+                if best is None or t < best:
+                    best = t
+            results[dtype, exchange] = best
+            print("%-8s %-10s exchange: %10.3f ms/step"%(dtype, exchange, 1e3*best))
+            if ns.count_allocs:
+                print("%-8s %-10s exchange: %10i bytes allocated per exchange"%(dtype, exchange,
+                      max(view.apply_sync(exchange_allocs))))
+            if ns.report:
+                view.apply_sync(setup_solver, *args, implementation=impl, **kwargs)
+                print(imbalance_report(view.apply_sync(instrumented_solve, tstop, dt)))
+            if ns.poll:
+                for poll in (False, True):
+                    view.apply_sync(set_poll, poll, ns.timeout)
+                    view.apply_sync(setup_solver, *args, implementation=impl, **kwargs)
+                    latency = step_latency(view.apply_sync(jittered_solve, tstop, dt, ns.jitter/1e3))
+                    print("%-8s %-10s %-6s step ms p50/p90/p99/max: %s, halo wait: %s"%(dtype, exchange,
+                          'polled' if poll else 'fixed',
+                          '/'.join('%.3f'%(1e3*t) for t in latency['total']),
+                          '/'.join('%.3f'%(1e3*t) for t in latency['recv'])))
+                view.apply_sync(set_poll, False, ns.timeout)
+
+        if 'blocking' in ns.exchange:
+            for exchange in ns.exchange:
+                if exchange != 'blocking':
+                    print("%-8s %s vs blocking: %.2fx"%(dtype, exchange,
+                          results[dtype, 'blocking']/results[dtype, exchange]))
+        if len(dtypes) > 1:
+            impl = dict(ic='vectorized', inner='vectorized', bc='vectorized')
+            view.apply_sync(setup_solver, *args, implementation=impl, **kwargs)
+            # the sum of the squares of the final solution, the same on every engine
+            squares = view.apply_sync(_solve, tstop, dt=dt, final_test=True)[0]
+            norms[dtype] = sqrt(squares*Lx/grid[0]*Ly/grid[1])
+
+    if len(dtypes) > 1:
+        print("%-8s %10s %8s %12s %14s %11s"%('dtype', 'ms/step', 'speedup', 'halo B/step',
+                                              'L2 norm', 'rel. error'))
+        t64 = min(results['float64', e] for e in ns.exchange)
+        for dtype in dtypes:
+            t = min(results[dtype, e] for e in ns.exchange)
+            itemsize = numpy.dtype(dtype).itemsize
+            halo_bytes = partition_cost(grid, partition, itemsize)['halo_bytes']
+            error = abs(norms[dtype]-norms['float64'])/norms['float64']
+            print("%-8s %10.3f %8.2f %12i %14.8g %11.2e"%(dtype, 1e3*t, t64/t, halo_bytes,
+                                                       norms[dtype], error))
+
+    # release the shared memory rings (and their pipes) of the engines
+    view.execute('partitioner.close()', block=True)
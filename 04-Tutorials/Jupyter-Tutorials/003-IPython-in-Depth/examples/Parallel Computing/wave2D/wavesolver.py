@@ -12,7 +12,8 @@ Authors
 """
 import time
 
-from numpy import exp, zeros, newaxis, sqrt, arange
+from numpy import exp, zeros, newaxis, sqrt, arange, add, multiply, subtract, einsum, \
+    broadcast_arrays, result_type, array, percentile
 
 def iseq(start=0, stop=None, inc=1):
     """
@@ -24,6 +25,142 @@ def iseq(start=0, stop=None, inc=1):
         stop = start; start = 0; inc = 1
     return arange(start, stop+inc, inc)
 
+class Instrumentation(object):
+    """
+    Per-step timings and halo traffic of WaveSolver.solve, on one engine.
+
+    Pass an Instrumentation object to solve(..., instrument=...) to record,
+    for every step, the seconds spent in each of the phases: 'inner' (the
+    update of the inner points), 'bc' (boundary conditions), 'send'
+    (posting the sends of the overlapped exchange), 'recv' (waiting for
+    the exchange to complete; the whole exchange in 'blocking' mode) and
+    'user_action'. The bytes sent to each neighbor are counted per
+    direction ('west', 'east', 'south', 'north').
+
+    arrays() returns the results as a small dict of arrays, which the
+    client can pull from all engines and pass to imbalance_report.
+    """
+    phases = ('inner', 'bc', 'send', 'recv', 'user_action')
+    directions = (('west', 'east'), ('south', 'north'))
+
+    def __init__(self):
+        self.my_id = -1
+        self.times = zeros((0, len(self.phases)))
+        self.step = -1
+        self.bytes = dict((d, 0) for pair in self.directions for d in pair)
+        self.last = 0.0
+
+    def begin_run(self, partitioner, max_steps):
+        """prepare for a run of (at most about) max_steps steps"""
+        self.my_id = partitioner.my_id
+        self.partitioner = partitioner
+        self.times = zeros((max_steps, len(self.phases)))
+        self.step = -1
+
+    def begin_step(self):
+        self.step += 1
+        if self.step == len(self.times):
+            # more steps than expected
+            times = zeros((2*len(self.times)+1, len(self.phases)))
+            times[:self.step] = self.times
+            self.times = times
+        self.last = time.time()
+
+    def mark(self, phase):
+        """add the time since the last mark to phase, for this step"""
+        now = time.time()
+        self.times[self.step, self.phases.index(phase)] += now-self.last
+        self.last = now
+
+    def count_exchange(self, levels=1):
+        """count the bytes sent by one exchange of levels solution arrays"""
+        p = self.partitioner
+        for i, (lower, upper) in enumerate(self.directions):
+            if p.lower_neighbors[i] > -1:
+                self.bytes[lower] += p.out_lower_buffers[i][:levels].nbytes
+            if p.upper_neighbors[i] > -1:
+                self.bytes[upper] += p.out_upper_buffers[i][:levels].nbytes
+
+    def arrays(self):
+        """the recorded data: the timings as a (steps, phases) array"""
+        return dict(my_id=self.my_id, phases=self.phases,
+                    times=self.times[:self.step+1], bytes=dict(self.bytes))
+
+class NoInstrumentation(object):
+    """does nothing, for solve without an Instrumentation object"""
+    def begin_run(self, partitioner, max_steps): pass
+    def begin_step(self): pass
+    def mark(self, phase): pass
+    def count_exchange(self, levels=1): pass
+
+def imbalance_report(results):
+    """
+    A load-imbalance report from the Instrumentation.arrays() of all
+    engines: the mean and max (over engines) time per step in each phase,
+    with the engine that takes the longest, the bytes sent per step and
+    the engine that computes the longest, which the others wait for.
+    """
+    phases = results[0]['phases']
+    # seconds per step for each engine and phase
+    per_step = [r['times'].sum(axis=0)/max(len(r['times']), 1) for r in results]
+    ids = [r['my_id'] for r in results]
+    lines = ['%-12s %12s %12s %9s %8s'%('phase', 'mean ms', 'max ms', 'max/mean', 'slowest')]
+    for k, phase in enumerate(phases+('total',)):
+        if phase == 'total':
+            values = [t.sum() for t in per_step]
+        else:
+            values = [t[k] for t in per_step]
+        mean = sum(values)/len(values)
+        worst = max(range(len(values)), key=lambda i: values[i])
+        ratio = values[worst]/mean if mean > 0 else 1.0
+        lines.append('%-12s %12.3f %12.3f %9.2f %8i'%(phase, 1e3*mean, 1e3*values[worst], ratio, ids[worst]))
+    compute = [t[phases.index('inner')]+t[phases.index('bc')] for t in per_step]
+    wait = [t[phases.index('recv')] for t in per_step]
+    straggler = max(range(len(compute)), key=lambda i: compute[i])
+    lines.append('straggler: engine %i computes %.3f ms/step, the others wait %.3f ms/step on average'\
+                 %(ids[straggler], 1e3*compute[straggler],
+                   1e3*sum(wait[i] for i in range(len(wait)) if i != straggler)/max(len(wait)-1, 1)))
+    for r, t in zip(results, per_step):
+        steps = max(len(r['times']), 1)
+        sent = ', '.join('%s %i'%(d, n//steps) for d, n in sorted(r['bytes'].items()) if n)
+        lines.append('engine %3i bytes/step sent: %s'%(r['my_id'], sent or '-'))
+    return '\n'.join(lines)
+
+def step_latency(results, percentiles=(50, 90, 99, 100)):
+    """
+    The tail latency per step from the Instrumentation.arrays() of all
+    engines: the given percentiles, over the steps, of the time the slowest
+    engine takes for the step, in total and in the 'recv' phase (waiting
+    for the halos). Returns a dict of lists of seconds.
+    """
+    phases = results[0]['phases']
+    steps = min(len(r['times']) for r in results)
+    times = array([r['times'][:steps] for r in results])   # engine, step, phase
+    total = times.sum(axis=2).max(axis=0)
+    recv = times[:,:,phases.index('recv')].max(axis=0)
+    return dict(percentiles=list(percentiles), total=list(percentile(total, percentiles)),
+                recv=list(percentile(recv, percentiles)))
+
+def calibration_speed(n=200, steps=20, implementation=None):
+    """
+    Time a short serial run of WaveSolver on an n x n grid, on this engine.
+    Returns the grid points updated per second, a weight for the
+    partitioner: view.apply_sync(calibration_speed) gives one for each
+    engine of view. Uses the RectPartitioner2D of the engine namespace,
+    so run RectPartitioner.py on the engines first.
+    """
+    p = RectPartitioner2D(my_id=0, num_procs=1)
+    p.redim(global_num_cells=[n,n], num_parts=[1,1])
+    p.prepare_communication()
+    if implementation is None:
+        implementation = {'ic': 'vectorized', 'inner': 'vectorized', 'bc': 'vectorized'}
+    I = lambda x, y: exp(-100*((x-0.5)**2+(y-0.5)**2))
+    dt = 0.5/n
+    solver = WaveSolver(I, 0.0, 1., 0.0, 1., 1., partitioner=p, dt=dt,
+                        implementation=implementation)
+    solver.solve((steps-0.5)*dt, dt=dt)
+    return (n-1)**2*solver.num_steps/solver.wtime
+
 class WaveSolver(object):
     """
     Solve the 2D wave equation u_tt = u_xx + u_yy + f(x,y,t) with
@@ -39,7 +176,18 @@ class WaveSolver(object):
 
     tstop is the stop time for the simulation.
 
-    I, f are functions: I(x,y), f(x,y,t)
+    I, f are functions: I(x,y), f(x,y,t). f may also be a number,
+    which declares a constant source term.
+
+    bc is normally a function bc(x,y,t), which is evaluated on the
+    boundary at every time step. Boundary values that don't need that can
+    be declared instead, and are then computed once and cached for each
+    edge of the subdomain, so that setting them is a copy per step:
+    a number is a constant boundary value, an array of shape (nx+1, ny+1)
+    holds time-independent boundary values of the global grid (only its
+    edges are used), and a tuple (g, h) of functions g(x,y) and h(t)
+    declares the separable boundary condition g(x,y)*h(t), or the
+    time-independent g(x,y) if h is None.
 
     user_action: function of (u, x, y, t) called at each time
     level (x and y are one-dimensional coordinate vectors).
@@ -52,9 +200,24 @@ class WaveSolver(object):
     Normally, values are legal: 'scalar' or 'vectorized'.
     'scalar' means straight loops over grid points, while
     'vectorized' means special NumPy vectorized operations.
+    For 'inner', 'fused' is a vectorized update that writes through
+    preallocated scratch arrays with out= arguments instead of building
+    temporary arrays, and that skips the source term if f is the constant 0
+    (or adds a constant f as a scalar). 'tiled' does the same update block
+    by block, with blocks small enough that the part of u, u_1, u_2 and the
+    scratch array they cover stays in the cache (tile_bytes, by default the
+    size of a typical L2 cache) during the whole update.
+
+    The 'exchange' key selects how the inner boundary is communicated:
+    'blocking' updates all inner points and then exchanges the inner
+    boundary, while 'overlap' updates the points next to the inner boundary
+    first, posts the sends with partitioner.begin_exchange, computes the
+    rest of the interior and then completes the receives with
+    partitioner.finish_exchange.
 
     If a key in the implementation dictionary is missing, it
-    defaults in this function to 'scalar' (the safest strategy).
+    defaults in this function to 'scalar' (the safest strategy),
+    or 'blocking' for 'exchange'.
     Note that if 'vectorized' is specified, the functions I, f,
     and bc must work in vectorized mode. It is always recommended
     to first run the 'scalar' mode and then compare 'vectorized'
@@ -64,28 +227,84 @@ class WaveSolver(object):
     verbose: true if a message at each time step is written,
     false implies no output during the simulation.
 
-    final_test: true means the discrete L2-norm of the final solution is
-    to be computed.
+    final_test: true means the sum of the squares of the final solution
+    over the global inner points is to be computed (and returned by solve
+    on every engine), from which the discrete L2-norm follows.
+
+    time_block: the number of steps solve takes between exchanges of the
+    inner boundary. Each step computes the whole halo as well, so the valid
+    part of the halo shrinks by one cell per step, and the partitioner needs
+    a halo of at least time_block cells. The last two time levels are
+    exchanged together every time_block steps, so the halo is only up to
+    date after those steps (user_action sees stale halo values in between)
+    and at the end of the call, which exchanges once more if it stops in
+    the middle of a block. On a high-latency network this trades
+    time_block-1 of every time_block messages for the extra computation in
+    the halo.
+
+    instrument: an Instrumentation object, which records the time spent in
+    each phase of every step and the bytes sent to the neighbors.
+
+    solve continues from the time the solver has reached (0 after the
+    initial condition), so a run can be split into several calls of solve,
+    e.g. to rebalance the subdomains in between (see balance).
+
+    stencil: a function stencil(c, dt, dx, dy) that returns a
+    stencil.Stencil, e.g. stencil.wave_stencil or stencil.heat_stencil,
+    which replaces the 5-point update of the wave equation for all inner
+    implementations. It reads at most two time levels, and the level before
+    the last one only at the point itself, so that the first step can
+    follow from du/dt=0: it halves the spatial terms of wave_stencil, but
+    adds the whole source term dt**2*f, like the built-in first step, so
+    that both give the same solution. dt must be given. The subdomains
+    overlap by at least the radius of the stencil; the solver widens the
+    halo of the partitioner to that if it is narrower (a ValueError if a
+    subdomain is narrower than the radius), and time_block steps need
+    time_block times the radius. The points closer than the radius to the
+    edge of the grid are updated with the boundary stencil.
+
+    dtype: the type of the solution arrays, by default partitioner.dtype
+    (float). With numpy.float32 the solver moves half the bytes through
+    memory and to the neighbors as with float64, and the partitioner's
+    buffers are reallocated with the same dtype if they differ. The norm
+    of final_test is summed up in float64 either way.
     """
 
     def __init__(self, I, f, c, bc, Lx, Ly, partitioner=None, dt=-1,
                 user_action=None,
                 implementation={'ic': 'vectorized',  # or 'scalar'
                                 'inner': 'vectorized',
-                                'bc': 'vectorized'}):
+                                'bc': 'vectorized'},
+                tile_bytes=256*1024, stencil=None, dtype=None):
 
         nx = partitioner.global_num_cells[0]  # number of global cells in x dir
         ny = partitioner.global_num_cells[1]  # number of global cells in y dir
         dx = Lx/float(nx)
         dy = Ly/float(ny)
+        self.stencil_factory = stencil
+        self.stencil = None
+        if stencil is not None:
+            if dt <= 0:
+                raise ValueError("a stencil needs a given time step dt")
+            self.stencil = self.make_stencil(c, dt, dx, dy)
+        if dtype is None:
+            dtype = partitioner.dtype
+        self.dtype = dtype = result_type(dtype)
+        halo = max(partitioner.halo, self.stencil.radius if stencil is not None else 1)
+        if halo != partitioner.halo or dtype != result_type(partitioner.dtype):
+            # overlap the subdomains by the radius of the stencil, and
+            # send the halos in the type of the solution; the subdomains
+            # must still be at least as wide as the wider halo
+            partitioner.check_cuts(partitioner.cuts, halo)
+            partitioner.halo = halo
+            partitioner.dtype = dtype
+            partitioner.prepare_communication(partitioner.cuts)
         loc_nx, loc_ny = partitioner.get_num_loc_cells()
         nx = loc_nx; ny = loc_ny              # now use loc_nx and loc_ny instead
-        lo_ix0 = partitioner.subd_lo_ix[0]
-        lo_ix1 = partitioner.subd_lo_ix[1]
-        hi_ix0 = partitioner.subd_hi_ix[0]
-        hi_ix1 = partitioner.subd_hi_ix[1]
-        x = iseq(dx*lo_ix0, dx*hi_ix0, dx) # local grid points in x dir
-        y = iseq(dy*lo_ix1, dy*hi_ix1, dy) # local grid points in y dir
+        self.Lx = Lx
+        self.Ly = Ly
+        self.partitioner=partitioner
+        x, y = self.local_grid()
         self.x = x
         self.y = y
         xv = x[:,newaxis]   # for vectorized expressions with f(xv,yv)
@@ -94,7 +313,7 @@ class WaveSolver(object):
             dt = (1/float(c))*(1/sqrt(1/dx**2 + 1/dy**2))  # max time step
         Cx2 = (c*dt/dx)**2;  Cy2 = (c*dt/dy)**2;  dt2 = dt**2  # help variables
 
-        u = zeros((nx+1,ny+1))   # solution array
+        u = zeros((nx+1,ny+1), dtype)   # solution array
         u_1 = u.copy()           # solution at t-dt
         u_2 = u.copy()           # solution at t-2*dt
 
@@ -107,16 +326,27 @@ class WaveSolver(object):
             implementation['bc'] = 'scalar'
         if 'inner' not in implementation:
             implementation['inner'] = 'scalar'
+        if 'exchange' not in implementation:
+            implementation['exchange'] = 'blocking'
 
         self.implementation = implementation
-        self.Lx = Lx
-        self.Ly = Ly
+        self.tile_bytes = tile_bytes
         self.I=I
+        if callable(f):
+            self.f_const = None
+        else:
+            # a constant source term
+            self.f_const = f_const = float(f)
+            f = lambda x, y, t: f_const
         self.f=f
         self.c=c
         self.bc=bc
         self.user_action = user_action
-        self.partitioner=partitioner
+        if callable(bc):
+            self.bc_edges = None
+        else:
+            # declared boundary values, for the edges i=0, i=nx, j=0, j=ny
+            self.bc_edges, self.bc_time = self.cache_bc(bc, x, y, implementation)
 
         # set initial condition (pointwise - allows straight if-tests in I(x,y)):
         t=0.0
@@ -125,48 +355,326 @@ class WaveSolver(object):
                 for j in xrange(0,ny+1):
                     u_1[i,j] = I(x[i], y[j])
 
-            for i in xrange(1,nx):
-                for j in xrange(1,ny):
-                    u_2[i,j] = u_1[i,j] + \
+            if self.stencil is not None:
+                self.update_stencil(u_2, (u_1,), 0.0, (1, nx, 1, ny), 'scalar',
+                                    first_step=True)
+            else:
+                for i in xrange(1,nx):
+                    for j in xrange(1,ny):
+                        u_2[i,j] = u_1[i,j] + \
                            0.5*Cx2*(u_1[i-1,j] - 2*u_1[i,j] + u_1[i+1,j]) + \
                            0.5*Cy2*(u_1[i,j-1] - 2*u_1[i,j] + u_1[i,j+1]) + \
                            dt2*f(x[i], y[j], 0.0)
 
             # boundary values of u_2 (equals u(t=dt) due to du/dt=0)
-            i = 0
-            for j in xrange(0,ny+1):
-                u_2[i,j] = bc(x[i], y[j], t+dt)
-            j = 0
-            for i in xrange(0,nx+1):
-                u_2[i,j] = bc(x[i], y[j], t+dt)
-            i = nx
-            for j in xrange(0,ny+1):
-                u_2[i,j] = bc(x[i], y[j], t+dt)
-            j = ny
-            for i in xrange(0,nx+1):
-                u_2[i,j] = bc(x[i], y[j], t+dt)
+            if self.bc_edges is not None:
+                self.apply_cached_bc(u_2, t+dt, range(4))
+            else:
+                i = 0
+                for j in xrange(0,ny+1):
+                    u_2[i,j] = bc(x[i], y[j], t+dt)
+                j = 0
+                for i in xrange(0,nx+1):
+                    u_2[i,j] = bc(x[i], y[j], t+dt)
+                i = nx
+                for j in xrange(0,ny+1):
+                    u_2[i,j] = bc(x[i], y[j], t+dt)
+                j = ny
+                for i in xrange(0,nx+1):
+                    u_2[i,j] = bc(x[i], y[j], t+dt)
 
         elif implementation['ic'] == 'vectorized':
-            u_1 = I(xv,yv)
-            u_2[1:nx,1:ny] = u_1[1:nx,1:ny] + \
-            0.5*Cx2*(u_1[0:nx-1,1:ny] - 2*u_1[1:nx,1:ny] + u_1[2:nx+1,1:ny]) + \
-            0.5*Cy2*(u_1[1:nx,0:ny-1] - 2*u_1[1:nx,1:ny] + u_1[1:nx,2:ny+1]) + \
-            dt2*(f(xv[1:nx,1:ny], yv[1:nx,1:ny], 0.0))
+            u_1[...] = I(xv,yv)
+            if self.stencil is not None:
+                self.update_stencil(u_2, (u_1,), 0.0, (1, nx, 1, ny), 'vectorized',
+                                    first_step=True)
+            else:
+                u_2[1:nx,1:ny] = u_1[1:nx,1:ny] + \
+                0.5*Cx2*(u_1[0:nx-1,1:ny] - 2*u_1[1:nx,1:ny] + u_1[2:nx+1,1:ny]) + \
+                0.5*Cy2*(u_1[1:nx,0:ny-1] - 2*u_1[1:nx,1:ny] + u_1[1:nx,2:ny+1]) + \
+                dt2*(f(xv[1:nx], yv[:,1:ny], 0.0))
             # boundary values (t=dt):
-            i = 0;  u_2[i,:] = bc(x[i], y, t+dt)
-            j = 0;  u_2[:,j] = bc(x, y[j], t+dt)
-            i = nx; u_2[i,:] = bc(x[i], y, t+dt)
-            j = ny; u_2[:,j] = bc(x, y[j], t+dt)
+            if self.bc_edges is not None:
+                self.apply_cached_bc(u_2, t+dt, range(4))
+            else:
+                i = 0;  u_2[i,:] = bc(x[i], y, t+dt)
+                j = 0;  u_2[:,j] = bc(x, y[j], t+dt)
+                i = nx; u_2[i,:] = bc(x[i], y, t+dt)
+                j = ny; u_2[:,j] = bc(x, y[j], t+dt)
 
         if user_action is not None:
             user_action(u_1, x, y, t)  # allow user to plot etc.
         # print(list(self.us[2][2]))
         self.us = (u,u_1,u_2)
+        self.t = t
+        self.alloc_scratch()
 
-
-    def solve(self, tstop, dt=-1, user_action=None, verbose=False, final_test=False):
+    def local_grid(self):
+        """the coordinates of the points of the local grid, in x and y"""
+        partitioner = self.partitioner
+        dx = self.Lx/float(partitioner.global_num_cells[0])
+        dy = self.Ly/float(partitioner.global_num_cells[1])
+        lo_ix0 = partitioner.subd_lo_ix[0]
+        lo_ix1 = partitioner.subd_lo_ix[1]
+        hi_ix0 = partitioner.subd_hi_ix[0]
+        hi_ix1 = partitioner.subd_hi_ix[1]
+        # integer ranges, so that x and y always have loc_nx+1 and loc_ny+1 points
+        x = dx*iseq(lo_ix0, hi_ix0) # local grid points in x dir
+        y = dy*iseq(lo_ix1, hi_ix1) # local grid points in y dir
+        return x, y
+
+    def make_stencil(self, c, dt, dx, dy):
+        """the stencil of self.stencil_factory for the time step dt"""
+        st = self.stencil_factory(c, dt, dx, dy)
+        for s in (st, st.boundary):
+            if s is None:
+                continue
+            r = s.radius
+            if s.levels > 2:
+                raise ValueError("WaveSolver keeps two time levels, not %i"%s.levels)
+            if s.levels == 2 and (s.coeffs[1] != 0).sum() != (s.coeffs[1][r,r] != 0):
+                raise ValueError("the initial condition du/dt=0 needs a stencil that reads "
+                                 "the level before the last one only at the point itself")
+        if st.boundary is not None and st.boundary.radius > 1:
+            raise ValueError("the boundary stencil must have radius 1")
+        self.stencil_dt = dt
+        return st
+
+    def stencil_regions(self, region):
+        """
+        Split region into the points self.stencil can update and the ones
+        closer than its radius to the edge of the arrays, which get the
+        boundary stencil. Returns a list of (stencil, region).
+        """
+        st = self.stencil
+        r = st.radius
+        if r == 1:
+            return [(st, region)]
+        nx = len(self.x)-1; ny = len(self.y)-1
+        i0, i1, j0, j1 = region
+        a = min(max(i0, r), i1); b = max(min(i1, nx+1-r), a)
+        c = min(max(j0, r), j1); d = max(min(j1, ny+1-r), c)
+        bd = st.boundary
+        return [(st, (a, b, c, d)), (bd, (i0, a, j0, j1)), (bd, (b, i1, j0, j1)),
+                (bd, (a, b, j0, c)), (bd, (a, b, d, j1))]
+
+    def update_stencil(self, u, levels, t_old, region, mode, first_step=False):
+        """
+        Update u at the inner points of region with self.stencil, from the
+        time levels (u_1, u_2), in the inner implementation mode. The first
+        step from du/dt=0 gets only u_1, and solves for u with the level
+        before u_1 equal to u; the source term is added after that in full,
+        as in the built-in first step (dt**2*f for the wave equation).
+        """
+        f = self.f
+        x = self.x
+        y = self.y
+        def source(i0, i1, j0, j1):
+            if self.f_const is None:
+                return f(x[i0:i1,newaxis], y[newaxis,j0:j1], t_old)
+            return self.f_const
+        for st, (i0, i1, j0, j1) in self.stencil_regions(region):
+            if i0 >= i1 or j0 >= j1:
+                continue
+            solve = first_step and st.levels > 1
+            if mode == 'scalar':
+                for i in xrange(i0, i1):
+                    for j in xrange(j0, j1):
+                        st.apply_scalar(u, levels, i, j, 0.0 if solve else f(x[i], y[j], t_old))
+            elif mode == 'fused':
+                st.apply(u, levels, (i0, i1, j0, j1), self.scratch,
+                         None if solve else source(i0, i1, j0, j1))
+            elif mode == 'tiled':
+                ti, tj = self.tile
+                for a in xrange(i0, i1, ti):
+                    for b in xrange(j0, j1, tj):
+                        tile = (a, min(a+ti, i1), b, min(b+tj, j1))
+                        st.apply(u, levels, tile, self.scratch, None if solve else source(*tile))
+            else:
+                st.apply(u, levels, (i0, i1, j0, j1), None,
+                         None if solve else source(i0, i1, j0, j1))
+            if solve:
+                u[i0:i1,j0:j1] /= 1 - st.coeffs[1][st.radius,st.radius]
+                if mode == 'scalar':
+                    for i in xrange(i0, i1):
+                        for j in xrange(j0, j1):
+                            u[i,j] += st.source*f(x[i], y[j], t_old)
+                else:
+                    u[i0:i1,j0:j1] += st.source*source(i0, i1, j0, j1)
+
+    def alloc_scratch(self):
+        """allocate the scratch space of the 'fused' and 'tiled' updates"""
+        nx, ny = self.partitioner.get_num_loc_cells()
+        itemsize = self.us[0].itemsize
+        if self.implementation['inner'] == 'fused':
+            # scratch space for the largest region update_inner works on
+            self.scratch = zeros(max(nx-1, 0)*max(ny-1, 0), self.dtype)
+        elif self.implementation['inner'] == 'tiled':
+            # u, u_1, u_2 and scratch for a block fit in tile_bytes; take
+            # whole rows if they fit, since those are contiguous
+            points = max(self.tile_bytes//(4*itemsize), 1)
+            tj = max(min(ny-1, points), 1)
+            ti = max(points//tj, 1)
+            self.tile = (ti, tj)
+            self.scratch = zeros(ti*tj, self.dtype)
+
+    def rebalance(self, weights):
+        """
+        Resize the subdomains in proportion to weights, one for each engine
+        (e.g. its speed), by moving the solution between neighbors with
+        partitioner.repartition. Must be called on all engines, between
+        calls of solve.
+        """
+        u, u_1, u_2 = self.us
+        u_1, u_2 = self.partitioner.repartition(weights, u_1, u_2)
+        self.us = (zeros(u_1.shape, u_1.dtype), u_1, u_2)
+        self.x, self.y = self.local_grid()
+        if self.bc_edges is not None:
+            self.bc_edges, self.bc_time = self.cache_bc(self.bc, self.x, self.y,
+                                                        self.implementation)
+        self.alloc_scratch()
+
+    def balance(self, instrument, tolerance=0.1):
+        """
+        Rebalance the subdomains if the compute times per step recorded by
+        instrument (an Instrumentation of the last solve) differ by more
+        than tolerance from their mean, with the measured speeds (owned
+        points per second) as weights. Must be called on all engines, which
+        agree on the result through partitioner.allreduce. Returns True if
+        the subdomains were resized.
+        """
+        partitioner = self.partitioner
+        data = instrument.arrays()
+        times = data['times']
+        phases = data['phases']
+        compute = (times[:,phases.index('inner')]+times[:,phases.index('bc')]).mean()
+        points = 1
+        for sl in partitioner.get_owned_slices()[0]:
+            points *= sl.stop-sl.start
+        # everyone's compute time and speed, on every engine
+        loads = zeros((2, partitioner.num_procs))
+        loads[:, partitioner.my_id] = compute, points/max(compute, 1e-9)
+        loads = partitioner.allreduce(loads)
+        if loads[0].max() <= (1+tolerance)*loads[0].mean():
+            return False
+        self.rebalance(list(loads[1]))
+        return True
+
+
+    def cache_bc(self, bc, x, y, implementation):
+        """
+        Compute the declared boundary values on the four edges of the
+        subdomain once. Returns a list of (index, values) for the edges
+        i=0, i=nx, j=0, j=ny, and the time factor h (or None).
+        """
+        nx = len(x)-1; ny = len(y)-1
+        edges = [((0, slice(None)), x[0], y), ((nx, slice(None)), x[nx], y),
+                 ((slice(None), 0), x, y[0]), ((slice(None), ny), x, y[ny])]
+        h = None
+        if isinstance(bc, tuple):
+            g, h = bc
+        elif hasattr(bc, 'shape'):
+            # global boundary values, cut down to this subdomain
+            p = self.partitioner
+            local = tuple(slice(lo, hi+1) for lo, hi in zip(p.subd_lo_ix, p.subd_hi_ix))
+            bc = bc[local]
+        else:
+            value = float(bc)
+        cached = []
+        for index, ex, ey in edges:
+            ex, ey = broadcast_arrays(ex, ey)
+            values = zeros(len(ex), self.dtype)
+            if isinstance(bc, tuple):
+                if implementation['bc'] == 'scalar':
+                    for k in xrange(len(values)):
+                        values[k] = g(ex[k], ey[k])
+                else:
+                    values[:] = g(ex, ey)
+            elif hasattr(bc, 'shape'):
+                values[:] = bc[index]
+            else:
+                values[:] = value
+            cached.append((index, values))
+        return cached, h
+
+    def apply_cached_bc(self, u, t, edges):
+        """set the cached boundary values at time t on the given edges of u"""
+        h = self.bc_time
+        if h is None:
+            for k in edges:
+                index, values = self.bc_edges[k]
+                u[index] = values
+        else:
+            factor = h(t)
+            for k in edges:
+                index, values = self.bc_edges[k]
+                multiply(values, factor, out=u[index])
+
+    def update_inner(self, u, u_1, u_2, t_old, coeffs, region):
+        """
+        Update u at the inner points i0<=i<i1, j0<=j<j1, where
+        region = (i0, i1, j0, j1) and coeffs = (Cx2, Cy2, dt2).
+        """
+        i0, i1, j0, j1 = region
+        if i0 >= i1 or j0 >= j1:
+            return
+        if self.stencil is not None:
+            self.update_stencil(u, (u_1, u_2), t_old, region, self.implementation['inner'])
+            return
+        Cx2, Cy2, dt2 = coeffs
+        f = self.f
+        x = self.x
+        y = self.y
+        if self.implementation['inner'] == 'scalar':
+            for i in xrange(i0, i1):
+                for j in xrange(j0, j1):
+                    u[i,j] = - u_2[i,j] + 2*u_1[i,j] + \
+                       Cx2*(u_1[i-1,j] - 2*u_1[i,j] + u_1[i+1,j]) + \
+                       Cy2*(u_1[i,j-1] - 2*u_1[i,j] + u_1[i,j+1]) + \
+                       dt2*f(x[i], y[j], t_old)
+        elif self.implementation['inner'] == 'vectorized':
+            xv = x[i0:i1,newaxis]
+            yv = y[newaxis,j0:j1]
+            u[i0:i1,j0:j1] = - u_2[i0:i1,j0:j1] + 2*u_1[i0:i1,j0:j1] + \
+           Cx2*(u_1[i0-1:i1-1,j0:j1] - 2*u_1[i0:i1,j0:j1] + u_1[i0+1:i1+1,j0:j1]) + \
+           Cy2*(u_1[i0:i1,j0-1:j1-1] - 2*u_1[i0:i1,j0:j1] + u_1[i0:i1,j0+1:j1+1]) + \
+           dt2*f(xv, yv, t_old)
+        elif self.implementation['inner'] == 'fused':
+            self.update_fused(u, u_1, u_2, t_old, coeffs, region)
+        elif self.implementation['inner'] == 'tiled':
+            ti, tj = self.tile
+            for a in xrange(i0, i1, ti):
+                for b in xrange(j0, j1, tj):
+                    self.update_fused(u, u_1, u_2, t_old, coeffs,
+                                      (a, min(a+ti, i1), b, min(b+tj, j1)))
+
+    def update_fused(self, u, u_1, u_2, t_old, coeffs, region):
+        """
+        Update u at the inner points of region in place, with ufuncs that
+        write to u and self.scratch (which must have room for the region).
+        """
+        i0, i1, j0, j1 = region
+        Cx2, Cy2, dt2 = coeffs
+        # u = (2-2*Cx2-2*Cy2)*u_1 - u_2 + Cx2*(west+east) + Cy2*(south+north)
+        ur = u[i0:i1,j0:j1]
+        tmp = self.scratch[:(i1-i0)*(j1-j0)].reshape(ur.shape)
+        multiply(u_1[i0:i1,j0:j1], 2-2*Cx2-2*Cy2, out=ur)
+        subtract(ur, u_2[i0:i1,j0:j1], out=ur)
+        add(u_1[i0-1:i1-1,j0:j1], u_1[i0+1:i1+1,j0:j1], out=tmp)
+        multiply(tmp, Cx2, out=tmp)
+        add(ur, tmp, out=ur)
+        add(u_1[i0:i1,j0-1:j1-1], u_1[i0:i1,j0+1:j1+1], out=tmp)
+        multiply(tmp, Cy2, out=tmp)
+        add(ur, tmp, out=ur)
+        if self.f_const is None:
+            multiply(self.f(self.x[i0:i1,newaxis], self.y[newaxis,j0:j1], t_old), dt2, out=tmp)
+            add(ur, tmp, out=ur)
+        elif self.f_const != 0:
+            add(ur, dt2*self.f_const, out=ur)
+
+    def solve(self, tstop, dt=-1, user_action=None, verbose=False, final_test=False,
+              time_block=1, instrument=None):
         t0=time.time()
-        f=self.f
         c=self.c
         bc=self.bc
         partitioner = self.partitioner
@@ -179,11 +687,16 @@ class WaveSolver(object):
         nx = loc_nx; ny = loc_ny              # now use loc_nx and loc_ny instead
         x = self.x
         y = self.y
-        xv = x[:,newaxis]   # for vectorized expressions with f(xv,yv)
-        yv = y[newaxis,:]   # -- " --
-        if dt <= 0:
+        if dt <= 0 and self.stencil is not None:
+            dt = self.stencil_dt
+        elif dt <= 0:
             dt = (1/float(c))*(1/sqrt(1/dx**2 + 1/dy**2))  # max time step
         Cx2 = (c*dt/dx)**2;  Cy2 = (c*dt/dy)**2;  dt2 = dt**2  # help variables
+        radius = 1
+        if self.stencil is not None:
+            if dt != self.stencil_dt:
+                self.stencil = self.make_stencil(c, dt, dx, dy)
+            radius = self.stencil.radius
         # id for the four possible neighbor subdomains
         lower_x_neigh = partitioner.lower_neighbors[0]
         upper_x_neigh = partitioner.upper_neighbors[0]
@@ -191,77 +704,136 @@ class WaveSolver(object):
         upper_y_neigh = partitioner.upper_neighbors[1]
         u,u_1,u_2 = self.us
         # u_1 = self.u_1
-
-        t = 0.0
+        coeffs = (Cx2, Cy2, dt2)
+        exchange = implementation['exchange']
+        halo = partitioner.halo
+        if time_block > 1:
+            neighbors = partitioner.lower_neighbors[:2]+partitioner.upper_neighbors[:2]
+            if time_block*radius > halo and max(neighbors) > -1:
+                raise ValueError("%i steps between exchanges need a halo of %i cells, not %i"\
+                                 %(time_block, time_block*radius, halo))
+            if exchange == 'overlap':
+                raise ValueError("the 'overlap' exchange needs time_block=1")
+        # rows/columns next to the inner boundary, which are sent or
+        # received, and the rest of the interior
+        e = 2*halo
+        edge_regions = [(1, e, 1, ny), (max(e, nx-e+1), nx, 1, ny),
+                        (e, nx-e+1, 1, e), (e, nx-e+1, max(e, ny-e+1), ny)]
+        interior = (e, nx-e+1, e, ny-e+1)
+        # the edges of the global boundary, in the order of self.bc_edges
+        boundary_edges = [k for k, neigh in enumerate((lower_x_neigh, upper_x_neigh,
+                                                       lower_y_neigh, upper_y_neigh))
+                          if neigh < 0]
+
+        timer = instrument if instrument is not None else NoInstrumentation()
+        timer.begin_run(partitioner, max(int((tstop-self.t)/dt), 0)+2)
+
+        t = self.t
+        num_steps = 0
         while t <= tstop:
             t_old = t;  t += dt
+            num_steps += 1
             if verbose:
                 print('solving (%s version) at t=%g' % \
                       (implementation['inner'], t))
+            timer.begin_step()
             # update all inner points:
-            if implementation['inner'] == 'scalar':
-                for i in xrange(1, nx):
-                    for j in xrange(1, ny):
-                        u[i,j] = - u_2[i,j] + 2*u_1[i,j] + \
-                           Cx2*(u_1[i-1,j] - 2*u_1[i,j] + u_1[i+1,j]) + \
-                           Cy2*(u_1[i,j-1] - 2*u_1[i,j] + u_1[i,j+1]) + \
-                           dt2*f(x[i], y[j], t_old)
-            elif implementation['inner'] == 'vectorized':
-                u[1:nx,1:ny] = - u_2[1:nx,1:ny] + 2*u_1[1:nx,1:ny] + \
-               Cx2*(u_1[0:nx-1,1:ny] - 2*u_1[1:nx,1:ny] + u_1[2:nx+1,1:ny]) + \
-               Cy2*(u_1[1:nx,0:ny-1] - 2*u_1[1:nx,1:ny] + u_1[1:nx,2:ny+1]) + \
-               dt2*f(xv[1:nx,1:ny], yv[1:nx,1:ny], t_old)
+            if exchange == 'overlap':
+                # first the points the neighbors need from us
+                for region in edge_regions:
+                    self.update_inner(u, u_1, u_2, t_old, coeffs, region)
+            else:
+                self.update_inner(u, u_1, u_2, t_old, coeffs, (1, nx, 1, ny))
+            timer.mark('inner')
 
             # insert boundary conditions (if there's no neighbor):
-            if lower_x_neigh < 0:
-                if implementation['bc'] == 'scalar':
-                    i = 0
-                    for j in xrange(0, ny+1):
-                        u[i,j] = bc(x[i], y[j], t)
-                elif implementation['bc'] == 'vectorized':
-                    u[0,:] = bc(x[0], y, t)
-            if upper_x_neigh < 0:
-                if implementation['bc'] == 'scalar':
-                    i = nx
-                    for j in xrange(0, ny+1):
-                        u[i,j] = bc(x[i], y[j], t)
-                elif implementation['bc'] == 'vectorized':
-                    u[nx,:] = bc(x[nx], y, t)
-            if lower_y_neigh < 0:
-                if implementation['bc'] == 'scalar':
-                    j = 0
-                    for i in xrange(0, nx+1):
-                        u[i,j] = bc(x[i], y[j], t)
-                elif implementation['bc'] == 'vectorized':
-                    u[:,0] = bc(x, y[0], t)
-            if upper_y_neigh < 0:
-                if implementation['bc'] == 'scalar':
-                    j = ny
-                    for i in xrange(0, nx+1):
-                        u[i,j] = bc(x[i], y[j], t)
-                elif implementation['bc'] == 'vectorized':
-                    u[:,ny] = bc(x, y[ny], t)
+            if self.bc_edges is not None:
+                self.apply_cached_bc(u, t, boundary_edges)
+            else:
+                if lower_x_neigh < 0:
+                    if implementation['bc'] == 'scalar':
+                        i = 0
+                        for j in xrange(0, ny+1):
+                            u[i,j] = bc(x[i], y[j], t)
+                    elif implementation['bc'] == 'vectorized':
+                        u[0,:] = bc(x[0], y, t)
+                if upper_x_neigh < 0:
+                    if implementation['bc'] == 'scalar':
+                        i = nx
+                        for j in xrange(0, ny+1):
+                            u[i,j] = bc(x[i], y[j], t)
+                    elif implementation['bc'] == 'vectorized':
+                        u[nx,:] = bc(x[nx], y, t)
+                if lower_y_neigh < 0:
+                    if implementation['bc'] == 'scalar':
+                        j = 0
+                        for i in xrange(0, nx+1):
+                            u[i,j] = bc(x[i], y[j], t)
+                    elif implementation['bc'] == 'vectorized':
+                        u[:,0] = bc(x, y[0], t)
+                if upper_y_neigh < 0:
+                    if implementation['bc'] == 'scalar':
+                        j = ny
+                        for i in xrange(0, nx+1):
+                            u[i,j] = bc(x[i], y[j], t)
+                    elif implementation['bc'] == 'vectorized':
+                        u[:,ny] = bc(x, y[ny], t)
+            timer.mark('bc')
 
             # communication
-            partitioner.update_internal_boundary (u)
+            if exchange == 'overlap':
+                partitioner.begin_exchange(u)
+                timer.mark('send')
+                # compute the deep interior while the messages are in flight
+                self.update_inner(u, u_1, u_2, t_old, coeffs, interior)
+                timer.mark('inner')
+                partitioner.finish_exchange(u)
+                timer.mark('recv')
+                timer.count_exchange(1)
+            elif time_block == 1:
+                partitioner.update_internal_boundary (u)
+                timer.mark('recv')
+                timer.count_exchange(1)
+            elif num_steps % time_block == 0:
+                # the valid part of the halo has shrunk to nothing, refresh
+                # both time levels the next step depends on, in one message
+                partitioner.update_internal_boundary (u, u_1)
+                timer.mark('recv')
+                timer.count_exchange(2)
 
             if user_action is not None:
                 user_action(u, x, y, t)
+                timer.mark('user_action')
             # update data structures for next step
             u_2, u_1, u = u_1, u, u_2
 
+        if time_block > 1 and num_steps % time_block != 0:
+            # stopped in the middle of a block: refresh the halo, so that
+            # the next call of solve starts a block of its own
+            partitioner.update_internal_boundary (u_1, u_2)
+            timer.mark('recv')
+            timer.count_exchange(2)
+
         t1 = time.time()
-        print('my_id=%2d, dt=%g, %s version, slice_copy=%s, net Wtime=%g'\
-              %(partitioner.my_id,dt,implementation['inner'],\
+        print('my_id=%2d, dt=%g, %s version, %s exchange, time_block=%i, slice_copy=%s, net Wtime=%g'\
+              %(partitioner.my_id,dt,implementation['inner'],exchange,time_block,\
                 partitioner.slice_copy,t1-t0))
+        # keep the timing around, so it can be pulled from the engines
+        self.wtime = t1-t0
+        self.num_steps = num_steps
         # save the us
         self.us = u,u_1,u_2
+        self.t = t
         # check final results; compute discrete L2-norm of the solution
         if final_test:
-            loc_res = 0.0
-            for i in iseq(start=1, stop=nx-1):
-                for j in iseq(start=1, stop=ny-1):
-                    loc_res += u_1[i,j]**2
-            return loc_res
+            # the inner points this subdomain owns, so that the overlap
+            # with the neighbors is only counted once
+            local = partitioner.get_owned_slices()[0]
+            inner = tuple(slice(max(sl.start, 1), min(sl.stop, n))
+                          for sl, n in zip(local, (nx, ny)))
+            v = u_1[inner]
+            loc_res = float(einsum('ij,ij', v, v, dtype=float))
+            # the sum over all subdomains, the same on every engine
+            return partitioner.allreduce(loc_res)
         return dt
 